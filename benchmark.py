@@ -0,0 +1,476 @@
+# Note: Benchmarks for the pipeline of project.py. A synthetic OSM file shaped like the Bengaluru
+# extract is generated at a chosen scale, every stage is timed on its own and the results are
+# saved as json, so the runs of two commits can be compared with --compare.
+
+import argparse
+import codecs
+import json
+import math
+import os
+import platform
+import random
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from collections import namedtuple
+from xml.sax.saxutils import quoteattr
+import project
+import reports
+
+# ================================================== #
+#               Synthetic OSM                        #
+# ================================================== #
+SyntheticConfig = namedtuple('SyntheticConfig', ['nodes', 'ways', 'tags_per_element', 'nodes_per_way',
+                                                 'kannada_ratio', 'abbreviation_ratio', 'seed'])
+DEFAULT_CONFIG = SyntheticConfig(nodes=100000, ways=20000, tags_per_element=3.0, nodes_per_way=8,
+                                 kannada_ratio=0.2, abbreviation_ratio=0.3, seed=42)
+
+# Roughly the area of the extract
+MIN_LAT, MAX_LAT = 12.80, 13.15
+MIN_LON, MAX_LON = 77.45, 77.75
+FIRST_NODE_ID = 1000000
+FIRST_WAY_ID = 100000000
+USERS = [(1000 + i, 'mapper_{0}'.format(i)) for i in range(200)]
+
+AMENITIES = ['restaurant', 'cafe', 'fast_food', 'bank', 'atm', 'school', 'hospital', 'place_of_worship',
+             'pharmacy', 'fuel']
+CUISINES = ['indian', 'regional', 'south_indian', 'pizza', 'chinese', 'burger', 'coffee_shop']
+BANKS = ['State Bank of India', 'Canara Bank', 'HDFC Bank', 'ICICI Bank', 'Axis Bank', 'Corporation Bank']
+HIGHWAYS = ['residential', 'service', 'tertiary', 'secondary', 'primary', 'unclassified', 'footway']
+AREAS = ['Jayanagar', 'Koramangala', 'Indiranagar', 'Malleshwaram', 'Banashankari', 'Rajajinagar',
+         'Basavanagudi', 'Whitefield', 'Hebbal', 'Yelahanka']
+ORDINALS = ['1st', '2nd', '3rd', '4th', '5th', '6th', '7th', '8th', '9th', '10th', '11th', '12th']
+# Street kinds, each with the abbreviations fix_street_name expands
+STREET_KINDS = [('Road', ['Rd', 'rd.', 'road']), ('Main', ['Mn', 'mn.', 'main']),
+                ('Cross', ['Crs', 'crs.', 'cross'])]
+# Kannada letters the Kannada names are made of
+KANNADA = [unichr(c) for c in range(0x0c85, 0x0c95)] + [unichr(c) for c in range(0x0c95, 0x0cb9)]
+
+
+class SyntheticOsm(object):
+    """Random elements drawn according to a SyntheticConfig, reproducible from its seed"""
+
+    def __init__(self, config):
+        self.config = config
+        self.random = random.Random(config.seed)
+
+    def street(self):
+        """A street name, abbreviated with probability abbreviation_ratio"""
+        rnd = self.random
+        kind, abbreviations = rnd.choice(STREET_KINDS)
+        if rnd.random() < self.config.abbreviation_ratio:
+            kind = rnd.choice(abbreviations)
+        if rnd.random() < 0.5:
+            return u'{0} {1}, {2}'.format(rnd.choice(ORDINALS), kind, rnd.choice(AREAS))
+        return u'{0} {1}'.format(rnd.choice(AREAS), kind)
+
+    def kannada(self):
+        return u''.join(self.random.choice(KANNADA) for _ in range(self.random.randint(3, 9)))
+
+    def name_tags(self, name):
+        """name, plus name:kn (and then name:en) with probability kannada_ratio"""
+        if self.random.random() < self.config.kannada_ratio:
+            return [('name', self.kannada()), ('name:kn', self.kannada()), ('name:en', name)]
+        return [('name', name)]
+
+    def tag_count(self):
+        """tags_per_element on average: its whole part, plus one with the fraction's probability"""
+        whole = int(self.config.tags_per_element)
+        return whole + (self.random.random() < self.config.tags_per_element - whole)
+
+    def node_tags(self):
+        """An amenity with the tags that go with it, cut to tag_count() tags"""
+        rnd = self.random
+        tags = []
+        count = self.tag_count()
+        while len(tags) < count:
+            amenity = rnd.choice(AMENITIES)
+            tags.append(('amenity', amenity))
+            if amenity in ('restaurant', 'cafe', 'fast_food'):
+                tags.append(('cuisine', rnd.choice(CUISINES)))
+                tags.extend(self.name_tags(u'{0} {1}'.format(rnd.choice(AREAS), amenity.title())))
+            elif amenity in ('bank', 'atm'):
+                bank = rnd.choice(BANKS)
+                tags.extend(self.name_tags(bank))
+                tags.append(('operator', bank))
+            else:
+                tags.append(('addr:street', self.street()))
+        return tags[:count]
+
+    def way_tags(self):
+        """A named street, cut to tag_count() tags"""
+        rnd = self.random
+        tags = []
+        count = self.tag_count()
+        while len(tags) < count:
+            tags.extend(self.name_tags(self.street()))
+            tags.append(('highway', rnd.choice(HIGHWAYS)))
+            if rnd.random() < 0.3:
+                tags.append(('source', 'survey'))
+        return tags[:count]
+
+    def attributes(self, element_id):
+        rnd = self.random
+        uid, user = rnd.choice(USERS)
+        return [('id', element_id), ('user', user), ('uid', uid), ('version', rnd.randint(1, 5)),
+                ('changeset', rnd.randint(1000000, 40000000)),
+                ('timestamp', '20{0:02d}-0{1}-1{2}T10:00:00Z'.format(rnd.randint(8, 16), rnd.randint(1, 9),
+                                                                      rnd.randint(0, 9)))]
+
+    def way_node_ids(self):
+        """A run of nearby node ids, so ways share nodes and intersect"""
+        config = self.config
+        length = self.random.randint(2, 2 * config.nodes_per_way - 2)
+        start = self.random.randint(0, max(config.nodes - length, 0))
+        return [FIRST_NODE_ID + start + i for i in range(min(length, config.nodes))]
+
+    def write(self, path):
+        """Write the OSM xml to path and return its size in bytes"""
+        rnd = self.random
+        config = self.config
+        with codecs.open(path, 'w', 'utf-8') as f:
+            f.write(u"<?xml version='1.0' encoding='UTF-8'?>\n<osm version=\"0.6\" generator=\"benchmark.py\">\n")
+            for i in range(config.nodes):
+                attributes = self.attributes(FIRST_NODE_ID + i) + [
+                    ('lat', '{0:.7f}'.format(rnd.uniform(MIN_LAT, MAX_LAT))),
+                    ('lon', '{0:.7f}'.format(rnd.uniform(MIN_LON, MAX_LON)))]
+                write_element(f, 'node', attributes, self.node_tags())
+            for i in range(config.ways):
+                write_element(f, 'way', self.attributes(FIRST_WAY_ID + i), self.way_tags(), self.way_node_ids())
+            f.write(u'</osm>\n')
+        return os.path.getsize(path)
+
+
+def write_element(f, tag, attributes, tags, node_ids=()):
+    f.write(u' <{0} {1}'.format(tag, u' '.join(u'{0}={1}'.format(k, quoteattr(unicode(v)))
+                                               for k, v in attributes)))
+    if not tags and not node_ids:
+        f.write(u'/>\n')
+        return
+    f.write(u'>\n')
+    for node_id in node_ids:
+        f.write(u'  <nd ref="{0}"/>\n'.format(node_id))
+    for k, v in tags:
+        f.write(u'  <tag k={0} v={1}/>\n'.format(quoteattr(k), quoteattr(v)))
+    f.write(u' </{0}>\n'.format(tag))
+
+
+def generate_osm(path, config=DEFAULT_CONFIG):
+    """Write a synthetic OSM file for config to path and return its size in bytes"""
+    return SyntheticOsm(config).write(path)
+
+
+# ================================================== #
+#               Stage Timing                         #
+# ================================================== #
+StageResult = namedtuple('StageResult', ['name', 'seconds', 'items', 'unit', 'per_second', 'peak_rss_kb'])
+
+
+def peak_rss_kb():
+    """Peak resident set size of this process so far (kB on Linux, bytes on macOS)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class StageTimer(object):
+    """Time the stages of a run and collect them as StageResults"""
+
+    def __init__(self, verbose=True):
+        self.stages = []
+        self.verbose = verbose
+
+    def run(self, name, fn, items=None, unit='elements', repeat=1):
+        """Call fn repeat times and record the fastest. items (or, if None, the length of what
+        fn returns) is the amount of work done, for the throughput."""
+        best = None
+        for _ in range(repeat):
+            start = time.time()
+            result = fn()
+            seconds = time.time() - start
+            best = seconds if best is None else min(best, seconds)
+        if items is None:
+            items = len(result)
+        stage = StageResult(name, best, items, unit, items / best if best else 0.0, peak_rss_kb())
+        self.stages.append(stage)
+        if self.verbose:
+            print "{0:<28} {1:>10.4f}s {2:>12.0f} {3}/s".format(name, best, stage.per_second, unit)
+        return result
+
+
+def reset_caches():
+    """Empty the memo tables of project so every stage starts cold"""
+    project.VALUE_CACHE.clear()
+    project.KEY_CACHE.clear()
+    project.CLEANING.dispatch.clear()
+    project.CLEANING.reset()
+
+
+def shape_all(elements):
+    reset_caches()
+    shaped = []
+    for i in range(0, len(elements), project.SHAPE_BATCH_SIZE):
+        shaped.extend(project.shape_elements(elements[i:i + project.SHAPE_BATCH_SIZE]))
+    return [el for el in shaped if el]
+
+
+def fix_all(values):
+    project.VALUE_CACHE.clear()
+    return [project.value_fixer(value) for value in values]
+
+
+def validate_all(shaped):
+    validator = project.CompiledValidator()
+    for el in shaped:
+        project.validate_element(el, validator)
+    return shaped
+
+
+def write_csvs(shaped):
+    sink = project.CsvSink(project.CSV_PATHS)
+    for el in shaped:
+        sink.add(el)
+    sink.close()
+    return shaped
+
+
+def load_sqlite(shaped, db_path):
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    conn = sqlite3.connect(db_path)
+    project.create_tables(conn)
+    with project.tuned_for_load(conn):
+        sink = project.SqliteSink(conn)
+        for el in shaped:
+            sink.add(el)
+        sink.close()
+    return conn
+
+
+def street_values(elements):
+    """Raw values of the tags the value_fixer rule applies to"""
+    rules = [rule for rule in project.CLEANING.rules if rule.clean is project.value_fixer]
+    return [child.attrib['v'] for element in elements for child in element
+            if child.tag == 'tag' and any(rule.applies_to(child.attrib['k']) for rule in rules)]
+
+
+# Spatial queries: each is run at SPATIAL_QUERIES random points of the area, through node_rtree
+# and as the plain scans of the node table it replaces
+SPATIAL_QUERIES = 50
+SPATIAL_RADIUS = 1000.0
+SPATIAL_NEAREST = 10
+
+
+def query_points(count=SPATIAL_QUERIES, seed=0):
+    rnd = random.Random(seed)
+    return [(rnd.uniform(MIN_LAT, MAX_LAT), rnd.uniform(MIN_LON, MAX_LON)) for _ in range(count)]
+
+
+def scan_bbox(conn, bbox):
+    """nodes_in_bbox without the spatial index: (id, lat, lon) of the nodes inside bbox"""
+    min_lat, min_lon, max_lat, max_lon = bbox
+    return conn.execute('SELECT id, lat, lon FROM node WHERE lat BETWEEN ? AND ? AND lon BETWEEN ? AND ? '
+                        'ORDER BY id', (min_lat, max_lat, min_lon, max_lon)).fetchall()
+
+
+def scan_within(conn, lat, lon, metres):
+    """nodes_within without the spatial index: (distance, id) of the nodes within metres"""
+    hits = [(project.distance(lat, lon, node_lat, node_lon), node_id)
+            for node_id, node_lat, node_lon in scan_bbox(conn, project.radius_bbox(lat, lon, metres))]
+    return sorted(hit for hit in hits if hit[0] <= metres)
+
+
+def scan_nearest(conn, lat, lon, k, start_metres=250.0):
+    """nearest_nodes without the spatial index, growing the radius the same way"""
+    metres = start_metres
+    while True:
+        hits = scan_within(conn, lat, lon, metres)
+        if len(hits) >= k or metres > math.pi * project.EARTH_RADIUS:
+            return hits[:k]
+        metres *= 2
+
+
+def spatial_queries(timer, conn, points, repeat=1):
+    """Time the bbox, radius and nearest queries at points, indexed and scanning"""
+    boxes = [project.radius_bbox(lat, lon, SPATIAL_RADIUS) for lat, lon in points]
+    queries = [
+        ('bbox', lambda: [project.nodes_in_bbox(conn, bbox, with_tags=False) for bbox in boxes],
+         lambda: [scan_bbox(conn, bbox) for bbox in boxes]),
+        ('within', lambda: [project.nodes_within(conn, lat, lon, SPATIAL_RADIUS, with_tags=False)
+                            for lat, lon in points],
+         lambda: [scan_within(conn, lat, lon, SPATIAL_RADIUS) for lat, lon in points]),
+        ('nearest', lambda: [project.nearest_nodes(conn, lat, lon, SPATIAL_NEAREST, with_tags=False)
+                             for lat, lon in points],
+         lambda: [scan_nearest(conn, lat, lon, SPATIAL_NEAREST) for lat, lon in points]),
+    ]
+    for name, indexed, scan in queries:
+        timer.run('rtree:' + name, indexed, unit='queries', repeat=repeat)
+        timer.run('scan:' + name, scan, unit='queries', repeat=repeat)
+
+
+def run_benchmark(osm_path, workdir, timer, report_repeat=3, workers=1, pipelined=False):
+    """Run every stage on osm_path inside workdir; return the cleaning rule stats and the db size"""
+    project.NODES_PATH, project.NODE_TAGS_PATH, project.WAYS_PATH, project.WAY_NODES_PATH, project.WAY_TAGS_PATH = \
+        project.CSV_PATHS = tuple(os.path.join(workdir, os.path.basename(path)) for path in project.CSV_PATHS)
+    db_path = os.path.join(workdir, 'benchmark.db')
+
+    elements = timer.run('get_element', lambda: list(project.get_element(osm_path, tags=('node', 'way'))))
+    tags = sum(1 for element in elements for child in element if child.tag == 'tag')
+    shaped = timer.run('shape_element', lambda: shape_all(elements))
+    rule_stats = project.CLEANING.stats()
+    timer.run('shape_element (tags)', lambda: shape_all(elements), items=tags, unit='tags')
+    values = street_values(elements)
+    timer.run('value_fixer', lambda: fix_all(values), unit='values')
+    timer.run('validation', lambda: validate_all(shaped))
+    timer.run('csv', lambda: write_csvs(shaped))
+    elements = None
+    conn = timer.run('sqlite_load', lambda: load_sqlite(shaped, db_path), items=len(shaped))
+    shaped = None
+    timer.run('build_indexes', lambda: project.build_indexes(conn), items=1, unit='builds')
+    timer.run('build_summaries', lambda: project.build_summaries(conn), items=1, unit='builds')
+    timer.run('build_node_index', lambda: project.build_node_index(conn), items=1, unit='builds')
+    spatial_queries(timer, conn, query_points(), report_repeat)
+    conn.close()
+    db_bytes = os.path.getsize(db_path)
+    print "db size {0:.1f}MB".format(db_bytes / 1e6)
+
+    runner = reports.QueryRunner(db_path, threads=1)
+    try:
+        for prefix, report_list in (('report:', reports.REPORTS), ('scan:', reports.SCAN_REPORTS)):
+            for report in report_list:
+                timer.run(prefix + report.name, lambda: runner.run(report), items=1, unit='queries',
+                          repeat=report_repeat)
+    finally:
+        runner.close()
+
+    if pipelined:
+        for name, flag in (('process_map', False), ('process_map (pipelined)', True)):
+            os.remove(db_path)
+            conn = sqlite3.connect(db_path)
+            project.create_tables(conn)
+            with project.tuned_for_load(conn, resumable=True):
+                timer.run(name, lambda: project.process_map(osm_path, False, conn=conn, pipelined=flag),
+                          items=os.path.getsize(osm_path), unit='bytes')
+            conn.close()
+    if workers > 1:
+        os.remove(db_path)
+        conn = sqlite3.connect(db_path)
+        project.create_tables(conn)
+        with project.tuned_for_load(conn, resumable=True):
+            timer.run('process_map ({0} workers)'.format(workers),
+                      lambda: project.process_map(osm_path, False, workers=workers, conn=conn),
+                      items=os.path.getsize(osm_path), unit='bytes')
+        conn.close()
+    return rule_stats, db_bytes
+
+
+# ================================================== #
+#               Results                              #
+# ================================================== #
+def git_commit():
+    """The commit of the checkout benchmark.py runs from, if it is a git repository"""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def results_dict(config, osm_path, timer, rule_stats, db_bytes):
+    return {
+        'commit': git_commit(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'config': config._asdict() if config is not None else None,
+        'osm_path': osm_path,
+        'osm_bytes': os.path.getsize(osm_path),
+        'db_bytes': db_bytes,
+        'peak_rss_kb': peak_rss_kb(),
+        'stages': [stage._asdict() for stage in timer.stages],
+        'cleaning_rules': [dict(zip(['name', 'hits', 'misses', 'seconds'], stat)) for stat in rule_stats],
+    }
+
+
+def compare(previous, current, threshold=0.1, min_seconds=0.01):
+    """Print the seconds of each stage in both results and return the stages more than
+    threshold slower in current. Stages faster than min_seconds in both are too noisy to flag."""
+    if previous.get('config') != current.get('config') or previous.get('osm_bytes') != current.get('osm_bytes'):
+        print "warning: the two runs benchmarked different inputs"
+    before = dict((stage['name'], stage) for stage in previous['stages'])
+    print "{0:<28} {1:>9} {2:>9} {3:>7}   ({4} -> {5})".format(
+        'stage', 'before', 'after', 'ratio', previous.get('commit'), current.get('commit'))
+    slower = []
+    for stage in current['stages']:
+        old = before.get(stage['name'])
+        if old is None:
+            print "{0:<28} {1:>9} {2:>9.3f}".format(stage['name'], '-', stage['seconds'])
+            continue
+        ratio = stage['seconds'] / old['seconds'] if old['seconds'] else float('inf')
+        flag = ''
+        if ratio > 1 + threshold and max(stage['seconds'], old['seconds']) >= min_seconds:
+            flag = '  slower'
+            slower.append(stage['name'])
+        print "{0:<28} {1:>9.3f} {2:>9.3f} {3:>6.2f}x{4}".format(stage['name'], old['seconds'], stage['seconds'],
+                                                                ratio, flag)
+    print "peak rss: {0} -> {1} kB".format(previous.get('peak_rss_kb'), current.get('peak_rss_kb'))
+    print "db size: {0} -> {1} bytes".format(previous.get('db_bytes'), current.get('db_bytes'))
+    return slower
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark each stage of project.py on a synthetic OSM file')
+    parser.add_argument('--osm', help='benchmark this OSM file instead of generating one')
+    parser.add_argument('--nodes', type=int, default=DEFAULT_CONFIG.nodes)
+    parser.add_argument('--ways', type=int, default=DEFAULT_CONFIG.ways)
+    parser.add_argument('--tags-per-element', type=float, default=DEFAULT_CONFIG.tags_per_element,
+                        help='average number of tags per node and per way')
+    parser.add_argument('--nodes-per-way', type=int, default=DEFAULT_CONFIG.nodes_per_way)
+    parser.add_argument('--kannada-ratio', type=float, default=DEFAULT_CONFIG.kannada_ratio,
+                        help='fraction of names written in kannada, with name:kn and name:en')
+    parser.add_argument('--abbreviation-ratio', type=float, default=DEFAULT_CONFIG.abbreviation_ratio,
+                        help='fraction of street names with an abbreviated Road/Main/Cross')
+    parser.add_argument('--seed', type=int, default=DEFAULT_CONFIG.seed)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='also time a full parallel process_map with this many workers')
+    parser.add_argument('--pipelined', action='store_true',
+                        help='also time a full process_map, serial and pipelined')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each report query, the fastest is kept')
+    parser.add_argument('--output', metavar='JSON', help='save the results here')
+    parser.add_argument('--compare', metavar='JSON', help='compare with the results of an earlier run')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='with --compare, exit 1 if a stage is this much slower')
+    parser.add_argument('--keep', action='store_true', help='keep the work directory with the osm, csvs and db')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='osm-benchmark-')
+    try:
+        config = None
+        osm_path = args.osm
+        if osm_path is None:
+            config = SyntheticConfig(args.nodes, args.ways, args.tags_per_element, args.nodes_per_way,
+                                     args.kannada_ratio, args.abbreviation_ratio, args.seed)
+            osm_path = os.path.join(workdir, 'synthetic.osm')
+            start = time.time()
+            size = generate_osm(osm_path, config)
+            print "generated {0} ({1:.1f}MB) in {2:.1f}s".format(osm_path, size / 1e6, time.time() - start)
+        timer = StageTimer()
+        rule_stats, db_bytes = run_benchmark(osm_path, workdir, timer, args.repeat, args.workers,
+                                             args.pipelined)
+        results = results_dict(config, osm_path, timer, rule_stats, db_bytes)
+        print "peak rss {0} kB".format(results['peak_rss_kb'])
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        if args.compare:
+            with open(args.compare) as f:
+                if compare(json.load(f), results, args.threshold):
+                    sys.exit(1)
+    finally:
+        if args.keep:
+            print "work directory kept in", workdir
+        else:
+            shutil.rmtree(workdir)
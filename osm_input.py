@@ -0,0 +1,489 @@
+# Note: The input formats project.get_element reads besides plain .osm xml: .osm.bz2 and .osm.gz,
+# decompressed on a background thread while the parser works, and .osm.pbf, the binary format
+# OSM data is distributed in.
+# A pbf file is a sequence of blobs, each a zlib compressed PrimitiveBlock of up to 8000
+# elements with its own string table. They are decoded here straight from the protobuf wire
+# format of fileformat.proto and osmformat.proto, so no protobuf library is needed, into the
+# same OsmElement records the xml parser produces.
+
+import bz2
+import os
+import Queue
+import struct
+import sys
+import threading
+import time
+import zlib
+from collections import namedtuple
+
+# A <tag> or <nd> child of an element
+OsmChild = namedtuple('OsmChild', ['tag', 'attrib'])
+
+
+class OsmElement(object):
+    """Detached copy of a top level OSM element: its tag, attributes and children"""
+    __slots__ = ('tag', 'attrib', 'children')
+
+    def __init__(self, tag, attrib, children):
+        self.tag = tag
+        self.attrib = attrib
+        self.children = children
+
+    def __iter__(self):
+        return iter(self.children)
+
+
+COMPRESSED_FORMATS = {'.bz2': 'bz2', '.gz': 'gz'}
+# Compressed bytes decompressed at a time, and decompressed chunks kept ready for the parser
+DECOMPRESS_CHUNK = 1024 * 1024
+DECOMPRESS_QUEUE = 16
+PBF_FEATURES = frozenset(['OsmSchema-V0.6', 'DenseNodes'])
+PBF_MEMBER_TYPES = ('node', 'way', 'relation')
+
+
+def osm_format(file_in):
+    """'pbf', 'bz2', 'gz' or 'xml', from the name of file_in"""
+    name = file_in.lower()
+    if name.endswith('.pbf'):
+        return 'pbf'
+    return COMPRESSED_FORMATS.get(os.path.splitext(name)[1], 'xml')
+
+
+def open_osm(file_in):
+    """Open file_in for get_element, whichever input format it is in"""
+    osm_type = osm_format(file_in)
+    if osm_type == 'pbf':
+        return PbfReader(file_in)
+    if osm_type == 'xml':
+        return open(file_in, 'rb')
+    return DecompressingReader(file_in)
+
+
+class DecompressingReader(object):
+    """File-like view of the xml inside a .bz2 or .gz file.
+
+    A background thread reads and decompresses the file DECOMPRESS_CHUNK at a time into a
+    queue of at most queue_size chunks, and read() takes them from there. Concatenated streams,
+    as written by pbzip2 or by appending gzip files, are followed. tell() is how far the
+    compressed file has been read. safe_offset is always 0: a compressed file can only be
+    read again from its start, so a resumed import skips what is loaded by id instead.
+    """
+
+    def __init__(self, file_in, queue_size=DECOMPRESS_QUEUE):
+        self.compression = osm_format(file_in)
+        if self.compression not in COMPRESSED_FORMATS.values():
+            raise ValueError('{0} is not a .bz2 or .gz file'.format(file_in))
+        self.osm = open(file_in, 'rb')
+        self.chunks = Queue.Queue(queue_size)
+        self.chunk = ''
+        self.offset = 0
+        self.position = 0
+        self.safe_offset = 0
+        self.done = False
+        self.stopped = False
+        self.thread = threading.Thread(target=self.decompress)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def decompressor(self):
+        if self.compression == 'bz2':
+            return bz2.BZ2Decompressor()
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def put(self, item):
+        while not self.stopped:
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def decompress(self):
+        try:
+            decompressor = self.decompressor()
+            data = ''
+            position = 0
+            while not self.stopped:
+                if not data:
+                    data = self.osm.read(DECOMPRESS_CHUNK)
+                    if not data:
+                        break
+                    position += len(data)
+                try:
+                    chunk = decompressor.decompress(data)
+                except EOFError:
+                    # a bz2 stream ended exactly at the end of the last read
+                    decompressor = self.decompressor()
+                    continue
+                # only left over when a stream ended inside data and another one follows
+                data = decompressor.unused_data
+                if data:
+                    decompressor = self.decompressor()
+                if chunk:
+                    self.put((chunk, position))
+            self.put(None)
+        except Exception:
+            self.put(sys.exc_info())
+
+    def next_chunk(self):
+        """Make the next decompressed chunk current; False at the end of the file"""
+        if self.done:
+            return False
+        item = self.chunks.get()
+        if item is None:
+            self.done = True
+            return False
+        if len(item) == 3:
+            self.done = True
+            raise item[0], item[1], item[2]
+        self.chunk, self.position = item
+        self.offset = 0
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            pieces = [self.chunk[self.offset:]]
+            while self.next_chunk():
+                pieces.append(self.chunk)
+            self.offset = len(self.chunk)
+            return ''.join(pieces)
+        pieces = []
+        while size > 0:
+            if self.offset >= len(self.chunk) and not self.next_chunk():
+                break
+            piece = self.chunk[self.offset:self.offset + size]
+            self.offset += len(piece)
+            size -= len(piece)
+            pieces.append(piece)
+        return ''.join(pieces)
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.stopped = True
+        while self.thread.is_alive():
+            try:
+                self.chunks.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        self.osm.close()
+
+
+def read_varint(data, pos):
+    """Decode the protobuf varint at data[pos:]; return it and the position after it"""
+    result = shift = 0
+    while True:
+        b = ord(data[pos])
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def message_fields(data):
+    """Decode a protobuf message into {field number: [values]}: varints as ints, length
+    delimited fields (strings, bytes, messages, packed arrays) as str"""
+    fields = {}
+    pos, end = 0, len(data)
+    while pos < end:
+        # keys, lengths and most small values are single byte varints
+        key = ord(data[pos])
+        if key < 0x80:
+            pos += 1
+        else:
+            key, pos = read_varint(data, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            value = ord(data[pos])
+            if value < 0x80:
+                pos += 1
+            else:
+                value, pos = read_varint(data, pos)
+        elif wire_type == 2:
+            length = ord(data[pos])
+            if length < 0x80:
+                pos += 1
+            else:
+                length, pos = read_varint(data, pos)
+            value = data[pos:pos + length]
+            pos += length
+        elif wire_type == 1:
+            value = data[pos:pos + 8]
+            pos += 8
+        elif wire_type == 5:
+            value = data[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError('unsupported protobuf wire type {0}'.format(wire_type))
+        fields.setdefault(key >> 3, []).append(value)
+    return fields
+
+
+def zigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def int64(value):
+    """A varint read as a (two's complement) int64"""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def packed(fields, number, signed=False):
+    """The values of repeated varint field number, packed or not; signed for sint32/sint64"""
+    values = []
+    for value in fields.get(number, ()):
+        if not isinstance(value, str):
+            values.append(zigzag(value) if signed else value)
+            continue
+        append = values.append
+        varint = shift = 0
+        for b in bytearray(value):
+            varint |= (b & 0x7f) << shift
+            if b & 0x80:
+                shift += 7
+                continue
+            append(((varint >> 1) ^ -(varint & 1)) if signed else varint)
+            varint = shift = 0
+    return values
+
+
+def delta_decoded(values):
+    total = 0
+    decoded = []
+    append = decoded.append
+    for value in values:
+        total += value
+        append(total)
+    return decoded
+
+
+def first(fields, number, default=None):
+    values = fields.get(number)
+    return values[0] if values else default
+
+
+class PbfBlock(object):
+    """The string table and coordinate / date scales of one PrimitiveBlock"""
+
+    def __init__(self, fields):
+        self.strings = message_fields(first(fields, 1, '')).get(1, [])
+        self.granularity = first(fields, 17, 100)
+        self.lat_offset = int64(first(fields, 19, 0))
+        self.lon_offset = int64(first(fields, 20, 0))
+        self.date_granularity = first(fields, 18, 1000)
+
+    def lat(self, lat):
+        return '%.7f' % (1e-9 * (self.lat_offset + self.granularity * lat))
+
+    def lon(self, lon):
+        return '%.7f' % (1e-9 * (self.lon_offset + self.granularity * lon))
+
+    def timestamp(self, timestamp):
+        return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp * self.date_granularity // 1000))
+
+    def info(self, data, attrib):
+        """Add the attributes of an Info message to attrib"""
+        if data is None:
+            return attrib
+        info = message_fields(data)
+        attrib['version'] = str(int64(first(info, 1, -1)))
+        attrib['timestamp'] = self.timestamp(int64(first(info, 2, 0)))
+        attrib['changeset'] = str(int64(first(info, 3, 0)))
+        attrib['uid'] = str(int64(first(info, 4, 0)))
+        attrib['user'] = self.strings[first(info, 5, 0)]
+        return attrib
+
+    def tags(self, fields):
+        """<tag> children from the keys (field 2) and vals (field 3) of a Node, Way or Relation"""
+        strings = self.strings
+        return [OsmChild('tag', {'k': strings[k], 'v': strings[v]})
+                for k, v in zip(packed(fields, 2), packed(fields, 3))]
+
+    def nodes(self, data):
+        node = message_fields(data)
+        attrib = self.info(first(node, 4), {'id': str(zigzag(first(node, 1))),
+                                            'lat': self.lat(zigzag(first(node, 8))),
+                                            'lon': self.lon(zigzag(first(node, 9)))})
+        return [OsmElement('node', attrib, self.tags(node))]
+
+    def dense_nodes(self, data):
+        dense = message_fields(data)
+        ids = delta_decoded(packed(dense, 1, True))
+        lats = delta_decoded(packed(dense, 8, True))
+        lons = delta_decoded(packed(dense, 9, True))
+        keys_vals = packed(dense, 10)
+        info = message_fields(first(dense, 5, ''))
+        versions = packed(info, 1)
+        timestamps = delta_decoded(packed(info, 2, True))
+        changesets = delta_decoded(packed(info, 3, True))
+        uids = delta_decoded(packed(info, 4, True))
+        user_sids = delta_decoded(packed(info, 5, True))
+        strings = self.strings
+        elements = []
+        j = 0
+        for i, node_id in enumerate(ids):
+            attrib = {'id': str(node_id), 'lat': self.lat(lats[i]), 'lon': self.lon(lons[i])}
+            if versions:
+                attrib['version'] = str(versions[i])
+                attrib['timestamp'] = self.timestamp(timestamps[i])
+                attrib['changeset'] = str(changesets[i])
+                attrib['uid'] = str(uids[i])
+                attrib['user'] = strings[user_sids[i]]
+            children = []
+            # keys_vals holds each node's key, value string ids, then a 0; it is empty when
+            # no node of the block has tags
+            if keys_vals:
+                while keys_vals[j]:
+                    children.append(OsmChild('tag', {'k': strings[keys_vals[j]], 'v': strings[keys_vals[j + 1]]}))
+                    j += 2
+                j += 1
+            elements.append(OsmElement('node', attrib, children))
+        return elements
+
+    def ways(self, data):
+        way = message_fields(data)
+        attrib = self.info(first(way, 4), {'id': str(int64(first(way, 1)))})
+        children = [OsmChild('nd', {'ref': str(ref)}) for ref in delta_decoded(packed(way, 8, True))]
+        return [OsmElement('way', attrib, children + self.tags(way))]
+
+    def relations(self, data):
+        relation = message_fields(data)
+        attrib = self.info(first(relation, 4), {'id': str(int64(first(relation, 1)))})
+        strings = self.strings
+        members = [OsmChild('member', {'type': PBF_MEMBER_TYPES[member_type], 'ref': str(ref), 'role': strings[role]})
+                   for role, ref, member_type in zip(packed(relation, 8), delta_decoded(packed(relation, 9, True)),
+                                                     packed(relation, 10))]
+        return [OsmElement('relation', attrib, members + self.tags(relation))]
+
+
+# PrimitiveGroup field number: (element type, PbfBlock method decoding one such field)
+PBF_GROUP_FIELDS = {1: ('node', PbfBlock.nodes), 2: ('node', PbfBlock.dense_nodes), 3: ('way', PbfBlock.ways),
+                    4: ('relation', PbfBlock.relations)}
+
+
+def read_pbf_blob(osm):
+    """Read the next (blob type, Blob message) of an open pbf file, or None at its end"""
+    size = osm.read(4)
+    if len(size) < 4:
+        return None
+    header = message_fields(osm.read(struct.unpack('>I', size)[0]))
+    return first(header, 1), osm.read(first(header, 3))
+
+
+def pbf_blob_data(blob):
+    """The uncompressed contents of a Blob message"""
+    fields = message_fields(blob)
+    if 1 in fields:
+        return fields[1][0]
+    if 3 in fields:
+        return zlib.decompress(fields[3][0])
+    raise ValueError('only raw and zlib compressed pbf blobs are supported')
+
+
+def check_pbf_header(blob):
+    """Raise ValueError if reading the file needs a feature this decoder does not have"""
+    missing = set(message_fields(pbf_blob_data(blob)).get(4, [])) - PBF_FEATURES
+    if missing:
+        raise ValueError('unsupported pbf features: {0}'.format(', '.join(sorted(missing))))
+
+
+def decode_pbf_blob(blob, tags):
+    """OsmElements of the types in tags from one OSMData blob, in file order"""
+    fields = message_fields(pbf_blob_data(blob))
+    block = PbfBlock(fields)
+    elements = []
+    for group in fields.get(2, ()):
+        for number, values in sorted(message_fields(group).iteritems()):
+            if number in PBF_GROUP_FIELDS and PBF_GROUP_FIELDS[number][0] in tags:
+                decode = PBF_GROUP_FIELDS[number][1]
+                for value in values:
+                    elements.extend(decode(block, value))
+    return elements
+
+
+def pbf_blob_offsets(file_in, offset=0, end=None):
+    """Yield (offset, blob type) of every blob from offset (a blob start) to end, reading only the headers"""
+    with open(file_in, 'rb') as osm:
+        end = os.fstat(osm.fileno()).st_size if end is None else end
+        while offset < end:
+            osm.seek(offset)
+            size = osm.read(4)
+            if len(size) < 4:
+                return
+            header_size = struct.unpack('>I', size)[0]
+            header = message_fields(osm.read(header_size))
+            yield offset, first(header, 1)
+            offset += 4 + header_size + first(header, 3)
+
+
+def pbf_shards(file_in, count, offset=0, end=None):
+    """Split the blobs of a pbf file from offset to end into at most count (start, end) byte ranges"""
+    offsets = [blob_offset for blob_offset, _ in pbf_blob_offsets(file_in, offset, end)]
+    if not offsets:
+        return []
+    end = os.path.getsize(file_in) if end is None else end
+    step = max(1, (end - offsets[0]) // count)
+    starts = [offsets[0]]
+    for blob_offset in offsets[1:]:
+        if blob_offset - starts[-1] >= step and len(starts) < count:
+            starts.append(blob_offset)
+    return zip(starts, starts[1:] + [end])
+
+
+def pbf_way_start(file_in, offset=0):
+    """Offset of the first blob at or after offset holding ways or relations, or None"""
+    with open(file_in, 'rb') as osm:
+        for blob_offset, blob_type in pbf_blob_offsets(file_in, offset):
+            if blob_type != 'OSMData':
+                continue
+            osm.seek(blob_offset)
+            _, blob = read_pbf_blob(osm)
+            for group in message_fields(pbf_blob_data(blob)).get(2, ()):
+                if set(message_fields(group)) & set([3, 4]):
+                    return blob_offset
+    return None
+
+
+class PbfReader(object):
+    """The elements of the blobs of a .osm.pbf file from start (a blob start) to end.
+
+    As for a ShardReader, safe_offset is where the blob of the last element handed out starts
+    and tell() how far the file has been read. process_map_parallel decodes the blobs in
+    parallel by giving each worker a PbfReader over its own range of blobs.
+    """
+
+    def __init__(self, file_in, start=0, end=None):
+        self.osm = open(file_in, 'rb')
+        self.end = os.fstat(self.osm.fileno()).st_size if end is None else end
+        self.osm.seek(start)
+        self.position = self.safe_offset = start
+
+    def blobs(self):
+        """Yield (offset, blob) of every OSMData blob, checking the header blob on the way"""
+        while self.position < self.end:
+            offset = self.position
+            blob = read_pbf_blob(self.osm)
+            if blob is None:
+                return
+            self.position = self.osm.tell()
+            blob_type, data = blob
+            if blob_type == 'OSMHeader':
+                check_pbf_header(data)
+            elif blob_type == 'OSMData':
+                yield offset, data
+
+    def elements(self, tags=('node', 'way', 'relation'), keep=None):
+        """Yield the OsmElements of the types in tags that keep (if given) returns True for"""
+        for offset, blob in self.blobs():
+            self.safe_offset = offset
+            for element in decode_pbf_blob(blob, tags):
+                if keep is None or keep(element):
+                    yield element
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.osm.close()
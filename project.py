@@ -6,20 +6,61 @@
 # Explaination at the bottom
 
 import csv
+import argparse
+import array
+import bisect
 import codecs
+import contextlib
+import cStringIO
+import importlib
+import json
+import math
+import os
 import pprint
+import Queue
 import re
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import multiprocessing
 import xml.etree.cElementTree as ET
 import sqlite3
-import cerberus
+from collections import Mapping, Sequence, namedtuple
+import osm_input
+import reports
+import road_graph
 import schema
 
+# lxml parses noticeably faster than cElementTree; it is used by get_element when installed.
+try:
+    from lxml import etree as LXML_ET
+except ImportError:
+    LXML_ET = None
+
+# pyarrow is only needed for the columnar (parquet/arrow) export
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
 OSM_PATH = "bengaluru_india.osm"
+DB_PATH = "bengaluru_map.db"
+GRAPH_PATH = "bengaluru_roads.graph"
 NODES_PATH = "bangalore/node.csv"
 NODE_TAGS_PATH = "bangalore/node_tags.csv"
 WAYS_PATH = "bangalore/way.csv"
 WAY_NODES_PATH = "bangalore/way_nodes.csv"
 WAY_TAGS_PATH = "bangalore/way_tags.csv"
+CSV_PATHS = (NODES_PATH, NODE_TAGS_PATH, WAYS_PATH, WAY_NODES_PATH, WAY_TAGS_PATH)
+
+# Number of processes used to shape the OSM file. 1 runs everything in this process.
+WORKERS = multiprocessing.cpu_count()
+# Target size of each byte range handed to a worker. Smaller shards keep the workers evenly loaded.
+SHARD_SIZE = 32 * 1024 * 1024
 
 # VALIDATION PROCESS
 
@@ -33,190 +74,526 @@ NODE_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
 WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_NODES_FIELDS = ['id', 'node_id', 'position']
+# Table name and columns of each csv, in the order of CSV_PATHS
+TABLES = (('node', NODE_FIELDS), ('node_tags', NODE_TAGS_FIELDS), ('way', WAY_FIELDS),
+          ('way_nodes', WAY_NODES_FIELDS), ('way_tags', WAY_TAGS_FIELDS))
 
 # Fixing street names
-def value_fixer(value):
+# The rules are compiled once here instead of on every call. The order and the exact patterns
+# are those of the original value_fixer, quirks included, so the cleaned values do not change.
+#     Any value without one of these (case-insensitive) is returned untouched.
+STREET_WORDS = re.compile('road|cross|main| rd|mn|crs', re.IGNORECASE)
 #     Make all upper/lower case of 'road|cross|main' to Road
-    re_road = re.compile(re.escape('road'), re.IGNORECASE)
-    re_main = re.compile(re.escape('main'), re.IGNORECASE)
-    re_cross = re.compile(re.escape('cross'), re.IGNORECASE)
-    if re.search('road', value, re.IGNORECASE):
-        value = re_road.sub('Road',value)
-    if re.search('cross', value, re.IGNORECASE):
-        value = re_road.sub('Cross',value)
-    if re.search('main', value, re.IGNORECASE):
-        value = re_road.sub('Main',value)
-
-#     Fix Rd or Rd. to Road
-#     Added a space so as to avoid considering 'rd' as a part of '3rd' and only taking abc rd.
-    re_rd_period = re.compile(re.escape(' rd\.'), re.IGNORECASE)
-    re_rd = re.compile(re.escape(' rd'), re.IGNORECASE)
-    if re.search(' rd\.', value, re.IGNORECASE):
-        value = re_rd_period.sub(' Road', value)
-    elif re.search(' rd', value, re.IGNORECASE):
-        value = re_rd.sub(' Road', value)
+RE_ROAD = re.compile(re.escape('road'), re.IGNORECASE)
+RE_CROSS = re.compile('cross', re.IGNORECASE)
+RE_MAIN = re.compile('main', re.IGNORECASE)
+#     Fix Rd or Rd. to Road. The period replacement has always matched a literal ' rd\.'.
+RE_RD_PERIOD_SEARCH = re.compile(' rd\.', re.IGNORECASE)
+RE_RD_PERIOD = re.compile(re.escape(' rd\.'), re.IGNORECASE)
+RE_RD = re.compile(re.escape(' rd'), re.IGNORECASE)
+#     Fix mn or mn. to Main
+RE_NTH_MN_PERIOD = re.compile('(?:th|st|nd|rd) mn\.', re.IGNORECASE)
+RE_NTH_MN = re.compile('(?:th|st|nd|rd) mn', re.IGNORECASE)
+RE_MN_PERIOD = re.compile(re.escape('mn.'), re.IGNORECASE)
+RE_MN = re.compile(re.escape('mn'), re.IGNORECASE)
+#     Fix crs or Crs. or cros to Cross
+RE_NTH_CRS_PERIOD = re.compile('(?:th|st|nd|rd) crs\.', re.IGNORECASE)
+RE_NTH_CRS = re.compile('(?:th|st|nd|rd) crs', re.IGNORECASE)
+RE_CROS = re.compile('cros', re.IGNORECASE)
+RE_CRS_PERIOD = re.compile(re.escape('crs.'), re.IGNORECASE)
+RE_CRS = re.compile(re.escape('crs'), re.IGNORECASE)
 
+# Names like '100 Feet Road' repeat thousands of times, so cleaned values are memoized.
+VALUE_CACHE = {}
+VALUE_CACHE_SIZE = 100000
+
+
+def value_fixer(value):
+    """Return the cleaned street name for value, memoized on the raw value"""
+    try:
+        return VALUE_CACHE[value]
+    except KeyError:
+        pass
+    if len(VALUE_CACHE) >= VALUE_CACHE_SIZE:
+        VALUE_CACHE.clear()
+    fixed = VALUE_CACHE[value] = fix_street_name(value)
+    return fixed
+
+
+def fix_street_name(value):
+    """Normalize road/main/cross and their abbreviations in value"""
+    if not STREET_WORDS.search(value):
+        return value
+
+#     'road' is rewritten once: to Cross if the value mentions cross, else to Main if it
+#     mentions main, else to Road (the three separate passes of the original reduce to this).
+    if RE_CROSS.search(value):
+        value = RE_ROAD.sub('Cross', value)
+    elif RE_MAIN.search(value):
+        value = RE_ROAD.sub('Main', value)
+    else:
+        value = RE_ROAD.sub('Road', value)
+
+#     Added a space so as to avoid considering 'rd' as a part of '3rd' and only taking abc rd.
+    if RE_RD_PERIOD_SEARCH.search(value):
+        value = RE_RD_PERIOD.sub(' Road', value)
+    else:
+        value = RE_RD.sub(' Road', value)
 
-#     Fix mn or mn. to Main
-    re_mn_period = re.compile(re.escape('mn.'), re.IGNORECASE)
-    re_mn = re.compile(re.escape('mn'), re.IGNORECASE)
     if 'Main' not in value:
-        if re.search('th mn\.', value, re.IGNORECASE) or re.search('st mn\.', value, re.IGNORECASE) or re.search('nd mn\.', value, re.IGNORECASE) or re.search('rd mn\.', value, re.IGNORECASE):
-            value = re_mn_period.sub('Main', value)
-        elif re.search('th mn', value, re.IGNORECASE) or re.search('st mn', value, re.IGNORECASE) or re.search('nd mn', value, re.IGNORECASE) or re.search('rd mn', value, re.IGNORECASE):
-            value = re_mn.sub('Main', value)
+        if RE_NTH_MN_PERIOD.search(value):
+            value = RE_MN_PERIOD.sub('Main', value)
+        elif RE_NTH_MN.search(value):
+            value = RE_MN.sub('Main', value)
     if 'Main Road' not in value:
-        value = value.replace('Main','Main Road')
+        value = value.replace('Main', 'Main Road')
 
-#     Fix crs or Crs. or cros to Cross
-    re_crs_period = re.compile(re.escape('crs.'), re.IGNORECASE)
-    re_crs = re.compile(re.escape('crs'), re.IGNORECASE)
-    re_cros = re.compile(re.escape('cros'), re.IGNORECASE)
     if 'Cross' not in value:
-        if re.search('th crs\.', value, re.IGNORECASE) or re.search('st crs\.', value, re.IGNORECASE) or re.search('nd crs\.', value, re.IGNORECASE) or re.search('rd crs\.', value, re.IGNORECASE):
-            value = re_crs_period.sub('Cross', value)
-        elif re.search('th crs', value, re.IGNORECASE) or re.search('st crs', value, re.IGNORECASE) or re.search('nd crs', value, re.IGNORECASE) or re.search('rd crs', value, re.IGNORECASE):
-            value = re_crs.sub('Cross', value)
-        elif re.search('cros', value, re.IGNORECASE):
-            value = re_crs.sub('Cross', value)
+        if RE_NTH_CRS_PERIOD.search(value):
+            value = RE_CRS_PERIOD.sub('Cross', value)
+        elif RE_NTH_CRS.search(value) or RE_CROS.search(value):
+            value = RE_CRS.sub('Cross', value)
     if 'Cross Road' not in value:
-        value = value.replace('Cross','Cross Road')
+        value = value.replace('Cross', 'Cross Road')
 
 #     Remove everything after 'Road'. I.e. Removing area name for roads. Like 4th Main Road, Banashankri should become 4th Main Road.
     if 'Road' in value:
-        value=value[0:value.index('Road')+4]
+        value = value[0:value.index('Road')+4]
     return value
 
 
 # Fixing Key values that are not so good
 
-def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS,
-                  problem_chars=PROBLEMCHARS, default_tag_type='regular'):
-    """Clean and shape node or way XML element to Python dict"""
-
-    node_attribs = {}
-    way_attribs = {}
-    way_nodes = []
-    tags = []  # Handle secondary tags the same way for both node and way elements
-
-    # YOUR CODE HERE
-    count = 0
-    count2 = 0
-    if element.tag == 'node':
-        node_attribs= {
-            'id': int(element.attrib['id']),
-            'user': element.attrib['user'].encode('utf-8').strip(),
-            'uid': int(element.attrib['uid']),
-            'version': element.attrib['version'].encode('utf-8').strip(),
-            'lat': float(element.attrib['lat']),
-            'lon': float(element.attrib['lon']),
-            'timestamp': element.attrib['timestamp'].encode('utf-8').strip(),
-            'changeset': int(element.attrib['changeset']),
-        }
-        for t in element:
-            if t.tag=='tag':
-#                 Pt. 1 and 2 of 'Key values that are not so good'
-                if t.attrib['k'] is not 'created_by':
-                    t.attrib['v'].replace('_',' ')
-#                 We don't want to make name as :kn and type as 'name', so we make an alternative condition.
-                if ':kn' not in t.attrib['k']:
-                    if ':' in t.attrib['k']:
-                        type = t.attrib['k'][0:t.attrib['k'].index(':')]
-                        key = t.attrib['k'][t.attrib['k'].index(':')+1:]
-                    else:
-                        type = 'regular'
-                        key = t.attrib['k']
-                    value = value_fixer(t.attrib['v'].encode('utf-8').strip())
-                    tags.append({
-                        'id':int(element.attrib['id']),
-                        'key': key.encode('utf-8').strip(),
-                        'value': value,
-                        'type': type.encode('utf-8').strip()
-                        })
-                else:
-                    if ':' in t.attrib['k'][:t.attrib['k'].index(':kn')]:
-                        type = t.attrib['k'][0:t.attrib['k'].index(':')]
-                        key = t.attrib['k'][t.attrib['k'].index(':')+1:]
+# shape_element returns these records instead of dicts. Their fields are in csv column order,
+# so the writers pass them to csv.writer as they are.
+Node = namedtuple('Node', NODE_FIELDS)
+Tag = namedtuple('Tag', NODE_TAGS_FIELDS)
+Way = namedtuple('Way', WAY_FIELDS)
+WayNode = namedtuple('WayNode', WAY_NODES_FIELDS)
+ShapedNode = namedtuple('ShapedNode', ['node', 'node_tags'])
+ShapedWay = namedtuple('ShapedWay', ['way', 'way_nodes', 'way_tags'])
+
+# Elements shaped together by shape_into, so their tags are processed as one batch
+SHAPE_BATCH_SIZE = 1000
+# There are only a few thousand distinct tag keys, so their (key, type) split is memoized.
+KEY_CACHE = {}
+KEY_CACHE_SIZE = 100000
+
+
+def utf8(value):
+    """Encode unicode to utf-8; plain ascii str is returned as is rather than re-encoded"""
+    return value.encode('utf-8') if isinstance(value, unicode) else value
+
+
+def split_key(k):
+    """Return the (key, type) of a raw tag key, memoized, as interned utf-8 strings.
+
+    'addr:street' is key 'street' of type 'addr'. Keys without a ':' are of type 'regular',
+    and so are keys whose first ':' starts a ':kn' suffix: a tag in kannada, like 'name:kn',
+    keeps its whole key rather than becoming key 'kn' of type 'name'.
+    """
+    try:
+        return KEY_CACHE[k]
+    except KeyError:
+        pass
+    if len(KEY_CACHE) >= KEY_CACHE_SIZE:
+        KEY_CACHE.clear()
+    i = k.find(':')
+    if i == -1 or k.startswith(':kn', i):
+        key, type_ = k, 'regular'
+    else:
+        key, type_ = k[i + 1:], k[:i]
+    split = KEY_CACHE[k] = (intern(utf8(key).strip()), intern(utf8(type_).strip()))
+    return split
+
+
+# Cleaning rules
+# Each rule names a cleaner, a function from a utf-8 value to its cleaned value, and the raw tag
+# keys it applies to ('*' for every key, less exclude_keys). A value is only passed to the
+# rules of its key, in rule order, and is stripped before the first and after each one.
+# Rules are given as dicts, so they can also be loaded from a json file (see load_rules);
+# 'cleaner' is the name of one of CLEANERS or the dotted path of any importable function.
+
+
+def replace_underscores(value):
+    """'traffic_signals' becomes 'traffic signals'"""
+    return value.replace('_', ' ')
+
+
+CLEANERS = {
+    'replace_underscores': replace_underscores,
+    'value_fixer': value_fixer,
+}
+
+# Keys whose values hold street names
+STREET_KEYS = ['addr:street', 'addr:full', 'addr:place', 'addr:housename', 'name', 'name:en',
+               'alt_name', 'old_name', 'official_name', 'short_name', 'loc_name']
+
+# Keys whose values are words from a fixed vocabulary, like 'traffic_signals' or 'bus_stop'.
+# Free text values (urls, emails, wikipedia titles, file names, created_by, ...) can hold
+# underscores that matter, so replace_underscores leaves them alone.
+ENUM_KEYS = ['amenity', 'highway', 'shop', 'tourism', 'leisure', 'building', 'landuse', 'natural', 'railway',
+             'public_transport', 'office', 'man_made', 'power', 'barrier', 'waterway', 'craft', 'emergency',
+             'historic', 'healthcare', 'cuisine', 'surface', 'sport', 'religion', 'denomination', 'service',
+             'crossing', 'parking', 'route', 'place', 'boundary', 'building:use']
+
+DEFAULT_RULES = [
+#     Pt. 1 and 2 of 'Key values that are not so good'
+    {'name': 'underscores', 'cleaner': 'replace_underscores', 'keys': ENUM_KEYS},
+    {'name': 'street_names', 'cleaner': 'value_fixer', 'keys': STREET_KEYS},
+]
+
+
+class CleaningRule(object):
+    """A cleaner, the keys it applies to and how often it changed (hits) or kept (misses) a value"""
+
+    def __init__(self, name, cleaner, keys='*', exclude_keys=()):
+        self.name = name
+        if callable(cleaner):
+            self.clean = cleaner
+        elif cleaner in CLEANERS:
+            self.clean = CLEANERS[cleaner]
+        else:
+            module_name, _, function_name = cleaner.rpartition('.')
+            if not module_name:
+                raise ValueError('unknown cleaner {0!r}'.format(cleaner))
+            self.clean = getattr(importlib.import_module(module_name), function_name)
+        self.keys = None if keys == '*' else frozenset(keys)
+        self.exclude_keys = frozenset(exclude_keys)
+        self.hits = self.misses = 0
+        self.seconds = 0.0
+
+    def applies_to(self, k):
+        return (self.keys is None or k in self.keys) and k not in self.exclude_keys
+
+
+class RuleEngine(object):
+    """Apply cleaning rules to the tag values of a batch, each only to the keys it applies to"""
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.dispatch = {}
+
+    @classmethod
+    def from_config(cls, config):
+        return cls([CleaningRule(**rule) for rule in config])
+
+    def rules_for(self, k):
+        """The rules for raw tag key k, in order; memoized per key"""
+        try:
+            return self.dispatch[k]
+        except KeyError:
+            pass
+        if len(self.dispatch) >= KEY_CACHE_SIZE:
+            self.dispatch.clear()
+        rules = self.dispatch[k] = tuple(rule for rule in self.rules if rule.applies_to(k))
+        return rules
+
+    def clean(self, keys, values):
+        """Return the cleaned values of the tags with these raw keys and values.
+
+        Every distinct (rules, value) of the batch is cleaned once, rule by rule; hits and
+        misses count every tag.
+        """
+        dispatch = self.dispatch
+        rule_sets = [dispatch[k] if k in dispatch else self.rules_for(k) for k in keys]
+        unique = {}
+        for item in zip(rule_sets, values):
+            unique[item] = unique.get(item, 0) + 1
+        items = list(unique)
+        cleaned = [utf8(v).strip() for _, v in items]
+        for rule in self.rules:
+            start = time.time()
+            clean = rule.clean
+            for i, (rules, _) in enumerate(items):
+                if rule in rules:
+                    value = cleaned[i]
+                    fixed = clean(value).strip()
+                    if fixed != value:
+                        cleaned[i] = fixed
+                        rule.hits += unique[items[i]]
                     else:
-                        type = 'regular'
-                        key = t.attrib['k']
-                    value = value_fixer(t.attrib['v'].encode('utf-8').strip())
-                    tags.append({
-                        'id':int(element.attrib['id']),
-                        'key': key.encode('utf-8').strip(),
-                        'value': value,
-                        'type': type.encode('utf-8').strip()
-                        })
-        result = {'node': node_attribs, 'node_tags': tags}
-        return {'node': node_attribs, 'node_tags': tags}
-    elif element.tag == 'way':
-        way_attribs= {
-            'id': int(element.attrib['id']),
-            'user': element.attrib['user'].encode('utf-8').strip(),
-            'uid': int(element.attrib['uid']),
-            'version': element.attrib['version'].encode('utf-8').strip(),
-            'timestamp': str(element.attrib['timestamp']),
-            'changeset': int(element.attrib['changeset']),
-        }
-        n=0
+                        rule.misses += unique[items[i]]
+            rule.seconds += time.time() - start
+        fixed = dict(zip(items, cleaned))
+        return [fixed[item] for item in zip(rule_sets, values)]
+
+    def stats(self):
+        """[(rule name, hits, misses, seconds)]"""
+        return [(rule.name, rule.hits, rule.misses, rule.seconds) for rule in self.rules]
+
+    def reset(self):
+        for rule in self.rules:
+            rule.hits = rule.misses = 0
+            rule.seconds = 0.0
+
+    def merge(self, stats):
+        """Add the stats() of another engine with the same rules, e.g. a worker's"""
+        for rule, (_, hits, misses, seconds) in zip(self.rules, stats):
+            rule.hits += hits
+            rule.misses += misses
+            rule.seconds += seconds
+
+    def report(self):
+        for name, hits, misses, seconds in self.stats():
+            print "{0}: {1} hits, {2} misses, {3:.2f}s".format(name, hits, misses, seconds)
+
+
+def load_rules(path):
+    """Load a RuleEngine from a json list of rules like DEFAULT_RULES"""
+    with open(path) as f:
+        return RuleEngine.from_config(json.load(f))
+
+
+# The rules shape_tags cleans values with
+CLEANING = RuleEngine.from_config(DEFAULT_RULES)
+
+
+def shape_tags(elements):
+    """Return the Tag records of each of elements, as one list per element.
+
+    The tags of the whole batch are gathered first, then every distinct key is split and
+    the values are cleaned by CLEANING as one batch.
+    """
+    ids, keys, values, counts = [], [], [], []
+    for element in elements:
+        element_id = int(element.attrib['id'])
+        count = 0
         for t in element:
-            if t.tag=='tag':
-#                 Pt. 1 and 2 of 'Key values that are not so good'
-                if t.attrib['k'] is not 'created_by':
-                    t.attrib['v'].replace('_',' ')
-                if ':kn' not in t.attrib['k']:
-                    if ':' in t.attrib['k']:
-                        type = t.attrib['k'][0:t.attrib['k'].index(':')]
-                        key = t.attrib['k'][t.attrib['k'].index(':')+1:]
-                    else:
-                        type = 'regular'
-                        key = t.attrib['k']
-                    value = value_fixer(t.attrib['v'].encode('utf-8').strip())
-                    tags.append({
-                        'id':int(element.attrib['id']),
-                        'key': key.encode('utf-8').strip(),
-                        'value': value,
-                        'type': type.encode('utf-8').strip()
-                        })
-                else:
-#                     If tag is of local language kannada, then :kn must not be in the key. 
-                    if ':' in t.attrib['k'][:t.attrib['k'].index(':kn')]:
-                        type = t.attrib['k'][0:t.attrib['k'].index(':')]
-                        key = t.attrib['k'][t.attrib['k'].index(':')+1:]
-                    else:
-                        type = 'regular'
-                        key = t.attrib['k']
-                    value = value_fixer(t.attrib['v'].encode('utf-8').strip())
-                    tags.append({
-                        'id':int(element.attrib['id']),
-                        'key': key.encode('utf-8').strip(),
-                        'value': value,
-                        'type': type.encode('utf-8').strip()
-                        })
-            elif t.tag=='nd':
-                way_nodes.append({
-                    'id': element.attrib['id'],
-                    'node_id': t.attrib['ref'],
-                    'position': n
-                })
-                n += 1
-                
-        result = {'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags}
-        return {'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags}
+            if t.tag == 'tag':
+                keys.append(t.attrib['k'])
+                values.append(t.attrib['v'])
+                count += 1
+        ids.extend([element_id] * count)
+        counts.append(count)
+
+    splits = [split_key(k) for k in keys]
+    cleaned = CLEANING.clean(keys, values)
+    tags = [Tag(element_id, key, value, type_) for element_id, (key, type_), value in zip(ids, splits, cleaned)]
+
+    shaped, start = [], 0
+    for count in counts:
+        shaped.append(tags[start:start + count])
+        start += count
+    return shaped
+
+
+def shape_elements(elements):
+    """Clean and shape a batch of node and way XML elements to ShapedNode and ShapedWay records"""
+    shaped = []
+    for element, tags in zip(elements, shape_tags(elements)):
+        attrib = element.attrib
+        element_id = int(attrib['id'])
+        if element.tag == 'node':
+            shaped.append(ShapedNode(Node(
+                id=element_id,
+                lat=float(attrib['lat']),
+                lon=float(attrib['lon']),
+                user=utf8(attrib['user']).strip(),
+                uid=int(attrib['uid']),
+                version=utf8(attrib['version']).strip(),
+                changeset=int(attrib['changeset']),
+                timestamp=utf8(attrib['timestamp']).strip(),
+            ), tags))
+        elif element.tag == 'way':
+            refs = [t.attrib['ref'] for t in element if t.tag == 'nd']
+            shaped.append(ShapedWay(Way(
+                id=element_id,
+                user=utf8(attrib['user']).strip(),
+                uid=int(attrib['uid']),
+                version=utf8(attrib['version']).strip(),
+                changeset=int(attrib['changeset']),
+                timestamp=str(attrib['timestamp']),
+            ), [WayNode(attrib['id'], ref, n) for n, ref in enumerate(refs)], tags))
+        else:
+            shaped.append(None)
+    return shaped
+
+
+def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS,
+                  problem_chars=PROBLEMCHARS, default_tag_type='regular'):
+    """Clean and shape node or way XML element to a ShapedNode or ShapedWay record"""
+    return shape_elements([element])[0]
 
 # USED CODE FROM THE FINAL CHAPTER OF THE DATA WRANGLING COURSE
 # ================================================== #
 #               Helper Functions                     #
 # ================================================== #
-def get_element(osm_file, tags=('node', 'way', 'relation')):
-    """Yield element if it is the right type of tag"""
-
-    context = ET.iterparse(osm_file, events=('start', 'end'))
+def detach(elem):
+    """Copy a parsed element into an OsmElement that outlives clearing the tree"""
+    return osm_input.OsmElement(elem.tag, dict(elem.attrib),
+                                [osm_input.OsmChild(child.tag, dict(child.attrib)) for child in elem])
+
+
+def get_element(osm_file, tags=('node', 'way', 'relation'), use_lxml=None, keep=None):
+    """Yield an OsmElement for each top level element of the right type of tag.
+
+    Every top level element, yielded or skipped, is copied out and cleared from the tree as
+    soon as it ends, so memory stays constant however large the file is. lxml is used when
+    installed unless use_lxml is False. keep, e.g. an ElementFilter, is called with each
+    parsed element of the right type; the ones it returns False for are never copied out.
+
+    osm_file is an xml file or file-like object, a PbfReader, or the path of a .osm, .osm.pbf,
+    .osm.bz2 or .osm.gz file, see osm_input.
+    """
+    if isinstance(osm_file, osm_input.PbfReader):
+        for element in osm_file.elements(tags, keep):
+            yield element
+        return
+    if isinstance(osm_file, basestring) and osm_input.osm_format(osm_file) != 'xml':
+        reader = osm_input.open_osm(osm_file)
+        try:
+            for element in get_element(reader, tags, use_lxml, keep):
+                yield element
+        finally:
+            reader.close()
+        return
+    if use_lxml is None:
+        use_lxml = LXML_ET is not None
+    iterparse = LXML_ET.iterparse if use_lxml else ET.iterparse
+
+    context = iterparse(osm_file, events=('start', 'end'))
     _, root = next(context)
+    depth = 1
     for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        if depth != 1:
+            continue
+        record = detach(elem) if elem.tag in tags and (keep is None or keep(elem)) else None
+        root.clear()
+        if record is not None:
+            yield record
+
+
+# ================================================== #
+#               Filtered Extraction                  #
+# ================================================== #
+# Extracts of one district or of only some kinds of features are filtered while parsing, so
+# the dropped elements are never copied out of the tree, shaped or written.
+
+class NodeIdSet(object):
+    """Compact set of node ids: a sorted array of 8 byte ints searched with bisect.
+
+    OSM files list nodes in id order, so add() normally just appends; ids that arrive out of
+    order are sorted in on the next lookup. (Python 2 arrays have no 'q' type code; 'l' is
+    8 bytes on 64 bit Linux and macOS.)
+    """
+
+    def __init__(self, ids=()):
+        self.ids = array.array('l', ids)
+        self.is_sorted = all(a < b for a, b in zip(self.ids, self.ids[1:]))
+
+    def add(self, node_id):
+        ids = self.ids
+        if ids and node_id <= ids[-1]:
+            self.is_sorted = False
+        ids.append(node_id)
+
+    def update(self, other):
+        if other.ids and self.ids and other.ids[0] <= self.ids[-1]:
+            self.is_sorted = False
+        self.ids.extend(other.ids)
+        self.is_sorted = self.is_sorted and other.is_sorted
+
+    def __contains__(self, node_id):
+        if not self.is_sorted:
+            self.ids = array.array('l', sorted(set(self.ids)))
+            self.is_sorted = True
+        ids = self.ids
+        i = bisect.bisect_left(ids, node_id)
+        return i < len(ids) and ids[i] == node_id
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class ElementFilter(object):
+    """Decide from a parsed element, before it is shaped, whether an extract keeps it.
+
+    bbox is (min_lat, min_lon, max_lat, max_lon): nodes outside it are dropped, and so are
+    ways that do not reference a single kept node. The ids of the kept nodes are gathered in
+    a NodeIdSet as the nodes go by, which is why nodes must be filtered before ways.
+    include_keys keeps only elements with at least one of these tag keys and exclude_keys
+    drops elements with any of them. Keys are matched as written in the file, e.g.
+    'addr:street'. The nodes of the kept ways are kept whatever their tags (as long as they
+    are inside the bbox), so a highway extract still has the untagged nodes of its ways. As
+    those come before the ways in the file, scan() must first find them in a pass of its own.
+    """
+
+    def __init__(self, bbox=None, include_keys=None, exclude_keys=None):
+        self.bbox = tuple(float(x) for x in bbox) if bbox is not None else None
+        self.include_keys = frozenset(include_keys) if include_keys else None
+        self.exclude_keys = frozenset(exclude_keys) if exclude_keys else None
+        self.node_ids = NodeIdSet()
+        # ids of the nodes referenced by the kept ways, found by scan()
+        self.way_node_ids = None
+
+    @property
+    def filters_keys(self):
+        return self.include_keys is not None or self.exclude_keys is not None
+
+    def scan(self, osm_file):
+        """Find the nodes of the ways this filter keeps, before filtering osm_file with it.
+
+        Only needed with include_keys or exclude_keys. Nothing is copied out of the tree in
+        this pass, so it costs little more than the parse itself.
+        """
+        inside = NodeIdSet()
+        way_node_ids = NodeIdSet()
+
+        def collect(elem):
+            if elem.tag == 'node':
+                if self.bbox is not None and self.in_bbox(elem):
+                    inside.add(int(elem.attrib['id']))
+            elif self.keys_match(elem) and (self.bbox is None or self.references(elem, inside)):
+                for child in elem:
+                    if child.tag == 'nd':
+                        way_node_ids.add(int(child.attrib['ref']))
+            return False
+
+        for _ in get_element(osm_file, tags=('node', 'way'), keep=collect):
+            pass
+        self.way_node_ids = way_node_ids
+
+    def __call__(self, elem):
+        if elem.tag == 'node':
+            if self.bbox is not None and not self.in_bbox(elem):
+                return False
+            if not self.keys_match(elem):
+                way_node_ids = self.way_node_ids
+                if way_node_ids is None or int(elem.attrib['id']) not in way_node_ids:
+                    return False
+            if self.bbox is not None:
+                self.node_ids.add(int(elem.attrib['id']))
+            return True
+        if not self.keys_match(elem):
+            return False
+        return self.bbox is None or self.references(elem, self.node_ids)
+
+    def in_bbox(self, elem):
+        min_lat, min_lon, max_lat, max_lon = self.bbox
+        attrib = elem.attrib
+        return min_lat <= float(attrib['lat']) <= max_lat and min_lon <= float(attrib['lon']) <= max_lon
+
+    @staticmethod
+    def references(way, node_ids):
+        """True if way has a node in node_ids"""
+        for child in way:
+            if child.tag == 'nd' and int(child.attrib['ref']) in node_ids:
+                return True
+        return False
+
+    def keys_match(self, elem):
+        """Apply include_keys and exclude_keys to the tag keys of elem"""
+        if self.include_keys is None and self.exclude_keys is None:
+            return True
+        keys = [child.attrib['k'] for child in elem if child.tag == 'tag']
+        if self.exclude_keys is not None and not self.exclude_keys.isdisjoint(keys):
+            return False
+        return self.include_keys is None or not self.include_keys.isdisjoint(keys)
 
 # USED CODE FROM THE FINAL CHAPTER OF THE DATA WRANGLING COURSE
 # ================================================== #
@@ -224,295 +601,2343 @@ def get_element(osm_file, tags=('node', 'way', 'relation')):
 # ================================================== #
 def validate_element(element, validator, schema=SCHEMA):
     """Raise ValidationError if element does not match schema"""
-    if validator.validate(element, schema) is not True:
+    if isinstance(validator, CompiledValidator):
+        valid = validator.validate(element)
+    else:
+        valid = validator.validate(as_dict(element), schema)
+    if valid is not True:
         field, errors = next(validator.errors.iteritems())
         message_string = "\nElement of type '{0}' has the following errors:\n{1}"
         error_string = pprint.pformat(errors)
         raise Exception(message_string.format(field, error_string))
 
-# USED CODE FROM THE FINAL CHAPTER OF THE DATA WRANGLING COURSE
 
 # ================================================== #
-#               Helper Functions                     #
+#               Compiled Validation                  #
 # ================================================== #
-class UnicodeDictWriter(csv.DictWriter, object):
-    """Extend csv.DictWriter to handle Unicode input"""
+# cerberus walks the nested schema rule by rule for every element. CompiledValidator turns
+# schema.py into one closure per field once, with a fast path for values that already have
+# the right type, and fills .errors with exactly what cerberus.Validator would report.
+# Only the rules schema.py uses are supported: type, required, coerce, nullable and schema.
+
+MISSING = object()
+
+# cerberus messages, in the order cerberus sorts them (by error code)
+REQUIRED_FIELD = 'required field'
+UNKNOWN_FIELD = 'unknown field'
+NOT_NULLABLE = 'null value not allowed'
+BAD_TYPE = 'must be of {0} type'
+COERCION_FAILED = "field '{0}' cannot be coerced: {1}"
+
+SUPPORTED_RULES = frozenset(['type', 'required', 'coerce', 'nullable', 'schema'])
+
+
+def is_record(value):
+    return isinstance(value, tuple) and hasattr(value, '_fields')
+
+
+# The same type definitions as cerberus; shaped records count as dicts
+TYPE_CHECKS = {
+    'integer': lambda value: isinstance(value, (int, long)),
+    'float': lambda value: isinstance(value, (float, int, long)),
+    'string': lambda value: isinstance(value, basestring),
+    'dict': lambda value: is_record(value) or isinstance(value, Mapping),
+    'list': lambda value: type(value) is list or (isinstance(value, Sequence) and not isinstance(value, basestring)),
+}
+# Exact types that always pass a field's type (and coercion) without further checks
+FAST_TYPES = {
+    'integer': (int, long),
+    'float': (float,),
+    'string': (str, unicode),
+}
+
+
+def compile_field(name, rules):
+    """Return check(value) for one field: None if value is valid, else its cerberus error list"""
+    unsupported = set(rules) - SUPPORTED_RULES
+    if unsupported:
+        raise ValueError("field '{0}' uses unsupported rules {1}".format(name, sorted(unsupported)))
+    type_name = rules.get('type')
+    if type_name not in TYPE_CHECKS:
+        raise ValueError("field '{0}' has unsupported type {1!r}".format(name, type_name))
+    type_check = TYPE_CHECKS[type_name]
+    type_error = BAD_TYPE.format(type_name)
+    nullable = rules.get('nullable', False)
+    coerce = rules.get('coerce')
+
+    if type_name == 'dict' and 'schema' in rules:
+        check_mapping = compile_mapping(rules['schema'])
+
+        def check(value):
+            if value is None:
+                return None if nullable else [NOT_NULLABLE]
+            if not type_check(value):
+                return [type_error]
+            errors = check_mapping(value)
+            return [errors] if errors else None
+        return check
+
+    if type_name == 'list' and 'schema' in rules:
+        check_item = compile_field('item', rules['schema'])
+
+        def check(value):
+            if value is None:
+                return None if nullable else [NOT_NULLABLE]
+            if not type_check(value):
+                return [type_error]
+            errors = {}
+            for index, item in enumerate(value):
+                item_errors = check_item(item)
+                if item_errors:
+                    errors[index] = item_errors
+            return [errors] if errors else None
+        return check
+
+    fast_types = FAST_TYPES.get(type_name, ())
+
+    def check(value):
+        if type(value) in fast_types:
+            return None
+        errors = []
+        coerce_error = None
+        if coerce is not None and not (nullable and value is None):
+            try:
+                value = coerce(value)
+            except Exception as e:
+                coerce_error = COERCION_FAILED.format(name, str(e))
+        if value is None:
+            if not nullable:
+                errors.append(NOT_NULLABLE)
+        elif not type_check(value):
+            errors.append(type_error)
+        if coerce_error is not None:
+            errors.append(coerce_error)
+        return errors or None
+    return check
+
+
+def compile_record_check(record_type, schema):
+    """Generate a predicate that is True when a record_type row is certainly valid, or None.
+
+    The predicate is a single expression testing the exact type of every field, so a valid
+    Node or Tag costs one call instead of one per field.
+    """
+    if set(record_type._fields) != set(schema):
+        return None
+    namespace = {}
+    terms = []
+    for index, name in enumerate(record_type._fields):
+        rules = schema[name]
+        if 'schema' in rules or rules.get('type') not in FAST_TYPES:
+            return None
+        namespace['T%d' % index] = FAST_TYPES[rules['type']]
+        terms.append('type(row[%d]) in T%d' % (index, index))
+    return eval('lambda row: ' + ' and '.join(terms), namespace)
+
+
+def compile_mapping(schema):
+    """Return check(document) for a dict or record, giving its cerberus errors dict (empty if valid)"""
+    fields = [(name, compile_field(name, rules), rules.get('required', False))
+              for name, rules in schema.items()]
+    known = frozenset(schema)
+    record_checks = {}
+
+    def check(document):
+        if not isinstance(document, dict):
+            record_type = type(document)
+            if record_type not in record_checks:
+                record_checks[record_type] = compile_record_check(record_type, schema)
+            record_check = record_checks[record_type]
+            if record_check is not None and record_check(document):
+                return {}
+            document = dict(zip(document._fields, document))
+
+        errors = {}
+        for name, check_field, required in fields:
+            value = document.get(name, MISSING)
+            if value is MISSING:
+                if required:
+                    errors[name] = [REQUIRED_FIELD]
+                continue
+            field_errors = check_field(value)
+            if field_errors:
+                errors[name] = field_errors
+        for name in document:
+            if name not in known:
+                errors[name] = [UNKNOWN_FIELD]
+        return errors
+    return check
+
+
+class CompiledValidator(object):
+    """Drop-in for cerberus.Validator(schema) on shaped elements, compiled once from schema.
+
+    With sample_rate below 1 only that fraction of the elements, evenly spread, is checked;
+    the others are reported valid.
+    """
+
+    def __init__(self, schema=SCHEMA, sample_rate=1.0):
+        self.check = compile_mapping(schema)
+        self.sample_rate = sample_rate
+        self.credit = 0.0
+        self.checked = 0
+        self.errors = {}
+
+    def validate(self, document):
+        self.credit += self.sample_rate
+        if self.credit < 1:
+            self.errors = {}
+            return True
+        self.credit -= 1
+        self.checked += 1
+        self.errors = self.check(document)
+        return not self.errors
+
+
+def as_dict(element):
+    """Nested dict form of a ShapedNode/ShapedWay, as the cerberus schema expects"""
+    return dict((field, [row._asdict() for row in value] if isinstance(value, list) else value._asdict())
+                for field, value in zip(element._fields, element))
 
-    def writerow(self, row):
-        super(UnicodeDictWriter, self).writerow({
-            k: (v.encode('utf-8') if isinstance(v, unicode) else v) for k, v in row.iteritems()
-        })
+# ================================================== #
+#               Instrumentation                      #
+# ================================================== #
+# A full import runs for a long time. ImportProgress keeps the cumulative seconds of each stage
+# (parse, shape, validate, every writer...), the elements done and the bytes of the OSM file
+# consumed, and every interval seconds prints a progress line with the rate and an ETA and
+# appends the same numbers as a json line to the metrics file.
+
+PROGRESS_INTERVAL = 10  # seconds between progress lines / metrics snapshots
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return '?'
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{0}:{1:02d}:{2:02d}'.format(hours, minutes, seconds)
+
+
+class ImportProgress(object):
+    """Elements done, bytes consumed of total_bytes and seconds per stage of an import.
+
+    With interval None nothing is reported, e.g. in the workers, whose counts are merged into
+    the parent's. Stage times are summed over all workers, so with several they add up to
+    more than the elapsed time.
+    """
+
+    def __init__(self, total_bytes=None, interval=PROGRESS_INTERVAL, metrics_path=None, unit='elements'):
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.unit = unit
+        self.metrics = open(metrics_path, 'a') if metrics_path else None
+        self.elements = 0
+        self.bytes = self.start_bytes = 0
+        self.seconds = {}
+        self.pipeline = None  # set by shape_pipelined
+        self.started = self.reported = time.time()
+
+    def start_at(self, byte_offset):
+        """Count bytes from byte_offset on, e.g. where a resumed import starts"""
+        self.bytes = self.start_bytes = byte_offset
+
+    def add(self, stage, seconds):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Add the time the block takes to stage name"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def advance(self, elements, byte_offset=None):
+        """Count elements more as done and the file as consumed up to byte_offset"""
+        self.elements += elements
+        if byte_offset is not None:
+            self.bytes = byte_offset
+        if self.interval is not None and time.time() - self.reported >= self.interval:
+            self.report()
+
+    def counts(self):
+        """(elements, seconds per stage), for merge() in another process"""
+        return self.elements, self.seconds
+
+    def merge(self, counts):
+        elements, seconds = counts
+        self.elements += elements
+        for stage, stage_seconds in seconds.iteritems():
+            self.add(stage, stage_seconds)
+
+    def snapshot(self):
+        elapsed = time.time() - self.started
+        consumed = self.bytes - self.start_bytes
+        eta = None
+        if self.total_bytes and consumed > 0:
+            eta = (self.total_bytes - self.bytes) * elapsed / consumed
+        stages = dict(self.seconds)
+        stages['clean'] = sum(seconds for _, _, _, seconds in CLEANING.stats())  # part of shape
+        return {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'elapsed': elapsed,
+            self.unit: self.elements,
+            self.unit + '_per_second': self.elements / elapsed if elapsed else 0.0,
+            'bytes': self.bytes,
+            'total_bytes': self.total_bytes,
+            'percent': 100.0 * self.bytes / self.total_bytes if self.total_bytes else None,
+            'eta_seconds': eta,
+            'stages': stages,
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'pipeline': self.pipeline.stats() if self.pipeline is not None else None,
+        }
+
+    def report(self):
+        """Print a progress line and write the snapshot to the metrics file"""
+        self.reported = time.time()
+        snapshot = self.snapshot()
+        line = "{0} {1}, {2:.0f}/s".format(snapshot[self.unit], self.unit, snapshot[self.unit + '_per_second'])
+        if self.total_bytes:
+            line += ", {0:.0f}/{1:.0f}MB ({2:.1f}%), ETA {3}".format(
+                self.bytes / 1e6, self.total_bytes / 1e6, snapshot['percent'], format_duration(snapshot['eta_seconds']))
+        stages = sorted(snapshot['stages'].iteritems(), key=lambda item: -item[1])
+        line += " | " + ", ".join("{0} {1:.1f}s".format(stage, seconds) for stage, seconds in stages)
+        if snapshot['pipeline']:
+            queues = sorted((name, stage['queue']) for name, stage in snapshot['pipeline'].iteritems() if 'queue' in stage)
+            line += " | queues " + ", ".join("{0} {1}/{2}".format(name, queue['depth'], queue['size'])
+                                             for name, queue in queues)
+        print line
+        sys.stdout.flush()
+        if self.metrics is not None:
+            self.metrics.write(json.dumps(snapshot, sort_keys=True) + '\n')
+            self.metrics.flush()
+
+    def close(self):
+        """Report the final numbers"""
+        if self.interval is not None:
+            self.report()
+        if self.metrics is not None:
+            self.metrics.close()
+            self.metrics = None
+
+
+class TimedSink(object):
+    """A sink whose add/add_shard/close times are added to progress under the sink's name"""
+
+    def __init__(self, sink, progress):
+        self.sink = sink
+        self.progress = progress
+        self.name = 'write ' + sink.name
+
+    def add(self, el):
+        start = time.time()
+        self.sink.add(el)
+        self.progress.add(self.name, time.time() - start)
+
+    def add_shard(self, shard_paths, end):
+        with self.progress.stage(self.name):
+            self.sink.add_shard(shard_paths, end)
+
+    def close(self):
+        with self.progress.stage(self.name):
+            self.sink.close()
+
+
+PROFILERS = ('cprofile', 'tracemalloc')
+
+
+@contextlib.contextmanager
+def profiled(profiler, output):
+    """Profile the block with cProfile or tracemalloc, print the top entries and save the
+    profile (pstats or tracemalloc snapshot) to output. Only the current process is profiled;
+    with profiler None the block just runs.
+    """
+    if profiler is None:
+        yield
+    elif profiler == 'cprofile':
+        import cProfile
+        import pstats
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(output)
+            pstats.Stats(output).sort_stats('cumulative').print_stats(30)
+    elif profiler == 'tracemalloc':
+        try:
+            tracemalloc = importlib.import_module('tracemalloc')
+        except ImportError:
+            raise ValueError('tracemalloc needs Python 3.4+ (or pytracemalloc); use cprofile, or the '
+                             'peak_rss_kb of the metrics snapshots for memory')
+        tracemalloc.start(25)
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            snapshot.dump(output)
+            for stat in snapshot.statistics('lineno')[:30]:
+                print stat
+    else:
+        raise ValueError('unknown profiler {0!r}'.format(profiler))
 
-    def writerows(self, rows):
-        for row in rows:
-            self.writerow(row)
 
 # USED CODE FROM THE FINAL CHAPTER OF THE DATA WRANGLING COURSE
 # ================================================== #
 #               Main Function                        #
 # ================================================== #
-def process_map(file_in, validate):
-    """Iteratively process each XML element and write to csv(s)"""
-
-    with codecs.open(NODES_PATH, 'w') as nodes_file, \
-         codecs.open(NODE_TAGS_PATH, 'w') as nodes_tags_file, \
-         codecs.open(WAYS_PATH, 'w') as ways_file, \
-         codecs.open(WAY_NODES_PATH, 'w') as way_nodes_file, \
-         codecs.open(WAY_TAGS_PATH, 'w') as way_tags_file:
-
-        nodes_writer = UnicodeDictWriter(nodes_file, NODE_FIELDS)
-        node_tags_writer = UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
-        ways_writer = UnicodeDictWriter(ways_file, WAY_FIELDS)
-        way_nodes_writer = UnicodeDictWriter(way_nodes_file, WAY_NODES_FIELDS)
-        way_tags_writer = UnicodeDictWriter(way_tags_file, WAY_TAGS_FIELDS)
-
-        nodes_writer.writeheader()
-        node_tags_writer.writeheader()
-        ways_writer.writeheader()
-        way_nodes_writer.writeheader()
-        way_tags_writer.writeheader()
-
-        validator = cerberus.Validator()
-
-        for element in get_element(file_in, tags=('node', 'way')):
-            el = shape_element(element)
-            if el:
-                if validate is True:
+def process_map(file_in, validate, workers=1, conn=None, write_csv=True, resume=False, element_filter=None,
+                columnar=None, progress=None, pipelined=False):
+    """Iteratively process each XML element and write to csv(s) and/or the sqlite db.
+
+    validate is True to check every element against the schema, False for none, or the
+    fraction of elements to check (e.g. 0.01).
+
+    If conn is given the shaped rows are streamed straight into its tables in batched
+    transactions, and the csvs are only written as well when write_csv is True. Every
+    transaction also saves an ImportCheckpoint; with resume=True the import carries on from
+    the last one instead of starting over (the csvs cannot be resumed, so write_csv must be
+    False then).
+
+    element_filter, an ElementFilter, restricts the output to an extract. With key filters,
+    file_in is first scanned for the nodes of the kept ways, see ElementFilter.scan. Filtered
+    imports cannot be resumed, since the filter needs to see every node before the ways.
+
+    columnar, 'parquet' or 'arrow', also writes the tables as columnar files next to the
+    csvs, see ColumnarSink.
+
+    progress, an ImportProgress, is given the time of every stage and the elements and bytes
+    done as the import goes.
+
+    pipelined parses, shapes and writes in threads of their own, see shape_pipelined. It only
+    applies with workers=1; with more, the workers shape while this process writes anyway.
+    """
+    if columnar and pyarrow is None:
+        # before any csv is truncated
+        raise ImportError('the columnar export needs pyarrow')
+    checkpoint = None
+    if conn is not None:
+        if resume:
+            if write_csv or columnar:
+                raise ValueError('an import can only be resumed with write_csv=False and no columnar export')
+            if element_filter is not None:
+                raise ValueError('a filtered import cannot be resumed')
+            checkpoint = ImportCheckpoint.load(conn, file_in)
+            if checkpoint.complete:
+                print "{0} is already fully imported".format(file_in)
+                return
+        else:
+            checkpoint = ImportCheckpoint(file_in)
+        if progress is not None:
+            progress.start_at(checkpoint.byte_offset)
+
+    if element_filter is not None and element_filter.filters_keys and element_filter.way_node_ids is None:
+        scan_start = time.time()
+        element_filter.scan(file_in)
+        if progress is not None:
+            progress.add('filter scan', time.time() - scan_start)
+
+    if workers > 1 and osm_input.osm_format(file_in) not in ('xml', 'pbf'):
+        # compressed xml cannot be cut into shards; it is shaped while a thread decompresses it
+        workers = 1
+    if workers > 1:
+        process_map_parallel(file_in, validate, workers, conn, write_csv, checkpoint, element_filter, columnar,
+                             progress)
+        return
+
+    shape = shape_pipelined if pipelined else shape_into
+    sinks = []
+    if write_csv:
+        sinks.append(CsvSink(CSV_PATHS, buffered=pipelined))
+    if columnar:
+        sinks.append(ColumnarSink(os.path.dirname(NODES_PATH) or '.', columnar))
+    if conn is None:
+        reader = osm_input.open_osm(file_in)
+        try:
+            shape(reader, validate, sinks, element_filter=element_filter, progress=progress)
+        finally:
+            reader.close()
+        return
+
+    sinks.append(SqliteSink(conn, checkpoint=checkpoint))
+    reader = checkpoint.reader()
+    try:
+        shape(reader, validate, sinks, checkpoint, element_filter, progress)
+    finally:
+        reader.close()
+
+
+def shape_into(osm_file, validate, sinks, checkpoint=None, element_filter=None, progress=None):
+    """Shape every node and way of osm_file and hand the result to each sink.
+
+    With a checkpoint, elements it has already loaded are skipped, and it is advanced past
+    each element just before the sinks get it. osm_file must then be a ShardReader.
+    Elements that element_filter drops are skipped while parsing. Elements are shaped
+    SHAPE_BATCH_SIZE at a time; with progress, the parse, shape, validate and write time of
+    every batch is added to it, and the bytes consumed if osm_file has a tell().
+    """
+    validator = None
+    if validate:
+        validator = CompiledValidator(SCHEMA, 1.0 if validate is True else validate)
+    if progress is not None:
+        sinks = [TimedSink(sink, progress) for sink in sinks]
+    tell = getattr(osm_file, 'tell', None) if progress is not None else None
+
+    def shape_batch(batch):
+        start = time.time()
+        shaped = shape_elements([element for element, _ in batch])
+        shaped_at = time.time()
+        if validator is not None:
+            for el in shaped:
+                if el:
                     validate_element(el, validator)
+        if progress is not None:
+            progress.add('shape', shaped_at - start)
+            progress.add('validate', time.time() - shaped_at)
+        for (element, offset), el in zip(batch, shaped):
+            if el:
+                if checkpoint is not None:
+                    checkpoint.advance(element, offset)
+                for sink in sinks:
+                    sink.add(el)
+        if progress is not None:
+            progress.advance(len(batch), tell() if tell is not None else None)
+
+    try:
+        batch = []
+        parse_start = time.time()
+        for element in get_element(osm_file, tags=('node', 'way'), keep=element_filter):
+            if checkpoint is not None:
+                if checkpoint.loaded(element):
+                    continue
+                # where the reader stood when the element was parsed, see ShardReader
+                batch.append((element, osm_file.safe_offset))
+            else:
+                batch.append((element, None))
+            if len(batch) == SHAPE_BATCH_SIZE:
+                if progress is not None:
+                    progress.add('parse', time.time() - parse_start)
+                shape_batch(batch)
+                batch = []
+                parse_start = time.time()
+        if progress is not None:
+            progress.add('parse', time.time() - parse_start)
+        shape_batch(batch)
+        if checkpoint is not None:
+            checkpoint.complete = True
+    finally:
+        for sink in sinks:
+            sink.close()
+
+
+class CsvSink(object):
+    """Write shaped elements to the five csvs given by paths.
+
+    With buffered, every csv is written from a thread of its own, see BufferedOutput.
+    """
+    name = 'csv'
+
+    def __init__(self, paths, header=True, buffered=False):
+        if buffered:
+            self.files = self.outputs = [BufferedOutput(path) for path in paths]
+        else:
+            self.files = [codecs.open(path, 'w') for path in paths]
+            self.outputs = []
+        self.added = 0
+        self.writers = [csv.writer(f) for f in self.files]
+        if header:
+            for writer, (_, fields) in zip(self.writers, TABLES):
+                writer.writerow(fields)
+
+    def add(self, el):
+        nodes_writer, node_tags_writer, ways_writer, way_nodes_writer, way_tags_writer = self.writers
+        if isinstance(el, ShapedNode):
+            nodes_writer.writerow(el.node)
+            node_tags_writer.writerows(el.node_tags)
+        else:
+            ways_writer.writerow(el.way)
+            way_nodes_writer.writerows(el.way_nodes)
+            way_tags_writer.writerows(el.way_tags)
+        if self.outputs:
+            self.added += 1
+            if self.added % BUFFER_CHECK_ELEMENTS == 0:
+                for output in self.outputs:
+                    output.hand_off(WRITE_BUFFER_SIZE)
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+
+# ================================================== #
+#               Pipelined Import                     #
+# ================================================== #
+# shape_pipelined does the work of shape_into as stages connected by bounded queues of
+# batches: a thread parses the OSM file, another shapes and validates, and every sink writes
+# from a thread of its own, the csvs each through a BufferedOutput thread. A stage feeding a
+# full queue blocks until there is room, so a slow stage holds the ones before it back instead
+# of letting batches pile up in memory. The GIL still runs the python of one stage at a time;
+# what overlaps is the work done without it: file reads and writes, decompression and
+# sqlite's inserts. So it only pays off with more than one cpu; on one it is slower than
+# shape_into. The stall and wait times show which stage the others wait on.
+
+# Batches of SHAPE_BATCH_SIZE elements waiting in front of a stage. Deeper queues were slower:
+# the batches they hold alive make every garbage collection and cache miss dearer.
+PIPELINE_QUEUE_SIZE = 2
+WRITE_BUFFER_SIZE = 1024 * 1024  # bytes a BufferedOutput gathers before its thread writes them
+WRITE_QUEUE_SIZE = 4  # full buffers waiting for a BufferedOutput's thread
+BUFFER_CHECK_ELEMENTS = 256  # elements a buffered CsvSink adds between checks of its buffers
+
+
+class PipelineStopped(Exception):
+    """Raised in a stage blocked on a queue once another stage has failed"""
+
+
+class StageQueue(object):
+    """Bounded queue of batches from pipeline stage producer to stage consumer.
+
+    The time put() blocks on a full queue is the producer's stall, the time get() blocks on
+    an empty one the consumer's wait. The depth is sampled at every put.
+    """
+
+    def __init__(self, pipeline, producer, consumer, size):
+        self.pipeline = pipeline
+        self.producer = producer
+        self.consumer = consumer
+        self.size = size
+        self.queue = Queue.Queue(size)
+        self.puts = self.depth_total = self.max_depth = 0
+        self.stalled = self.waiting = 0.0
+
+    def put(self, item):
+        depth = self.queue.qsize()
+        self.puts += 1
+        self.depth_total += depth
+        self.max_depth = max(self.max_depth, depth)
+        start = time.time()
+        try:
+            while True:
+                try:
+                    self.queue.put(item, timeout=0.1)
+                    return
+                except Queue.Full:
+                    if self.pipeline.stopped:
+                        raise PipelineStopped()
+        finally:
+            self.stalled += time.time() - start
+
+    def get(self):
+        start = time.time()
+        try:
+            while True:
+                try:
+                    return self.queue.get(timeout=0.1)
+                except Queue.Empty:
+                    if self.pipeline.stopped:
+                        raise PipelineStopped()
+        finally:
+            self.waiting += time.time() - start
+
+    def stats(self):
+        return {'depth': self.queue.qsize(), 'size': self.size, 'max_depth': self.max_depth,
+                'mean_depth': float(self.depth_total) / self.puts if self.puts else 0.0}
+
+
+class Pipeline(object):
+    """Stages running in threads and connected by StageQueues, stopped together when one fails"""
+
+    def __init__(self, queue_size=PIPELINE_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.queues = []
+        self.outputs = []
+        self.threads = []
+        self.elapsed = {}
+        self.stopped = False
+        self.error = None
+
+    def queue(self, producer, consumer):
+        queue = StageQueue(self, producer, consumer, self.queue_size)
+        self.queues.append(queue)
+        return queue
+
+    def start(self, name, target, *args):
+        """Run target(*args) as stage name in a new thread"""
+        thread = threading.Thread(target=self.run, args=(name, target) + args, name=name)
+        thread.daemon = True
+        self.threads.append(thread)
+        thread.start()
+
+    def run(self, name, target, *args):
+        """Run target(*args) as stage name in this thread; an error stops the pipeline.
+
+        KeyboardInterrupt and SystemExit stop it too, or the other stages would block on their
+        queues forever; join() raises them again in the main thread.
+        """
+        start = time.time()
+        try:
+            target(*args)
+        except PipelineStopped:
+            pass
+        except BaseException:
+            self.stop(sys.exc_info())
+        finally:
+            self.elapsed[name] = time.time() - start
+
+    def stop(self, error=None):
+        if error is not None and self.error is None:
+            self.error = error
+        self.stopped = True
+
+    def join(self):
+        """Wait for the stage threads, then raise the first error a stage hit"""
+        for thread in self.threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def stats(self):
+        """{stage: {'busy', 'stalled', 'waiting', 'queue'}} and {'output <file>': BufferedOutput stats}.
+
+        stalled is the time a stage was blocked on a full queue, waiting the time it was blocked
+        on an empty one and queue the depths of its input queue. busy is only known once the
+        stage has finished, and includes the time it waited for the GIL.
+        """
+        stages = {}
+        for queue in self.queues:
+            stages.setdefault(queue.producer, {'stalled': 0.0, 'waiting': 0.0})['stalled'] += queue.stalled
+            consumer = stages.setdefault(queue.consumer, {'stalled': 0.0, 'waiting': 0.0})
+            consumer['waiting'] += queue.waiting
+            consumer['queue'] = queue.stats()
+        for name, elapsed in self.elapsed.items():
+            stages[name]['busy'] = elapsed - stages[name]['stalled'] - stages[name]['waiting']
+        for output in self.outputs:
+            stages['output ' + output.name] = output.stats()
+        return stages
+
+    def report(self):
+        """Print the time each stage was busy, stalled and waiting, busiest first"""
+        stats = self.stats()
+        stages = sorted((name for name in stats if 'busy' in stats[name]), key=lambda name: -stats[name]['busy'])
+        for name in stages:
+            stage = stats[name]
+            line = "{0}: busy {1:.1f}s, stalled {2:.1f}s, waiting {3:.1f}s".format(
+                name, stage['busy'], stage['stalled'], stage['waiting'])
+            if 'queue' in stage:
+                line += ", queue {0:.1f}/{1} (max {2})".format(
+                    stage['queue']['mean_depth'], stage['queue']['size'], stage['queue']['max_depth'])
+            print line
+        for output in self.outputs:
+            print "output {0}: {1:.1f}MB, writing {2:.1f}s, stalled {3:.1f}s".format(
+                output.name, output.written / 1e6, output.writing, output.stalled)
+
+
+class BufferedOutput(object):
+    """A file written from a thread of its own.
+
+    write() goes to an in-memory buffer, and hand_off() queues the buffer's contents for the
+    thread, which does the actual file writes. It only blocks (and counts the time as stalled)
+    when queue_size buffers are already waiting. close() writes the rest, closes the file and
+    raises any error the thread hit.
+    """
+
+    def __init__(self, path, queue_size=WRITE_QUEUE_SIZE):
+        self.name = os.path.basename(path)
+        self.file = open(path, 'wb')
+        self.buffer = cStringIO.StringIO()
+        self.write = self.buffer.write  # a C method, as cheap for csv.writer as a file's own
+        self.buffers = Queue.Queue(queue_size)
+        self.error = None
+        self.written = 0
+        self.writing = self.stalled = 0.0
+        self.thread = threading.Thread(target=self.run, name='output ' + self.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def hand_off(self, min_size=1):
+        """Queue the buffer for the thread if it holds at least min_size bytes"""
+        if self.buffer.tell() < min_size:
+            return
+        data = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        start = time.time()
+        self.buffers.put(data)
+        self.stalled += time.time() - start
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def run(self):
+        while True:
+            data = self.buffers.get()
+            if data is None:
+                return
+            if self.error is not None:
+                continue  # keep draining so hand_off never blocks for good
+            try:
+                start = time.time()
+                self.file.write(data)
+                self.writing += time.time() - start
+                self.written += len(data)
+            except BaseException:
+                self.error = sys.exc_info()
+
+    def close(self):
+        try:
+            self.hand_off()
+        finally:
+            self.buffers.put(None)
+            self.thread.join()
+            self.file.close()
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def stats(self):
+        return {'written': self.written, 'writing': self.writing, 'stalled': self.stalled,
+                'pending': self.buffers.qsize()}
+
+
+def shape_pipelined(osm_file, validate, sinks, checkpoint=None, element_filter=None, progress=None,
+                    queue_size=PIPELINE_QUEUE_SIZE):
+    """shape_into run as a Pipeline, with the same arguments and the same output.
+
+    Parsing, shaping and each sink's writes are stages of their own, connected by queues of
+    queue_size batches. The sinks write from threads, except one that has to stay in the
+    calling thread (thread_bound, the SqliteSink), or else the last one. That stage also
+    advances the checkpoint and progress; progress snapshots then carry Pipeline.stats().
+    The stage times are printed at the end.
+    """
+    validator = None
+    if validate:
+        validator = CompiledValidator(SCHEMA, 1.0 if validate is True else validate)
+    pipeline = Pipeline(queue_size)
+    pipeline.outputs = [output for sink in sinks for output in getattr(sink, 'outputs', [])]
+    names = ['write ' + sink.name for sink in sinks] or ['write']
+    bound = [i for i, sink in enumerate(sinks) if getattr(sink, 'thread_bound', False)]
+    main = bound[0] if bound else len(names) - 1
+    if progress is not None:
+        progress.pipeline = pipeline
+        sinks = [TimedSink(sink, progress) for sink in sinks]
+    sinks = sinks or [None]
+    # the write stage advances the checkpoint while this one parses, so skip by a copy
+    skip = None
+    if checkpoint is not None:
+        skip = ImportCheckpoint(checkpoint.osm_file, checkpoint.byte_offset, checkpoint.last)
+
+    def parse(output):
+        tell = getattr(osm_file, 'tell', None) if progress is not None else None
+        batch = []
+        start = time.time()
+        for element in get_element(osm_file, tags=('node', 'way'), keep=element_filter):
+            if skip is not None:
+                if skip.loaded(element):
+                    continue
+                # where the reader stood when the element was parsed, see ShardReader
+                batch.append((element, osm_file.safe_offset))
+            else:
+                batch.append((element, None))
+            if len(batch) == SHAPE_BATCH_SIZE:
+                if progress is not None:
+                    progress.add('parse', time.time() - start)
+                output.put((batch, tell() if tell is not None else None))
+                batch = []
+                start = time.time()
+        if progress is not None:
+            progress.add('parse', time.time() - start)
+        if batch:
+            output.put((batch, tell() if tell is not None else None))
+        output.put(None)
+
+    def shape(source, outputs):
+        while True:
+            item = source.get()
+            if item is None:
+                break
+            batch, offset = item
+            start = time.time()
+            shaped = shape_elements([element for element, _ in batch])
+            shaped_at = time.time()
+            if validator is not None:
+                for el in shaped:
+                    if el:
+                        validate_element(el, validator)
+            if progress is not None:
+                progress.add('shape', shaped_at - start)
+                progress.add('validate', time.time() - shaped_at)
+            for output in outputs:
+                output.put((batch, shaped, offset))
+        for output in outputs:
+            output.put(None)
+
+    def write(source, sink, is_main):
+        try:
+            while True:
+                item = source.get()
+                if item is None:
+                    break
+                batch, shaped, offset = item
+                for (element, element_offset), el in zip(batch, shaped):
+                    if el:
+                        if is_main and checkpoint is not None:
+                            checkpoint.advance(element, element_offset)
+                        if sink is not None:
+                            sink.add(el)
+                if is_main and progress is not None:
+                    progress.advance(len(batch), offset)
+            if is_main and checkpoint is not None:
+                checkpoint.complete = True
+        finally:
+            if sink is not None:
+                sink.close()
+
+    parsed = pipeline.queue('parse', 'shape')
+    outputs = [pipeline.queue('shape', name) for name in names]
+    try:
+        pipeline.start('parse', parse, parsed)
+        pipeline.start('shape', shape, parsed, outputs)
+        for i, (name, sink, output) in enumerate(zip(names, sinks, outputs)):
+            if i != main:
+                pipeline.start(name, write, output, sink, False)
+        pipeline.run(names[main], write, outputs[main], sinks[main], True)
+    except BaseException:
+        pipeline.stop()
+        pipeline.join()
+        raise
+    pipeline.join()
+    pipeline.report()
 
-                if element.tag == 'node':
-                    nodes_writer.writerow(el['node'])
-                    node_tags_writer.writerows(el['node_tags'])
-                elif element.tag == 'way':
-                    ways_writer.writerow(el['way'])
-                    way_nodes_writer.writerows(el['way_nodes'])
-                    way_tags_writer.writerows(el['way_tags'])
 
-process_map(OSM_PATH, validate=False)
+# ================================================== #
+#               Columnar Export                      #
+# ================================================== #
+# The five tables can also be written as typed, compressed columnar files, so analytics read
+# only the columns they need instead of re-parsing csv text. Needs pyarrow.
+
+# Arrow type of each column of each table, in TABLES column order
+COLUMN_TYPES = {
+    'node': ['int64', 'float64', 'float64', 'string', 'int64', 'string', 'int64', 'string'],
+    'node_tags': ['int64', 'string', 'string', 'string'],
+    'way': ['int64', 'string', 'int64', 'string', 'int64', 'string'],
+    'way_nodes': ['int64', 'int64', 'int64'],
+    'way_tags': ['int64', 'string', 'string', 'string'],
+}
+# Turn a shaped record or csv field into the value stored for each type
+COLUMN_CONVERTERS = {'int64': int, 'float64': float, 'string': utf8}
+# Rows per parquet row group / arrow record batch
+ROW_GROUP_SIZE = 100000
+COLUMNAR_EXTENSIONS = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+
+class ColumnarTable(object):
+    """One table's columnar file, written a row group at a time"""
+
+    def __init__(self, path, table_name, fields, columnar_format, row_group_size, compression):
+        types = COLUMN_TYPES[table_name]
+        self.fields = fields
+        self.converters = [COLUMN_CONVERTERS[type_name] for type_name in types]
+        self.types = [getattr(pyarrow, type_name)() for type_name in types]
+        self.schema = pyarrow.schema([pyarrow.field(field, type_) for field, type_ in zip(fields, self.types)])
+        self.row_group_size = row_group_size
+        self.columns = [[] for _ in fields]
+        self.file = None
+        if columnar_format == 'parquet':
+            self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression=compression)
+        else:
+            self.file = pyarrow.OSFile(path, 'wb')
+            self.writer = pyarrow.RecordBatchFileWriter(self.file, self.schema)
+
+    def add(self, rows):
+        columns, converters = self.columns, self.converters
+        for row in rows:
+            for column, convert, value in zip(columns, converters, row):
+                column.append(convert(value))
+        if len(columns[0]) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self.columns[0]:
+            return
+        arrays = [pyarrow.array(column, type=type_) for column, type_ in zip(self.columns, self.types)]
+        if self.file is None:
+            self.writer.write_table(pyarrow.Table.from_arrays(arrays, self.fields))
+        else:
+            self.writer.write_batch(pyarrow.RecordBatch.from_arrays(arrays, self.fields))
+        self.columns = [[] for _ in self.fields]
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        if self.file is not None:
+            self.file.close()
+
+
+class ColumnarSink(object):
+    """Write shaped elements to one columnar file per table in directory.
+
+    columnar_format is 'parquet' (compressed with compression) or 'arrow' (an Arrow IPC
+    file, which readers can memory map for zero copy reads). Rows are written in row groups
+    of row_group_size.
+    """
+
+    def __init__(self, directory, columnar_format='parquet', row_group_size=ROW_GROUP_SIZE, compression='snappy'):
+        if pyarrow is None:
+            raise ImportError('the columnar export needs pyarrow')
+        if columnar_format not in COLUMNAR_EXTENSIONS:
+            raise ValueError('unknown columnar format {0!r}'.format(columnar_format))
+        self.name = columnar_format
+        self.tables = [ColumnarTable(os.path.join(directory, table_name + COLUMNAR_EXTENSIONS[columnar_format]),
+                                     table_name, fields, columnar_format, row_group_size, compression)
+                       for table_name, fields in TABLES]
+
+    def add(self, el):
+        node_table, node_tags_table, way_table, way_nodes_table, way_tags_table = self.tables
+        if isinstance(el, ShapedNode):
+            node_table.add([el.node])
+            node_tags_table.add(el.node_tags)
+        else:
+            way_table.add([el.way])
+            way_nodes_table.add(el.way_nodes)
+            way_tags_table.add(el.way_tags)
+
+    def add_shard(self, shard_paths, end):
+        """Add the rows of one set of headerless shard csvs"""
+        for table, shard_path in zip(self.tables, shard_paths):
+            with open(shard_path, 'rb') as shard:
+                table.add(csv.reader(shard))
+
+    def close(self):
+        for table in self.tables:
+            table.close()
+
+# ================================================== #
+#               Parallel Processing                  #
+# ================================================== #
+# The OSM file is cut into byte ranges that each start on a top level <node, <way or <relation.
+# Every range is shaped in its own process into a set of shard csvs, which are then appended
+# in file order. OSM files are sorted by type and id, so the merged csvs come out in id order
+# and byte for byte the same as a serial run. A pbf file is cut on blob boundaries instead.
+
+ELEMENT_START = re.compile(r'<(?:node|way|relation)[\s/>]')
+WAY_START = re.compile(r'<way[\s/>]')
+
+
+def find_element_start(osm, offset, chunk_size=64 * 1024, pattern=ELEMENT_START):
+    """Return the offset of the first top level element (matching pattern) at or after offset, or None"""
+    osm.seek(offset)
+    carry = ''
+    position = offset
+    while True:
+        chunk = osm.read(chunk_size)
+        if not chunk:
+            return None
+        data = carry + chunk
+        match = pattern.search(data)
+        if match:
+            return position - len(carry) + match.start()
+        carry = data[-16:]
+        position += len(chunk)
+
+
+def osm_data_end(osm):
+    """Return the offset of the closing </osm> tag, or the file size if there is none"""
+    osm.seek(0, os.SEEK_END)
+    size = osm.tell()
+    osm.seek(max(0, size - 4096))
+    tail = osm.read()
+    end = tail.rfind('</osm>')
+    return size if end == -1 else size - len(tail) + end
+
+
+def osm_shards(file_in, count, offset=0, end=None):
+    """Split file_in from offset to end into at most count (start, end) byte ranges aligned on element boundaries"""
+    with open(file_in, 'rb') as osm:
+        if end is None:
+            end = osm_data_end(osm)
+        first = find_element_start(osm, offset)
+        if first is None or first >= end:
+            return []
+        starts = [first]
+        step = max(1, (end - first) // count)
+        for i in range(1, count):
+            start = find_element_start(osm, first + i * step)
+            if start is None or start >= end:
+                break
+            if start > starts[-1]:
+                starts.append(start)
+    return zip(starts, starts[1:] + [end])
+
+
+class ShardReader(object):
+    """File-like view of a byte range of the OSM file, wrapped in an <osm> root element.
+
+    safe_offset is the file offset where the chunk before the last one read began. The parser
+    hands out every element ending in a chunk before it reads the next one, so no element
+    that has not been yielded yet starts before safe_offset.
+    """
+
+    def __init__(self, file_in, start, end):
+        self.osm = open(file_in, 'rb')
+        self.osm.seek(start)
+        self.remaining = end - start
+        self.head = '<osm>'
+        self.tail = '</osm>'
+        self.position = self.chunk_start = self.safe_offset = start
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self.head) + self.remaining + len(self.tail)
+        data = self.head[:size]
+        self.head = self.head[len(data):]
+        if len(data) < size and self.remaining > 0:
+            self.safe_offset, self.chunk_start = self.chunk_start, self.position
+            chunk = self.osm.read(min(size - len(data), self.remaining))
+            self.position += len(chunk)
+            self.remaining = self.remaining - len(chunk) if chunk else 0
+            data += chunk
+        if len(data) < size and self.remaining <= 0:
+            closing = self.tail[:size - len(data)]
+            self.tail = self.tail[len(closing):]
+            data += closing
+        return data
+
+    def tell(self):
+        """Offset in the OSM file up to which it has been read"""
+        return self.position
+
+    def close(self):
+        self.osm.close()
+
+
+def process_shard(task):
+    """Shape one byte range into headerless shard csvs.
+
+    Returns their paths, the NodeIdSet of the nodes the shard's filter kept inside its bbox
+    (None if it kept none), the shard's CLEANING stats and its ImportProgress counts (None
+    without progress).
+    """
+    file_in, start, end, validate, shard_dir, index, checkpoint, element_filter, track = task
+    paths = [os.path.join(shard_dir, '%05d_%s' % (index, os.path.basename(path))) for path in CSV_PATHS]
+    known = len(element_filter.node_ids) if element_filter is not None else 0
+    CLEANING.reset()
+    progress = ImportProgress(interval=None) if track else None
+    if osm_input.osm_format(file_in) == 'pbf':
+        reader = osm_input.PbfReader(file_in, start, end)
+    else:
+        reader = ShardReader(file_in, start, end)
+    try:
+        shape_into(reader, validate, [CsvSink(paths, header=False)], checkpoint, element_filter, progress)
+    finally:
+        reader.close()
+    counts = progress.counts() if progress is not None else None
+    if element_filter is None or len(element_filter.node_ids) == known:
+        return paths, None, CLEANING.stats(), counts
+    return paths, element_filter.node_ids, CLEANING.stats(), counts
+
+
+def process_map_parallel(file_in, validate, workers, conn=None, write_csv=True, checkpoint=None,
+                         element_filter=None, columnar=None, progress=None):
+    """Shape file_in on a pool of workers and merge the shard csvs in order.
+
+    With conn each merged shard is loaded in a single transaction that also moves the
+    checkpoint to the end of the shard. With columnar the shards are also appended to the
+    columnar files. progress gets the stage times of the workers and advances shard by shard.
+    """
+    offset = checkpoint.byte_offset if checkpoint is not None else 0
+    count = max(workers, (os.path.getsize(file_in) - offset) // SHARD_SIZE)
+    pbf = osm_input.osm_format(file_in) == 'pbf'
+    shards_of = osm_input.pbf_shards if pbf else osm_shards
+    if element_filter is not None and element_filter.bbox is not None:
+        # A way is only kept if one of its nodes is inside the bbox, so the node shards are all
+        # shaped first and the node ids they kept are handed to the way shards.
+        if pbf:
+            way_start = osm_input.pbf_way_start(file_in, offset)
+            if way_start is None:
+                way_start = os.path.getsize(file_in)
+        else:
+            with open(file_in, 'rb') as osm:
+                way_start = find_element_start(osm, offset, pattern=WAY_START)
+                if way_start is None:
+                    way_start = osm_data_end(osm)
+        phases = [shards_of(file_in, count, offset, way_start), shards_of(file_in, count, way_start)]
+    else:
+        phases = [shards_of(file_in, count, offset)]
+    shard_dir = tempfile.mkdtemp(dir=os.path.dirname(NODES_PATH) or '.')
+    outputs = []
+    sinks = []
+    pool = None
+    try:
+        if conn is not None:
+            sinks.append(SqliteSink(conn, checkpoint=checkpoint))
+        if columnar:
+            sinks.append(ColumnarSink(os.path.dirname(NODES_PATH) or '.', columnar))
+        if progress is not None:
+            sinks = [TimedSink(sink, progress) for sink in sinks]
+        for path in CSV_PATHS:
+            outputs.append(open(path, 'wb') if write_csv else None)
+        pool = multiprocessing.Pool(workers)
+        for output, (_, fields) in zip(outputs, TABLES):
+            if output is not None:
+                csv.writer(output).writerow(fields)
+        index = 0
+        for shards in phases:
+            # Only the first shard of a resumed import can hold elements that are already loaded
+            tasks = [(file_in, start, end, validate, shard_dir, index + i, checkpoint if index + i == 0 else None,
+                      element_filter, progress is not None) for i, (start, end) in enumerate(shards)]
+            index += len(tasks)
+            # imap hands results back in shard order, so each shard is appended as soon as it and
+            # every shard before it are done.
+            for (_, end), (shard_paths, node_ids, stats, counts) in zip(shards, pool.imap(process_shard, tasks)):
+                CLEANING.merge(stats)
+                merge_start = time.time()
+                for output, shard_path in zip(outputs, shard_paths):
+                    if output is not None:
+                        with open(shard_path, 'rb') as shard:
+                            shutil.copyfileobj(shard, output)
+                if progress is not None:
+                    progress.add('merge csv', time.time() - merge_start)
+                for sink in sinks:
+                    sink.add_shard(shard_paths, end)
+                for shard_path in shard_paths:
+                    os.remove(shard_path)
+                if node_ids is not None:
+                    element_filter.node_ids.update(node_ids)
+                if progress is not None:
+                    progress.merge(counts)
+                    progress.advance(0, end)
+        if checkpoint is not None:
+            checkpoint.complete = True
+        pool.close()
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.join()
+        for output in outputs:
+            if output is not None:
+                output.close()
+        for sink in sinks:
+            sink.close()
+        shutil.rmtree(shard_dir, ignore_errors=True)
 
 # PUSH csv to SQLITE DB
 
+# Users, tag keys and tag types repeat the same few thousand strings over millions of rows, so
+# they are dictionary encoded: each distinct string is stored once in a lookup table and the
+# rows keep its integer id. The tables of TABLES are views joining the strings back in, so
+# queries written against them keep working, and INSERTs into them are encoded by triggers.
+
+# Lookup table of each dictionary: (table, string column)
+DICTIONARIES = [('users', 'name'), ('tag_keys', 'key'), ('tag_types', 'type')]
+
+# Tables of TABLES stored encoded: table -> (table the rows are stored in, {column: lookup table}).
+# An encoded column is stored as <column>_id.
+ENCODED_TABLES = {
+    'node': ('node_data', {'user': 'users'}),
+    'node_tags': ('node_tag_data', {'key': 'tag_keys', 'type': 'tag_types'}),
+    'way': ('way_data', {'user': 'users'}),
+    'way_tags': ('way_tag_data', {'key': 'tag_keys', 'type': 'tag_types'}),
+}
+# Encoded columns the views join to their lookup table, so that a filter like key = 'cuisine' or
+# key LIKE '%:kn%' finds the key ids first and then reads the (key_id, value) index. The other
+# columns are looked up row by row only when a query reads them, which leaves a COUNT(*) of a
+# view a plain count of its stored table. Tag rows need a key to show in the views.
+JOINED_COLUMNS = ('key',)
+
+CREATE_TABLE_QUERIES = [
+    # Lookup tables
+    'CREATE TABLE IF NOT EXISTS users(id INTEGER PRIMARY KEY, name STRING UNIQUE)',
+    'CREATE TABLE IF NOT EXISTS tag_keys(id INTEGER PRIMARY KEY, key STRING UNIQUE)',
+    'CREATE TABLE IF NOT EXISTS tag_types(id INTEGER PRIMARY KEY, type STRING UNIQUE)',
+    # Node
+    '''CREATE TABLE IF NOT EXISTS node_data(id INTEGER, lat REAL, lon REAL, user_id INTEGER, uid INTEGER,
+    version STRING, changeset INTEGER, timestamp STRING, PRIMARY KEY(id ASC),
+    FOREIGN KEY(user_id) REFERENCES users(id))''',
+    # Node_tags
+    '''CREATE TABLE IF NOT EXISTS node_tag_data(id INTEGER, key_id INTEGER, value STRING, type_id INTEGER,
+    FOREIGN KEY(id) REFERENCES node_data(id), FOREIGN KEY(key_id) REFERENCES tag_keys(id),
+    FOREIGN KEY(type_id) REFERENCES tag_types(id))''',
+    # way
+    '''CREATE TABLE IF NOT EXISTS way_data(id INTEGER, user_id INTEGER, uid INTEGER, version STRING,
+    changeset INTEGER, timestamp STRING, PRIMARY KEY(id ASC), FOREIGN KEY(user_id) REFERENCES users(id))''',
+    # way_nodes
+    '''CREATE TABLE IF NOT EXISTS way_nodes(id INTEGER, node_id INTEGER, position INTEGER,
+    FOREIGN KEY(id) REFERENCES way_data(id), FOREIGN KEY(node_id) REFERENCES node_data(id))''',
+    # way_tags
+    '''CREATE TABLE IF NOT EXISTS way_tag_data(id INTEGER, key_id INTEGER, value STRING, type_id INTEGER,
+    FOREIGN KEY(id) REFERENCES way_data(id), FOREIGN KEY(key_id) REFERENCES tag_keys(id),
+    FOREIGN KEY(type_id) REFERENCES tag_types(id))''',
+    # How far the import of each OSM file has got, see ImportCheckpoint
+    '''CREATE TABLE IF NOT EXISTS import_checkpoint(osm_file STRING, file_size INTEGER, byte_offset INTEGER,
+    element_type INTEGER, element_id INTEGER, complete INTEGER, PRIMARY KEY(osm_file))''',
+]
+
+# Tables holding the loaded rows, in the order clear_tables empties them
+STORED_TABLES = ['node_tag_data', 'node_data', 'way_tag_data', 'way_nodes', 'way_data'] + \
+    [lookup_table for lookup_table, _ in DICTIONARIES]
+
+
+def stored_fields(table_name, fields):
+    """Columns of table_name's stored table matching fields"""
+    encoded = ENCODED_TABLES[table_name][1]
+    return [field + '_id' if field in encoded else field for field in fields]
+
+
+def encoded_view_queries(table_name, fields):
+    """CREATE statements of the view presenting an encoded table as table_name, and its INSERT trigger"""
+    stored_table, encoded = ENCODED_TABLES[table_name]
+    lookup_column = dict(DICTIONARIES)
+    columns, joins, values, lookups = [], [], [], []
+    for field in fields:
+        if field not in encoded:
+            columns.append('t.{0} AS {0}'.format(field))
+            values.append('NEW.' + field)
+            continue
+        lookup_table = encoded[field]
+        if field in JOINED_COLUMNS:
+            columns.append('{0}.{1} AS {2}'.format(lookup_table, lookup_column[lookup_table], field))
+            joins.append('JOIN {0} ON {0}.id = t.{1}_id'.format(lookup_table, field))
+        else:
+            columns.append('(SELECT {1} FROM {0} WHERE id = t.{2}_id) AS {2}'.format(
+                lookup_table, lookup_column[lookup_table], field))
+        values.append('(SELECT id FROM {0} WHERE {1} = NEW.{2})'.format(lookup_table, lookup_column[lookup_table], field))
+        lookups.append('INSERT OR IGNORE INTO {0}({1}) SELECT NEW.{2} WHERE NEW.{2} IS NOT NULL;'.format(
+            lookup_table, lookup_column[lookup_table], field))
+    view = 'CREATE VIEW IF NOT EXISTS {0} AS SELECT {1} FROM {2} t {3}'.format(
+        table_name, ', '.join(columns), stored_table, ' '.join(joins))
+    trigger = 'CREATE TRIGGER IF NOT EXISTS {0}_insert INSTEAD OF INSERT ON {0} BEGIN {1} ' \
+              'INSERT INTO {2}({3}) VALUES ({4}); END'.format(
+                  table_name, ' '.join(lookups), stored_table, ', '.join(stored_fields(table_name, fields)),
+                  ', '.join(values))
+    return [view, trigger]
+
+
+VIEW_QUERIES = [query for table_name, fields in TABLES if table_name in ENCODED_TABLES
+                for query in encoded_view_queries(table_name, fields)]
+
 # Creates SQL Table
 def create_table(create_table_query,conn):
     c = conn.cursor()
     c.execute(create_table_query)
     conn.commit()
 
-# Reads csv
-def read_csv(csv_file):
-    with open(csv_file, "rb") as f:
-        reader = csv.reader(f)
-        header = reader.next()
-        data = [row for row in reader]
-        return header,data
-
-# adds each row of csv into sql table
-def add_into_table(csv_file):
-    c = conn.cursor()
-    table_name = csv_file[csv_file.index('/')+1:csv_file.index('.csv')]
-    header,data = read_csv(csv_file)
-    header_string = '(\"'+ '\", \"'.join(str(x) for x in header)+'\")'
-    for row in data:
-        data_string = '(\"'+ '\", \"'.join(str(x).replace('\"','').replace('\'','') for x in row)+'\")'
-        query_string = "INSERT INTO "+table_name+header_string+" VALUES "+data_string
-        try:
-            c.execute(query_string)
-        except:
-            # print 'error query: ', query_string
-            conn.commit()
-            return
+# Create tables for each csv file
+def create_tables(conn):
+    if is_unencoded(conn):
+        encode_tables(conn)
+    for create_table_query in CREATE_TABLE_QUERIES + VIEW_QUERIES:
+        create_table(create_table_query, conn)
+
+# Empty the tables before a fresh full import
+def clear_tables(conn):
+    for table_name in STORED_TABLES:
+        conn.execute('DELETE FROM %s' % table_name)
+    conn.execute('DELETE FROM import_checkpoint')
     conn.commit()
 
 
-# CREATING A TABLE
+# Dbs created before the tables were encoded hold node, node_tags, way and way_tags as tables
+def is_unencoded(conn):
+    return conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'node'").fetchone()[0] == 1
+
+
+def encode_tables(conn):
+    """Move the rows of a db with plain tables into the encoded tables and views, in one transaction.
+
+    The tag search indexes read the tag tables' rowids, so they are rebuilt if the db had them.
+    """
+    print "Encoding the tables of an older db"
+    tag_search = has_tag_search(conn)
+    lookup_column = dict(DICTIONARIES)
+    with transaction(conn) as c:
+        # way_nodes is moved too: it declares foreign keys to node and way, which become views
+        for table_name, _ in TABLES:
+            c.execute('ALTER TABLE {0} RENAME TO {0}_unencoded'.format(table_name))
+        for search_table, _, _ in TAG_SEARCH_TABLES:
+            c.execute('DROP TABLE IF EXISTS %s' % search_table)
+        for query in CREATE_TABLE_QUERIES:
+            c.execute(query)
+        for lookup_table, column in DICTIONARIES:
+            sources = ['SELECT {0} AS value FROM {1}_unencoded'.format(field, table_name)
+                       for table_name, (_, encoded) in sorted(ENCODED_TABLES.items())
+                       for field, table in encoded.items() if table == lookup_table]
+            c.execute('INSERT INTO {0}({1}) SELECT value FROM ({2}) WHERE value IS NOT NULL'.format(
+                lookup_table, column, ' UNION '.join(sources)))
+        for table_name, fields in TABLES:
+            if table_name not in ENCODED_TABLES:
+                c.execute('INSERT INTO {0} SELECT * FROM {0}_unencoded'.format(table_name))
+                continue
+            stored_table, encoded = ENCODED_TABLES[table_name]
+            c.execute('INSERT INTO {0}({1}) SELECT {2} FROM {3}_unencoded t {4}'.format(
+                stored_table, ', '.join(stored_fields(table_name, fields)),
+                ', '.join(encoded[field] + '.id' if field in encoded else 't.' + field for field in fields),
+                table_name,
+                ' '.join('LEFT JOIN {0} ON {0}.{1} = t.{2}'.format(encoded[field], lookup_column[encoded[field]], field)
+                         for field in fields if field in encoded)))
+        for table_name, _ in TABLES:
+            c.execute('DROP TABLE {0}_unencoded'.format(table_name))
+        for query in VIEW_QUERIES:
+            c.execute(query)
+    if tag_search:
+        build_tag_search(conn)
+
+
+# Secondary indexes are built only once the tables are loaded: inserting into an indexed
+# table costs a b-tree update per row per index, sorting a full table once is far cheaper.
+INDEX_QUERIES = [
+    ('node_tag_data_id', 'CREATE INDEX IF NOT EXISTS node_tag_data_id ON node_tag_data(id)'),
+    ('node_tag_data_key_value', 'CREATE INDEX IF NOT EXISTS node_tag_data_key_value ON node_tag_data(key_id, value)'),
+    ('way_tag_data_id', 'CREATE INDEX IF NOT EXISTS way_tag_data_id ON way_tag_data(id)'),
+    ('way_tag_data_key_value', 'CREATE INDEX IF NOT EXISTS way_tag_data_key_value ON way_tag_data(key_id, value)'),
+    ('way_nodes_id', 'CREATE INDEX IF NOT EXISTS way_nodes_id ON way_nodes(id)'),
+    ('way_nodes_node_id_id', 'CREATE INDEX IF NOT EXISTS way_nodes_node_id_id ON way_nodes(node_id, id)'),
+]
+
+# Drop the secondary indexes before a bulk load
+def drop_indexes(conn):
+    for name, _ in INDEX_QUERIES:
+        conn.execute('DROP INDEX IF EXISTS %s' % name)
+    conn.commit()
 
+# Build the secondary indexes and refresh the planner statistics after a bulk load
+def build_indexes(conn):
+    """Create INDEX_QUERIES then ANALYZE, returning [(name, seconds)] for each step"""
+    timings = []
+    for name, create_index_query in INDEX_QUERIES + [('ANALYZE', 'ANALYZE')]:
+        start = time.time()
+        conn.execute(create_index_query)
+        conn.commit()
+        timings.append((name, time.time() - start))
+        print "{0}: {1:.1f}s".format(name, timings[-1][1])
+    return timings
+
+# SQLite cannot add foreign keys to a loaded table and does not enforce the declared ones
+# unless PRAGMA foreign_keys is on, so they are checked once after the load instead.
+def check_foreign_keys(conn):
+    """Return {(table, parent): number of rows whose foreign key has no parent row}"""
+    violations = {}
+    for table, _, parent, _ in conn.execute('PRAGMA foreign_key_check'):
+        violations[(table, parent)] = violations.get((table, parent), 0) + 1
+    for (table, parent), count in sorted(violations.items()):
+        print "{0}: {1} rows reference a missing {2}".format(table, count, parent)
+    return violations
+
+# Rows inserted per transaction by add_into_table and SqliteSink
+BATCH_SIZE = 50000
+# Settings used only while bulk loading: no fsync, in-memory rollback journal and a 200MB page cache.
+# A crash in the middle of a transaction will likely corrupt a db loaded this way, so they are
+# only for loads that start over anyway.
+LOAD_PRAGMAS = (('journal_mode', 'MEMORY'), ('synchronous', 'OFF'), ('cache_size', -200000))
+# Settings for loads that save an ImportCheckpoint: a crash, kill or power loss then at worst
+# loses the last transactions, and the checkpoint saved with them, but leaves the db intact.
+RESUMABLE_LOAD_PRAGMAS = (('journal_mode', 'WAL'), ('synchronous', 'NORMAL'), ('cache_size', -200000))
+
+
+@contextlib.contextmanager
+def tuned_for_load(conn, resumable=False):
+    """Apply LOAD_PRAGMAS (RESUMABLE_LOAD_PRAGMAS if resumable) to conn for the duration of a bulk load, then restore them"""
+    pragmas = RESUMABLE_LOAD_PRAGMAS if resumable else LOAD_PRAGMAS
+    conn.commit()
+    previous = [(name, conn.execute('PRAGMA %s' % name).fetchone()[0]) for name, _ in pragmas]
+    for name, value in pragmas:
+        conn.execute('PRAGMA %s = %s' % (name, value))
+    try:
+        yield conn
+    finally:
+        conn.commit()
+        for name, value in previous:
+            conn.execute('PRAGMA %s = %s' % (name, value))
+
+
+@contextlib.contextmanager
+def explicit_transactions(conn):
+    """Switch off the sqlite3 module's implicit transactions for the duration of the block.
+
+    Setting isolation_level to None commits any open transaction, so it is only touched
+    when it is not None already.
+    """
+    isolation_level = conn.isolation_level
+    if isolation_level is None:
+        yield
+        return
+    conn.isolation_level = None
+    try:
+        yield
+    finally:
+        conn.isolation_level = isolation_level
+
+
+@contextlib.contextmanager
+def transaction(conn):
+    """Run the block in one explicit transaction on conn and yield a cursor"""
+    with explicit_transactions(conn):
+        c = conn.cursor()
+        c.execute('BEGIN')
+        try:
+            yield c
+            c.execute('COMMIT')
+        except:
+            c.execute('ROLLBACK')
+            raise
+
+
+def insert_query(table_name, fields):
+    return "INSERT INTO {0}({1}) VALUES ({2})".format(
+        table_name, ', '.join('"%s"' % x for x in fields), ', '.join('?' * len(fields)))
+
+
+class Dictionary(object):
+    """In-memory copy of one lookup table of DICTIONARIES, so rows are encoded without queries.
+
+    encode() hands out the next id for a string it has not seen; the new entries are written
+    by flush(), which the loaders call before inserting rows that may use them. Inside a
+    transaction the written entries are kept until committed(); rolled_back() queues them to
+    be written again, since the ids stay handed out.
+    """
+
+    def __init__(self, conn, table_name, column):
+        self.ids = dict((value, value_id) for value_id, value in
+                        conn.execute('SELECT id, {0} FROM {1}'.format(column, table_name)))
+        self.next_id = max(self.ids.values() or [0]) + 1
+        self.query_string = insert_query(table_name, ['id', column])
+        self.pending = []
+        self.uncommitted = []
+
+    def encode(self, value):
+        if value is None:
+            return None
+        value_id = self.ids.get(value)
+        if value_id is None:
+            value_id = self.ids[value] = self.next_id
+            self.next_id += 1
+            self.pending.append((value_id, value))
+        return value_id
+
+    def flush(self, c):
+        if self.pending:
+            c.executemany(self.query_string, self.pending)
+            self.uncommitted.extend(self.pending)
+            self.pending = []
+
+    def committed(self):
+        self.uncommitted = []
+
+    def rolled_back(self):
+        self.pending = self.uncommitted + self.pending
+        self.uncommitted = []
+
+
+def load_dictionaries(conn):
+    """{lookup table: Dictionary} for every table of DICTIONARIES"""
+    return dict((table_name, Dictionary(conn, table_name, column)) for table_name, column in DICTIONARIES)
+
+
+@contextlib.contextmanager
+def encoding_transaction(conn, dictionaries):
+    """transaction() for rows encoded with dictionaries, a {lookup table: Dictionary}.
+
+    If it rolls back, the lookup entries written in it are written again by the next flush.
+    """
+    try:
+        with transaction(conn) as c:
+            yield c
+    except:
+        for dictionary in dictionaries.values():
+            dictionary.rolled_back()
+        raise
+    for dictionary in dictionaries.values():
+        dictionary.committed()
+
+
+class TableLoader(object):
+    """Insert rows into one table with executemany, one savepoint per batch.
+
+    A batch that fails is rolled back and retried row by row, and the rows sqlite refuses
+    are written with their error to rejects_path instead of stopping the load. Outside a
+    transaction each batch commits on its own; inside one it commits with it.
+
+    Rows of an ENCODED_TABLES table are encoded with dictionaries (by default loaded from the
+    db) and inserted into its stored table. Loaders sharing a connection should share them.
+    """
+
+    def __init__(self, conn, table_name, fields, rejects_path, dictionaries=None):
+        self.conn = conn
+        self.table_name = table_name
+        self.fields = list(fields)
+        self.rejects_path = rejects_path
+        self.rejects_file = None
+        self.encoders = []
+        if table_name in ENCODED_TABLES:
+            stored_table, encoded = ENCODED_TABLES[table_name]
+            if dictionaries is None:
+                dictionaries = load_dictionaries(conn)
+            self.encoders = [(self.fields.index(field), dictionaries[encoded[field]])
+                             for field in self.fields if field in encoded]
+            self.query_string = insert_query(stored_table, stored_fields(table_name, self.fields))
+        else:
+            self.query_string = insert_query(table_name, fields)
+        self.loaded = self.rejected = 0
+        # time spent in insert(), so tables loaded side by side each get their own rate
+        self.seconds = 0.0
+
+    def encode(self, batch):
+        if not self.encoders:
+            return batch
+        # a column at a time, with the known strings looked up inline
+        rows = map(list, batch)
+        for position, dictionary in self.encoders:
+            ids = dictionary.ids
+            for row in rows:
+                value = row[position]
+                row[position] = ids[value] if value in ids else dictionary.encode(value)
+        return rows
+
+    def insert(self, batch):
+        start = time.time()
+        try:
+            rows = self.encode(batch)
+            with explicit_transactions(self.conn):
+                c = self.conn.cursor()
+                # outside the savepoint: the lookup entries must outlive a rolled back batch
+                for _, dictionary in self.encoders:
+                    dictionary.flush(c)
+                c.execute('SAVEPOINT load_batch')
+                try:
+                    c.executemany(self.query_string, rows)
+                    c.execute('RELEASE load_batch')
+                    self.loaded += len(batch)
+                    return
+                except sqlite3.Error:
+                    c.execute('ROLLBACK TO load_batch')
+
+                for row, encoded_row in zip(batch, rows):
+                    try:
+                        c.execute(self.query_string, encoded_row)
+                        self.loaded += 1
+                    except sqlite3.Error as e:
+                        self.reject(row, e)
+                c.execute('RELEASE load_batch')
+        finally:
+            self.seconds += time.time() - start
+
+    def reject(self, row, error):
+        if self.rejects_file is None:
+            self.rejects_file = open(self.rejects_path, 'wb')
+            self.rejects_writer = csv.writer(self.rejects_file)
+            self.rejects_writer.writerow(self.fields + ['error'])
+        self.rejects_writer.writerow(
+            [x.encode('utf-8') if isinstance(x, unicode) else x for x in row] + [str(error)])
+        self.rejected += 1
+
+    def close(self):
+        """Close the reject file, print the insert rate and return (loaded, rejected)"""
+        if self.rejects_file is not None:
+            self.rejects_file.close()
+        print "{0}: {1} rows in {2:.1f}s ({3:.0f} rows/sec), {4} rejected".format(
+            self.table_name, self.loaded, self.seconds, self.loaded / self.seconds if self.seconds else 0,
+            self.rejected)
+        return self.loaded, self.rejected
+
+
+def rejects_path_for(table_name):
+    """Reject csv used for table_name when loading straight from the OSM file"""
+    return os.path.join(os.path.dirname(NODES_PATH), table_name + '_rejects.csv')
+
+
+def sql_value(value):
+    """sqlite only binds unicode text, so the utf-8 encoded strings from shape_element are decoded"""
+    return value.decode('utf-8') if isinstance(value, str) else value
+
+
+# Turn a csv field into the value sql_value gives for the shaped record, for each column type
+SQL_CONVERTERS = dict(COLUMN_CONVERTERS, string=sql_value)
+
+
+def element_rows(el):
+    """Yield (table name, row of sql values) for every row of a shaped element"""
+    if isinstance(el, ShapedNode):
+        yield 'node', map(sql_value, el.node)
+        for tag in el.node_tags:
+            yield 'node_tags', map(sql_value, tag)
+    else:
+        yield 'way', map(sql_value, el.way)
+        for way_node in el.way_nodes:
+            yield 'way_nodes', map(sql_value, way_node)
+        for tag in el.way_tags:
+            yield 'way_tags', map(sql_value, tag)
+
+
+class SqliteSink(object):
+    """Stream shaped elements into the sqlite tables.
+
+    Rows are buffered and written once batch_size of them are pending, so memory stays
+    bounded whatever the size of the OSM file. All tables are written in one transaction per
+    batch, together with the checkpoint if there is one, and only between elements.
+    """
+    name = 'sqlite'
+    # sqlite3 connections can only be used from the thread that opened them, see shape_pipelined
+    thread_bound = True
+
+    def __init__(self, conn, batch_size=BATCH_SIZE, checkpoint=None):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.checkpoint = checkpoint
+        self.loaders = {}
+        self.pending = {}
+        self.pending_rows = 0
+        self.dictionaries = load_dictionaries(conn)
+        for table_name, fields in TABLES:
+            self.loaders[table_name] = TableLoader(conn, table_name, fields, rejects_path_for(table_name),
+                                                   self.dictionaries)
+            self.pending[table_name] = []
+
+    def add(self, el):
+        for table_name, row in element_rows(el):
+            self.pending[table_name].append(row)
+            self.pending_rows += 1
+        if self.pending_rows >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        # the rows stay pending until they are committed, so a rolled back flush is retried by
+        # the next one (close() included) instead of saving a checkpoint past rows not loaded
+        with encoding_transaction(self.conn, self.dictionaries):
+            for table_name, _ in TABLES:
+                if self.pending[table_name]:
+                    self.loaders[table_name].insert(self.pending[table_name])
+            if self.checkpoint is not None:
+                self.checkpoint.save(self.conn)
+        for table_name, _ in TABLES:
+            self.pending[table_name] = []
+        self.pending_rows = 0
+
+    def add_shard(self, shard_paths, end):
+        """Load a set of headerless shard csvs in one transaction and move the checkpoint to end"""
+        position = (self.checkpoint.byte_offset, self.checkpoint.last) if self.checkpoint is not None else None
+        try:
+            with encoding_transaction(self.conn, self.dictionaries):
+                for (table_name, _), shard_path in zip(TABLES, shard_paths):
+                    with open(shard_path, 'rb') as shard:
+                        for batch in csv_batches(csv.reader(shard), self.batch_size, COLUMN_TYPES[table_name]):
+                            self.loaders[table_name].insert(batch)
+                if self.checkpoint is not None:
+                    self.checkpoint.byte_offset = end
+                    self.checkpoint.last = None
+                    self.checkpoint.save(self.conn)
+        except:
+            # the shard was rolled back, so the checkpoint must not move past it
+            if self.checkpoint is not None:
+                self.checkpoint.byte_offset, self.checkpoint.last = position
+            raise
+
+    def close(self):
+        self.flush()
+        for table_name, _ in TABLES:
+            self.loaders[table_name].close()
+
+
+def csv_batches(reader, batch_size, types=None):
+    """Yield lists of up to batch_size rows from reader, decoded to unicode for sqlite.
+
+    With types, the COLUMN_TYPES of the table, every field is converted to its column's type
+    instead, so the rows are bound exactly like the shaped records they were written from
+    rather than left to sqlite's own (not always correctly rounded) text to number conversion.
+    """
+    if types is None:
+        convert_row = lambda row: [x.decode('utf-8') for x in row]
+    else:
+        converters = [SQL_CONVERTERS[type_name] for type_name in types]
+        convert_row = lambda row: [convert(x) for convert, x in zip(converters, row)]
+    batch = []
+    for row in reader:
+        batch.append(convert_row(row))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 
-conn = sqlite3.connect('bengaluru_map.db')
-# Create tables for each csv file
-# Node
-create_table_query = '''CREATE TABLE IF NOT EXISTS node(id INTEGER, lat REAL, lon REAL, user STRING, uid INTEGER,
-                    version STRING, changeset INTEGER, timestamp STRING, PRIMARY KEY(id ASC))'''
-create_table(create_table_query,conn)
-
-# Node_tags
-conn = sqlite3.connect('bengaluru_map.db')
-create_table_query = '''CREATE TABLE IF NOT EXISTS node_tags(id INTEGER, key STRING, value STRING, type STRING,
-                    FOREIGN KEY(id) REFERENCES node(id))'''
-create_table(create_table_query,conn)
-# way
-create_table_query = '''CREATE TABLE IF NOT EXISTS way(id INTEGER, user STRING, uid INTEGER, version STRING,
-                    changeset INTEGER, timestamp STRING, PRIMARY KEY(id ASC))'''
-create_table(create_table_query,conn)
-
-# way_nodes
-create_table_query = '''CREATE TABLE IF NOT EXISTS way_nodes(id INTEGER, node_id INTEGER, position INTEGER, 
-                    FOREIGN KEY(id) REFERENCES way(id), FOREIGN KEY(node_id) REFERENCES node(id))'''
-create_table(create_table_query,conn)
-
-# way_tags
-create_table_query = '''CREATE TABLE IF NOT EXISTS way_tags(id INTEGER, key STRING, value STRING, type STRING,
-                    FOREIGN KEY(id) REFERENCES way(id))'''
-create_table(create_table_query,conn)
-
-conn.close()
-
-
-# Build connection
-conn = sqlite3.connect('bengaluru_map.db')
-c = conn.cursor()
-# Add data into table:
-# Node
-add_into_table("bangalore/node.csv")
-# Node_tags
-add_into_table("bangalore/node_tags.csv")
-# way
-add_into_table("bangalore/way.csv")
-# way_nodes
-add_into_table("bangalore/way_nodes.csv")
-# way_tags
-add_into_table("bangalore/way_tags.csv")
-conn.close()
-
-
-# QUERIES
-print "Few information Queried from the db"
-
-print "1. No of node tags written in kannada."
-conn = sqlite3.connect('bengaluru_map.db')
-c = conn.cursor()
-result = c.execute("SELECT COUNT(*) FROM node_tags WHERE key LIKE '%:kn%'")
-for row in result:
-    print row
-conn.close()
-
-
-print "2. No of way tags written in kannada."
-conn = sqlite3.connect('bengaluru_map.db')
-c = conn.cursor()
-result = c.execute("SELECT COUNT(*) FROM way_tags WHERE key LIKE '%:kn%'")
-for row in result:
-    print row
-conn.close()
-
-
-
-# USED CODE FROM THE SAMEPLE CODE GIVEN IN https://gist.github.com/carlward/54ec1c91b62a5f911c42#map-area
-# Questions - Most popular Amenities in bangalore
-print "3. Most popular aminities in bangalore"
-conn = sqlite3.connect('bengaluru_map.db')
-c = conn.cursor()
-result = c.execute("SELECT value,count(*) FROM node_tags WHERE key LIKE '%amenity%' GROUP BY value ORDER BY count(*) DESC LIMIT 10")
-for row in result:
-    print row
-conn.close()
-
-
-# MODIFIED CODE FROM THE SAMEPLE CODE GIVEN IN https://gist.github.com/carlward/54ec1c91b62a5f911c42#map-area
-# Questions - Most popular Banks in India
-
-print "4. Most popular bank in Bangalore"
-conn = sqlite3.connect('bengaluru_map.db')
-c = conn.cursor()
-result = c.execute("SELECT node_tags.value, COUNT(*) as num FROM node_tags,(SELECT DISTINCT(id) FROM node_tags WHERE value LIKE '%bank%') as banknodes ON node_tags.id=banknodes.id WHERE node_tags.key IN ('name','operator','brand') AND node_tags.value LIKE '%bank%' GROUP BY node_tags.value ORDER BY num DESC LIMIT 10")
-for row in result:
-    print row
-conn.close()
-
-
-# USED CODE FROM THE SAMEPLE CODE GIVEN IN https://gist.github.com/carlward/54ec1c91b62a5f911c42#map-area
-# Questions - Food in bangalore - The more popular cuisines
-print "5. Popular cuisines in bangalore"
-conn = sqlite3.connect('bengaluru_map.db')
-c = conn.cursor()
-result = c.execute("SELECT value,count(*) as quantity FROM node_tags,(SELECT DISTINCT(id) FROM node_tags WHERE value IN ('restaurant','cafe','fast_food')) as foodnodes ON node_tags.id=foodnodes.id WHERE key IN ('cuisine') GROUP BY value ORDER BY quantity DESC LIMIT 10")
-# u'cuisine'
-# result=c.execute("SELECT DISTINCT(id) FROM node_tags WHERE value IN ('restaurant','cafe','fast_food')")
-for row in result:
-    print row
-conn.close()
-
-
-print "Top nodes with highest number of intersection."
-
-conn = sqlite3.connect('bengaluru_map.db')
-c = conn.cursor()
-node_through_which_highest_way_pass = "(SELECT node_id,count(*) FROM way_nodes GROUP BY node_id ORDER BY count(*) DESC LIMIT 10) as busy_nodes"
-info_about_that_node = "SELECT id FROM node,"+node_through_which_highest_way_pass+" ON busy_nodes.node_id=node.id WHERE node.id=busy_nodes.node_id "
-result = c.execute(info_about_that_node)
-op=[]
-for row in result:
-    op.append(row[0])
-conn.close()
-print op
-
-print "To find out more about these nodes, we investigated further. We find no node tags."
-tags_of_those_nodes = "SELECT * FROM node_tags,("+info_about_that_node+") as main_nodes WHERE main_nodes.id=node_tags.id"
-conn = sqlite3.connect('bengaluru_map.db')
-c = conn.cursor()
-result = c.execute(tags_of_those_nodes)
-for row in result:
-    print row
-conn.close()
-
-
-print "ADDITIONAL STATISTICS"
-
-print "Number of nodes: 2882959"
-conn = sqlite3.connect('bengaluru_map.db')
-c = conn.cursor()
-result = c.execute("SELECT COUNT(*) FROM node")
-for row in result:
-    print row
-conn.close()
-print "Number of node_tags: 93243"
-conn = sqlite3.connect('bengaluru_map.db')
-c = conn.cursor()
-result = c.execute("SELECT COUNT(*) FROM node_tags")
-for row in result:
-    print row
-conn.close()
-print "Number of ways: 660784"
-conn = sqlite3.connect('bengaluru_map.db')
-c = conn.cursor()
-result = c.execute("SELECT COUNT(*) FROM way")
-for row in result:
-    print row
-conn.close()
-print "Number of way_nodes: 3576371"
-conn = sqlite3.connect('bengaluru_map.db')
-c = conn.cursor()
-result = c.execute("SELECT COUNT(*) FROM way_nodes")
-for row in result:
-    print row
-conn.close()
-print "Number of way_tags: 723631"
-conn = sqlite3.connect('bengaluru_map.db')
-c = conn.cursor()
-result = c.execute("SELECT COUNT(*) FROM way_tags")
-for row in result:
-    print row
-conn.close()
-
-
-# USED CODE FROM THE SAMEPLE CODE GIVEN IN https://gist.github.com/carlward/54ec1c91b62a5f911c42#map-area
-print "# OF UNIQUE USERS "
-conn = sqlite3.connect('bengaluru_map.db')
-c = conn.cursor()
-result = c.execute("SELECT COUNT(DISTINCT(e.uid)) FROM (SELECT uid FROM node UNION ALL SELECT uid FROM way) e")
-for row in result:
-    print row[0]
-conn.close()
-
-
-# USED CODE FROM THE SAMEPLE CODE GIVEN IN https://gist.github.com/carlward/54ec1c91b62a5f911c42#map-area
-print "Highest contributing user"
-conn = sqlite3.connect('bengaluru_map.db')
-c = conn.cursor()
-result = c.execute("SELECT e.user, COUNT(*) as num FROM (SELECT user FROM node UNION ALL SELECT user FROM way) e GROUP BY e.user ORDER BY num DESC LIMIT 10")
-for row in result:
-    print row
-conn.close()
+# adds each row of csv into sql table
+def add_into_table(csv_file, conn, batch_size=BATCH_SIZE, progress=None):
+    """Bulk load an existing csv into the table of the same name, returning (loaded, rejected).
 
+    progress, an ImportProgress (say with unit='rows'), gets the rows and the insert time.
+    """
+    table_name = os.path.splitext(os.path.basename(csv_file))[0]
+    with open(csv_file, "rb") as f:
+        reader = csv.reader(f)
+        header = reader.next()
+        loader = TableLoader(conn, table_name, header, os.path.splitext(csv_file)[0] + '_rejects.csv')
+        for batch in csv_batches(reader, batch_size):
+            if progress is None:
+                loader.insert(batch)
+                continue
+            with progress.stage('add_into_table ' + table_name):
+                loader.insert(batch)
+            progress.advance(len(batch))
+    return loader.close()
+
+
+# SUMMARY TABLES
+# The reports only need a handful of aggregates, so these are computed once after the load and
+# kept up to date by apply_changes, instead of every report rescanning the big tables.
+
+# amenity values are stored with '_' replaced by ' ', see replace_underscores
+FOOD_VALUES = "('restaurant','cafe','fast food')"
+
+# (table, CREATE query, queries that fill it from the loaded tables)
+SUMMARY_TABLES = [
+    # How often each tag key/value pair occurs on nodes and on ways
+    ('tag_counts',
+     '''CREATE TABLE tag_counts(element STRING, key STRING, value STRING, count INTEGER,
+     PRIMARY KEY(element, key, value))''',
+     ["INSERT INTO tag_counts SELECT 'node', tag_keys.key, value, COUNT(*) FROM node_tag_data "
+      "LEFT JOIN tag_keys ON tag_keys.id = key_id GROUP BY key_id, value",
+      "INSERT INTO tag_counts SELECT 'way', tag_keys.key, value, COUNT(*) FROM way_tag_data "
+      "LEFT JOIN tag_keys ON tag_keys.id = key_id GROUP BY key_id, value"]),
+    # Nodes and ways last edited by each user
+    ('user_edit_counts',
+     '''CREATE TABLE user_edit_counts(uid INTEGER, user STRING, nodes INTEGER, ways INTEGER,
+     PRIMARY KEY(uid, user))''',
+     ['''INSERT INTO user_edit_counts SELECT uid, users.name, SUM(nodes), SUM(ways) FROM
+     (SELECT uid, user_id, 1 AS nodes, 0 AS ways FROM node_data UNION ALL SELECT uid, user_id, 0, 1 FROM way_data)
+     LEFT JOIN users ON users.id = user_id GROUP BY uid, user_id''']),
+    # Number of way_nodes rows referencing each node, i.e. how many ways pass through it
+    ('node_degree',
+     'CREATE TABLE node_degree(node_id INTEGER, degree INTEGER, PRIMARY KEY(node_id))',
+     ['INSERT INTO node_degree SELECT node_id, COUNT(*) FROM way_nodes GROUP BY node_id',
+      'CREATE INDEX node_degree_degree ON node_degree(degree)']),
+    # Rows in each of the loaded tables
+    ('table_counts',
+     'CREATE TABLE table_counts(name STRING, rows INTEGER, PRIMARY KEY(name))',
+     ["INSERT INTO table_counts SELECT '{0}', COUNT(*) FROM {0}".format(table_name)
+      for table_name, _ in TABLES]),
+    # Cuisine values of the restaurant, cafe and fast food nodes
+    ('cuisine_counts',
+     'CREATE TABLE cuisine_counts(value STRING, count INTEGER, PRIMARY KEY(value))',
+     ['''INSERT INTO cuisine_counts SELECT value, COUNT(*) FROM node_tags,
+     (SELECT DISTINCT(id) FROM node_tags WHERE value IN ''' + FOOD_VALUES + ''') AS food_nodes
+     ON node_tags.id = food_nodes.id WHERE key = 'cuisine' GROUP BY value''']),
+]
+
+# Statements that add (sign 1) or remove (sign -1) the rows an element currently has in the db
+# to or from the summaries. Each takes (sign, id). They are upserts, which need SQLite 3.24;
+# with an older one apply_changes rebuilds the summaries instead.
+UPSERT_SQLITE = (3, 24, 0)
+SUMMARY_DELTAS = {
+    'node': [
+        '''INSERT INTO tag_counts SELECT 'node', key, value, ? FROM node_tags WHERE id = ?
+        ON CONFLICT(element, key, value) DO UPDATE SET count = count + excluded.count''',
+        '''INSERT INTO user_edit_counts SELECT uid, user, ?, 0 FROM node WHERE id = ?
+        ON CONFLICT(uid, user) DO UPDATE SET nodes = nodes + excluded.nodes''',
+        '''INSERT INTO cuisine_counts SELECT value, ? FROM node_tags WHERE id = ? AND key = 'cuisine'
+        AND EXISTS (SELECT 1 FROM node_tags food WHERE food.id = node_tags.id AND food.value IN ''' + FOOD_VALUES + ''')
+        ON CONFLICT(value) DO UPDATE SET count = count + excluded.count''',
+        "UPDATE table_counts SET rows = rows + ? * (SELECT COUNT(*) FROM node WHERE id = ?) WHERE name = 'node'",
+        "UPDATE table_counts SET rows = rows + ? * (SELECT COUNT(*) FROM node_tags WHERE id = ?) WHERE name = 'node_tags'",
+    ],
+    'way': [
+        '''INSERT INTO tag_counts SELECT 'way', key, value, ? FROM way_tags WHERE id = ?
+        ON CONFLICT(element, key, value) DO UPDATE SET count = count + excluded.count''',
+        '''INSERT INTO user_edit_counts SELECT uid, user, 0, ? FROM way WHERE id = ?
+        ON CONFLICT(uid, user) DO UPDATE SET ways = ways + excluded.ways''',
+        '''INSERT INTO node_degree SELECT node_id, ? FROM way_nodes WHERE id = ?
+        ON CONFLICT(node_id) DO UPDATE SET degree = degree + excluded.degree''',
+        "UPDATE table_counts SET rows = rows + ? * (SELECT COUNT(*) FROM way WHERE id = ?) WHERE name = 'way'",
+        "UPDATE table_counts SET rows = rows + ? * (SELECT COUNT(*) FROM way_nodes WHERE id = ?) WHERE name = 'way_nodes'",
+        "UPDATE table_counts SET rows = rows + ? * (SELECT COUNT(*) FROM way_tags WHERE id = ?) WHERE name = 'way_tags'",
+    ],
+}
+# Summary rows that changes have brought down to zero
+SUMMARY_CLEANUP = [
+    'DELETE FROM tag_counts WHERE count <= 0',
+    'DELETE FROM user_edit_counts WHERE nodes <= 0 AND ways <= 0',
+    'DELETE FROM node_degree WHERE degree <= 0',
+    'DELETE FROM cuisine_counts WHERE count <= 0',
+]
+
+
+# (Re)build the summary tables from the loaded tables, after build_indexes. The big GROUP BYs
+# group the stored tables by id and look each string up once per group.
+def build_summaries(conn):
+    """Fill SUMMARY_TABLES from scratch, returning [(table, seconds)]"""
+    timings = []
+    for table_name, create_query, fill_queries in SUMMARY_TABLES:
+        start = time.time()
+        with transaction(conn) as c:
+            c.execute('DROP TABLE IF EXISTS %s' % table_name)
+            c.execute(create_query)
+            for fill_query in fill_queries:
+                c.execute(fill_query)
+        timings.append((table_name, time.time() - start))
+        print "{0}: {1:.1f}s".format(table_name, timings[-1][1])
+    return timings
+
+
+def has_summaries(conn):
+    """True if build_summaries has been run on this db"""
+    names = [table_name for table_name, _, _ in SUMMARY_TABLES]
+    query = 'SELECT COUNT(*) FROM sqlite_master WHERE type = ? AND name IN (%s)' % ','.join('?' * len(names))
+    return conn.execute(query, ['table'] + names).fetchone()[0] == len(names)
+
+
+def update_summaries(c, tag, element_id, sign):
+    """Add (sign 1) or remove (sign -1) element's current rows to or from the summary tables"""
+    for delta_query in SUMMARY_DELTAS[tag]:
+        c.execute(delta_query, (sign, element_id))
+
+
+# TAG SEARCH
+# Full text indexes over the tag keys and values, so substring searches like LIKE '%bank%' use
+# an index instead of scanning node_tags and way_tags. They are external content FTS5 tables
+# (the text stays in the tag tables, the index refers to their rowids) with the trigram
+# tokenizer, which matches any substring of 3 or more characters case-insensitively.
+# The tag views do not expose the stored rows' rowids, so the index reads its content through
+# a view that does (tag_rowid).
+# VACUUM may renumber the tag tables' rowids, so run build_tag_search again after one.
+# The trigram tokenizer needs SQLite 3.34; with an older one there is no index and search_tags
+# scans the tag tables with LIKE.
+
+# Oldest SQLite with the FTS5 trigram tokenizer
+TAG_SEARCH_SQLITE = (3, 34, 0)
+
+# (fts table, tag table, element)
+TAG_SEARCH_TABLES = [('node_tag_search', 'node_tags', 'node'), ('way_tag_search', 'way_tags', 'way')]
+
+# Content view of each fts table, by (fts table, stored tag table)
+TAG_SEARCH_CONTENT = '''CREATE VIEW IF NOT EXISTS {0}_content AS SELECT t.rowid AS tag_rowid, t.id AS id,
+tag_keys.key AS key, t.value AS value FROM {1} t LEFT JOIN tag_keys ON tag_keys.id = t.key_id'''
+
+# Statements that add an element's current tag rows to (sign 1) or remove them from (sign -1)
+# its search index, by (element, sign). Each takes (id,).
+TAG_SEARCH_ADD = 'INSERT INTO {0}(rowid, id, key, value) SELECT tag_rowid, id, key, value FROM {0}_content WHERE id = ?'
+TAG_SEARCH_REMOVE = ("INSERT INTO {0}({0}, rowid, id, key, value) SELECT 'delete', tag_rowid, id, key, value "
+                     "FROM {0}_content WHERE id = ?")
+TAG_SEARCH_DELTAS = dict(((element_type, sign), query.format(search_table))
+                         for search_table, _, element_type in TAG_SEARCH_TABLES
+                         for sign, query in ((1, TAG_SEARCH_ADD), (-1, TAG_SEARCH_REMOVE)))
+
+
+# (Re)build the tag search indexes from the loaded tag tables
+def build_tag_search(conn):
+    """Create and fill TAG_SEARCH_TABLES from scratch, returning [(table, seconds)].
+
+    Does nothing but say so if this SQLite is older than TAG_SEARCH_SQLITE.
+    """
+    timings = []
+    if sqlite3.sqlite_version_info < TAG_SEARCH_SQLITE:
+        print "tag search needs SQLite {0} or later, not {1}: searches will scan the tag tables".format(
+            '.'.join(map(str, TAG_SEARCH_SQLITE)), sqlite3.sqlite_version)
+        return timings
+    for search_table, tags_table, _ in TAG_SEARCH_TABLES:
+        start = time.time()
+        with transaction(conn) as c:
+            c.execute('DROP TABLE IF EXISTS %s' % search_table)
+            c.execute(TAG_SEARCH_CONTENT.format(search_table, ENCODED_TABLES[tags_table][0]))
+            c.execute("CREATE VIRTUAL TABLE {0} USING fts5(id UNINDEXED, key, value, content='{0}_content', "
+                      "content_rowid='tag_rowid', tokenize='trigram')".format(search_table))
+            c.execute("INSERT INTO {0}({0}) VALUES ('rebuild')".format(search_table))
+        timings.append((search_table, time.time() - start))
+        print "{0}: {1:.1f}s".format(search_table, timings[-1][1])
+    return timings
+
+
+def has_tag_search(conn):
+    """True if build_tag_search has been run on this db"""
+    names = [search_table for search_table, _, _ in TAG_SEARCH_TABLES]
+    query = 'SELECT COUNT(*) FROM sqlite_master WHERE name IN (%s)' % ','.join('?' * len(names))
+    return conn.execute(query, names).fetchone()[0] == len(names)
+
+
+def update_tag_search(c, tag, element_id, sign):
+    """Add (sign 1) or remove (sign -1) element's current tag rows to or from its search index"""
+    c.execute(TAG_SEARCH_DELTAS[(tag, sign)], (element_id,))
+
+
+def search_tags(conn, text, keys=None, element=None):
+    """Return the sorted (element, id) of every node and way with a tag value containing text.
+
+    The match ignores case. keys restricts it to tags with one of these keys (as stored, e.g.
+    'name' or 'street'), element to 'node' or 'way'. Without the indexes (see build_tag_search)
+    the tag tables are scanned, and only ascii letters match regardless of case.
+    """
+    text = text.decode('utf-8') if isinstance(text, str) else text
+    indexed = has_tag_search(conn)
+    results = []
+    for search_table, tags_table, element_type in TAG_SEARCH_TABLES:
+        if element is not None and element != element_type:
+            continue
+        if indexed and len(text) >= 3:
+            query = 'SELECT DISTINCT id FROM {0} WHERE {0} MATCH ?'.format(search_table)
+            params = ['value : "%s"' % text.replace('"', '""')]
+        else:
+            # no index, or too short for a trigram, so the tag table is scanned
+            query = "SELECT DISTINCT id FROM {0} WHERE value LIKE ? ESCAPE '\\'".format(tags_table)
+            params = ['%' + re.sub(r'([%_\\])', r'\\\1', text) + '%']
+        if keys:
+            query += ' AND key IN (%s)' % ','.join('?' * len(keys))
+            params.extend(keys)
+        results.extend((element_type, element_id) for element_id, in conn.execute(query, params))
+    return sorted(results)
+
+
+# SPATIAL INDEX
+# An R*Tree over the node coordinates, so area and distance queries look up the nodes near a
+# point instead of scanning the whole node table. The R*Tree stores 32 bit floats rounded
+# outwards, so its hits are checked again against the exact lat/lon in node.
+
+# Great circle distances, the same the road graph measures its edges with
+EARTH_RADIUS = road_graph.EARTH_RADIUS
+distance = road_graph.distance
+METRES_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+NodeHit = namedtuple('NodeHit', ['id', 'lat', 'lon', 'distance', 'tags'])
+
+NODE_INDEX_DELTAS = {
+    1: 'INSERT INTO node_rtree SELECT id, lat, lat, lon, lon FROM node_data WHERE id = ?',
+    -1: 'DELETE FROM node_rtree WHERE id = ?',
+}
+
+
+# (Re)build the spatial index from the loaded node table
+def build_node_index(conn):
+    """Create and fill node_rtree from scratch, returning the seconds taken"""
+    start = time.time()
+    with transaction(conn) as c:
+        c.execute('DROP TABLE IF EXISTS node_rtree')
+        c.execute('CREATE VIRTUAL TABLE node_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)')
+        c.execute('INSERT INTO node_rtree SELECT id, lat, lat, lon, lon FROM node_data')
+    seconds = time.time() - start
+    print "node_rtree: {0:.1f}s".format(seconds)
+    return seconds
+
+
+def has_node_index(conn):
+    """True if build_node_index has been run on this db"""
+    return conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'node_rtree'").fetchone()[0] == 1
+
+
+def update_node_index(c, tag, element_id, sign):
+    """Add (sign 1) or remove (sign -1) a node's current position to or from node_rtree"""
+    if tag == 'node':
+        c.execute(NODE_INDEX_DELTAS[sign], (element_id,))
+
+
+def radius_bbox(lat, lon, metres):
+    """(min_lat, min_lon, max_lat, max_lon) of a box holding every point within metres of lat, lon"""
+    dlat = metres / METRES_PER_DEGREE
+    cos_lat = math.cos(math.radians(min(90.0, abs(lat) + dlat)))
+    dlon = 180.0 if cos_lat < 1e-9 else min(180.0, dlat / cos_lat)
+    return (max(-90.0, lat - dlat), max(-180.0, lon - dlon), min(90.0, lat + dlat), min(180.0, lon + dlon))
+
+
+def node_tags_of(conn, node_ids, chunk_size=500):
+    """Return {id: [Tag]} for node_ids"""
+    tags = dict((node_id, []) for node_id in node_ids)
+    node_ids = list(tags)
+    for i in range(0, len(node_ids), chunk_size):
+        chunk = node_ids[i:i + chunk_size]
+        query = 'SELECT id, key, value, type FROM node_tags WHERE id IN (%s)' % ','.join('?' * len(chunk))
+        for row in conn.execute(query, chunk):
+            tags[row[0]].append(Tag(*row))
+    return tags
+
+
+def nodes_in_bbox(conn, bbox, key=None, value=None, with_tags=True):
+    """Return a NodeHit (distance None) for every node inside bbox, in id order.
+
+    bbox is (min_lat, min_lon, max_lat, max_lon). key, and value, restrict the hits to nodes
+    with such a tag. Each hit carries all its node_tags unless with_tags is False.
+    """
+    min_lat, min_lon, max_lat, max_lon = bbox
+    query = '''SELECT node.id, node.lat, node.lon FROM node_rtree JOIN node ON node.id = node_rtree.id
+        WHERE node_rtree.max_lat >= ? AND node_rtree.min_lat <= ? AND node_rtree.max_lon >= ? AND node_rtree.min_lon <= ?
+        AND node.lat BETWEEN ? AND ? AND node.lon BETWEEN ? AND ?'''
+    params = [min_lat, max_lat, min_lon, max_lon, min_lat, max_lat, min_lon, max_lon]
+    if key is not None:
+        query += ' AND EXISTS (SELECT 1 FROM node_tags WHERE node_tags.id = node.id AND node_tags.key = ?'
+        params.append(key)
+        if value is not None:
+            query += ' AND node_tags.value = ?'
+            params.append(value)
+        query += ')'
+    rows = conn.execute(query + ' ORDER BY node.id', params).fetchall()
+    tags = node_tags_of(conn, [row[0] for row in rows]) if with_tags else {}
+    return [NodeHit(node_id, lat, lon, None, tags.get(node_id)) for node_id, lat, lon in rows]
+
+
+def nodes_within(conn, lat, lon, metres, key=None, value=None, with_tags=True):
+    """Return a NodeHit for every node within metres of lat, lon, nearest first"""
+    hits = []
+    for hit in nodes_in_bbox(conn, radius_bbox(lat, lon, metres), key, value, with_tags=False):
+        d = distance(lat, lon, hit.lat, hit.lon)
+        if d <= metres:
+            hits.append(hit._replace(distance=d))
+    hits.sort(key=lambda hit: (hit.distance, hit.id))
+    if with_tags:
+        tags = node_tags_of(conn, [hit.id for hit in hits])
+        hits = [hit._replace(tags=tags[hit.id]) for hit in hits]
+    return hits
+
+
+def nearest_nodes(conn, lat, lon, k, key=None, value=None, with_tags=True, start_metres=250.0):
+    """Return a NodeHit for each of the k nodes nearest to lat, lon, nearest first.
+
+    The search radius doubles from start_metres until it holds k nodes; the nodes inside a
+    radius are always nearer than any outside it, so the k nearest of those are the answer.
+    """
+    metres = start_metres
+    while True:
+        hits = nodes_within(conn, lat, lon, metres, key, value, with_tags=False)
+        if len(hits) >= k or metres > math.pi * EARTH_RADIUS:
+            break
+        metres *= 2
+    hits = hits[:k]
+    if with_tags:
+        tags = node_tags_of(conn, [hit.id for hit in hits])
+        hits = [hit._replace(tags=tags[hit.id]) for hit in hits]
+    return hits
+
+
+# INCREMENTAL IMPORT
+
+# OSM files hold all nodes, then all ways, then all relations, each sorted by id, so
+# (ELEMENT_RANK[tag], id) increases through the file.
+ELEMENT_RANK = {'node': 0, 'way': 1, 'relation': 2}
+
+
+class ImportCheckpoint(object):
+    """How far the import of osm_file into the db has got.
+
+    byte_offset is at or before the start of the first element not loaded yet, and last is
+    the (rank, id) of the last element loaded, or None if everything before byte_offset is
+    loaded and nothing after it. SqliteSink saves it in the same transaction as the rows.
+    """
+
+    def __init__(self, osm_file, byte_offset=0, last=None, complete=False):
+        self.osm_file = osm_file
+        self.byte_offset = byte_offset
+        self.last = last
+        self.complete = complete
+
+    @classmethod
+    def load(cls, conn, osm_file):
+        """The saved checkpoint of osm_file, or a fresh one if there is none or the file changed"""
+        row = conn.execute('SELECT file_size, byte_offset, element_type, element_id, complete '
+                           'FROM import_checkpoint WHERE osm_file = ?',
+                           (os.path.abspath(osm_file).decode('utf-8'),)).fetchone()
+        if row is None or row[0] != os.path.getsize(osm_file):
+            return cls(osm_file)
+        file_size, byte_offset, element_type, element_id, complete = row
+        last = (element_type, element_id) if element_id is not None else None
+        return cls(osm_file, byte_offset, last, bool(complete))
+
+    def save(self, conn):
+        element_type, element_id = self.last if self.last is not None else (None, None)
+        conn.execute('INSERT OR REPLACE INTO import_checkpoint VALUES (?, ?, ?, ?, ?, ?)',
+                     (os.path.abspath(self.osm_file).decode('utf-8'), os.path.getsize(self.osm_file),
+                      self.byte_offset, element_type, element_id, int(self.complete)))
+
+    def reader(self):
+        """Reader over the rest of the file, starting on an element boundary (a blob for pbf).
+
+        A compressed xml file is read from its start again.
+        """
+        osm_type = osm_input.osm_format(self.osm_file)
+        if osm_type == 'pbf':
+            return osm_input.PbfReader(self.osm_file, self.byte_offset)
+        if osm_type != 'xml':
+            return osm_input.DecompressingReader(self.osm_file)
+        with open(self.osm_file, 'rb') as osm:
+            end = osm_data_end(osm)
+            start = find_element_start(osm, self.byte_offset)
+        return ShardReader(self.osm_file, min(start, end) if start is not None else end, end)
+
+    def loaded(self, element):
+        """True if element is at or before the last element loaded"""
+        return self.last is not None and (ELEMENT_RANK[element.tag], int(element.attrib['id'])) <= self.last
+
+    def advance(self, element, byte_offset):
+        """Record element as the last element loaded; byte_offset is the reader's safe_offset as it was parsed"""
+        self.last = (ELEMENT_RANK[element.tag], int(element.attrib['id']))
+        self.byte_offset = byte_offset
+
+
+def get_changes(osc_file):
+    """Yield (action, OsmElement) for every node and way of an osmChange (.osc) file"""
+    context = ET.iterparse(osc_file, events=('start', 'end'))
+    _, root = next(context)
+    depth = 1
+    action = None
+    for event, elem in context:
+        if event == 'start':
+            depth += 1
+            if depth == 2:
+                action = elem
+            continue
+        depth -= 1
+        if depth == 2:
+            record = detach(elem) if elem.tag in ('node', 'way') else None
+            action.clear()
+            if record is not None:
+                yield action.tag, record
+        elif depth == 1:
+            root.clear()
 
 
+# Rows removed before an element is re-inserted (create/modify) or dropped (delete). They are
+# re-inserted through the views, whose triggers encode them.
+DELETE_QUERIES = {
+    'node': ['DELETE FROM node_tag_data WHERE id = ?', 'DELETE FROM node_data WHERE id = ?'],
+    'way': ['DELETE FROM way_tag_data WHERE id = ?', 'DELETE FROM way_nodes WHERE id = ?',
+            'DELETE FROM way_data WHERE id = ?'],
+}
+INSERT_QUERIES = dict((table_name, insert_query(table_name, fields)) for table_name, fields in TABLES)
+
+
+def apply_changes(osc_file, conn, batch_size=BATCH_SIZE):
+    """Apply an OSM change file to the db and return {(action, tag): count}.
+
+    create and modify are upserts: the element's rows in all its tables are replaced. delete
+    removes them. Changes are committed batch_size elements at a time. The summary tables, tag
+    search indexes and spatial index, if built, are updated in the same transactions (the
+    summaries are rebuilt at the end instead if this SQLite is older than UPSERT_SQLITE).
+    """
+    counts = {}
+    rebuild_summaries = has_summaries(conn) and sqlite3.sqlite_version_info < UPSERT_SQLITE
+    summaries = has_summaries(conn) and not rebuild_summaries
+    tag_search = has_tag_search(conn)
+    node_index = has_node_index(conn)
+    changes = get_changes(osc_file)
+    while True:
+        with transaction(conn) as c:
+            done = 0
+            for action, element in changes:
+                element_id = int(element.attrib['id'])
+                if summaries:
+                    update_summaries(c, element.tag, element_id, -1)
+                if tag_search:
+                    update_tag_search(c, element.tag, element_id, -1)
+                if node_index:
+                    update_node_index(c, element.tag, element_id, -1)
+                for delete_query in DELETE_QUERIES[element.tag]:
+                    c.execute(delete_query, (element_id,))
+                if action != 'delete':
+                    for table_name, row in element_rows(shape_element(element)):
+                        c.execute(INSERT_QUERIES[table_name], row)
+                    if summaries:
+                        update_summaries(c, element.tag, element_id, 1)
+                    if tag_search:
+                        update_tag_search(c, element.tag, element_id, 1)
+                    if node_index:
+                        update_node_index(c, element.tag, element_id, 1)
+                counts[(action, element.tag)] = counts.get((action, element.tag), 0) + 1
+                done += 1
+                if done == batch_size:
+                    break
+            if summaries:
+                for cleanup_query in SUMMARY_CLEANUP:
+                    c.execute(cleanup_query)
+        if done < batch_size:
+            break
+    if rebuild_summaries:
+        build_summaries(conn)
+    for (action, tag), count in sorted(counts.items()):
+        print "{0}: {1} {2} {3}".format(osc_file, action, count, tag)
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Clean the Bengaluru OSM extract into csvs and a SQLite db')
+    parser.add_argument('--osm', default=OSM_PATH, metavar='PATH',
+                        help='the OSM file to import: .osm, .osm.pbf, .osm.bz2 or .osm.gz (default %(default)s)')
+    parser.add_argument('--resume', action='store_true',
+                        help='carry on an interrupted import from its last checkpoint (no csvs are written). '
+                             'Unfiltered imports are loaded in WAL mode with synchronous=NORMAL, so that a '
+                             'crash leaves the db and its checkpoint intact; filtered imports cannot be resumed '
+                             'and are loaded with the faster journal_mode=MEMORY and synchronous=OFF')
+    parser.add_argument('--changes', nargs='+', metavar='OSC',
+                        help='apply these OSM change files to the db instead of a full import')
+    parser.add_argument('--bbox', nargs=4, type=float, metavar=('MIN_LAT', 'MIN_LON', 'MAX_LAT', 'MAX_LON'),
+                        help='only import the nodes inside this box and the ways through it')
+    parser.add_argument('--include-keys', nargs='+', metavar='KEY',
+                        help='only import elements with at least one of these tag keys')
+    parser.add_argument('--exclude-keys', nargs='+', metavar='KEY',
+                        help='do not import elements with any of these tag keys')
+    parser.add_argument('--columnar', choices=sorted(COLUMNAR_EXTENSIONS),
+                        help='also write the tables as parquet or arrow files next to the csvs (needs pyarrow)')
+    parser.add_argument('--validate', nargs='?', type=float, const=1.0, default=False, metavar='RATE',
+                        help='check the shaped elements against schema.py: all of them, or only the fraction '
+                             'RATE of them, evenly spread (e.g. 0.01)')
+    parser.add_argument('--rules', metavar='JSON',
+                        help='clean tag values with the rules in this json file instead of DEFAULT_RULES')
+    parser.add_argument('--road-graph', action='store_true',
+                        help='also save the graph of the highway ways to ' + GRAPH_PATH)
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='processes shaping the OSM file (default: one per cpu)')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='with --workers 1, parse, shape and write in threads of their own')
+    parser.add_argument('--progress', type=float, default=PROGRESS_INTERVAL, metavar='SECONDS',
+                        help='print the import progress every SECONDS, 0 for never (default %(default)s)')
+    parser.add_argument('--metrics', metavar='JSONL',
+                        help='append a json line with the progress and stage times to JSONL at every progress line')
+    parser.add_argument('--profile', choices=PROFILERS,
+                        help='profile the run (only the main process; use --workers 1 to profile the shaping)')
+    parser.add_argument('--profile-output', default='import.prof', metavar='PATH',
+                        help='where --profile saves the profile (default %(default)s)')
+    args = parser.parse_args()
+    if args.columnar and pyarrow is None:
+        parser.error('--columnar needs pyarrow')
+    if args.validate is not False and not 0 < args.validate <= 1:
+        parser.error('--validate RATE must be more than 0 and at most 1')
+    if args.rules:
+        CLEANING = load_rules(args.rules)
+    element_filter = None
+    if args.bbox or args.include_keys or args.exclude_keys:
+        element_filter = ElementFilter(args.bbox, args.include_keys, args.exclude_keys)
+
+    # CREATING A TABLE
+    conn = sqlite3.connect(DB_PATH)
+    create_tables(conn)
+
+    with profiled(args.profile, args.profile_output):
+        if args.changes:
+            for osc_file in args.changes:
+                apply_changes(osc_file, conn)
+        else:
+            if not args.resume:
+                clear_tables(conn)
+            drop_indexes(conn)
+
+            # Shape the OSM file straight into the tables, writing the csvs alongside
+            progress = ImportProgress(os.path.getsize(args.osm), args.progress or None, args.metrics)
+            with tuned_for_load(conn, resumable=element_filter is None):
+                process_map(args.osm, validate=args.validate, workers=args.workers, conn=conn,
+                            write_csv=not args.resume, resume=args.resume, element_filter=element_filter,
+                            columnar=args.columnar, progress=progress, pipelined=args.pipeline)
+                CLEANING.report()
+                for build in (build_indexes, build_summaries, build_tag_search, build_node_index):
+                    with progress.stage(build.__name__):
+                        build(conn)
+            with progress.stage('check_foreign_keys'):
+                check_foreign_keys(conn)
+            progress.close()
+    if args.road_graph:
+        road_graph.RoadGraph.from_db(conn).save(GRAPH_PATH)
+    # Dbs loaded before the summary tables existed, or only migrated by encode_tables, have none
+    report_list = reports.REPORTS if has_summaries(conn) else reports.SCAN_REPORTS
+    conn.close()
+
+
+    # QUERIES
+    print "Few information Queried from the db"
+    runner = reports.QueryRunner(DB_PATH)
+    try:
+        for result in runner.run_all(report_list):
+            reports.print_result(result)
+    finally:
+        runner.close()
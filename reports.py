@@ -0,0 +1,150 @@
+# Note: The reports of project.py, and a runner that keeps its sqlite connections open between
+# queries instead of opening a new one for every report.
+
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+# Settings for the read-only report connections: refuse writes, read the db through a 256MB
+# memory map and keep a 100MB page cache.
+READ_PRAGMAS = (('query_only', 1), ('mmap_size', 256 * 1024 * 1024), ('cache_size', -100000),
+                ('temp_store', 'MEMORY'))
+# Statements each connection keeps prepared, see sqlite3.connect
+CACHED_STATEMENTS = 200
+
+Report = namedtuple('Report', ['name', 'title', 'sql'])
+ReportResult = namedtuple('ReportResult', ['name', 'title', 'columns', 'rows', 'seconds'])
+
+# USED CODE FROM THE SAMEPLE CODE GIVEN IN https://gist.github.com/carlward/54ec1c91b62a5f911c42#map-area
+BUSY_NODES = "(SELECT node_id,count(*) FROM way_nodes GROUP BY node_id ORDER BY count(*) DESC LIMIT 10) as busy_nodes"
+BUSY_NODE_IDS = "SELECT id FROM node," + BUSY_NODES + " ON busy_nodes.node_id=node.id WHERE node.id=busy_nodes.node_id "
+
+# The reports as first written, scanning the loaded tables
+SCAN_REPORTS = [
+    Report('kannada_node_tags', "1. No of node tags written in kannada.",
+           "SELECT COUNT(*) FROM node_tags WHERE key LIKE '%:kn%'"),
+    Report('kannada_way_tags', "2. No of way tags written in kannada.",
+           "SELECT COUNT(*) FROM way_tags WHERE key LIKE '%:kn%'"),
+    Report('amenities', "3. Most popular aminities in bangalore",
+           "SELECT value,count(*) FROM node_tags WHERE key LIKE '%amenity%' GROUP BY value ORDER BY count(*) DESC LIMIT 10"),
+    Report('banks', "4. Most popular bank in Bangalore",
+           "SELECT node_tags.value, COUNT(*) as num FROM node_tags,(SELECT DISTINCT(id) FROM node_tags WHERE value LIKE '%bank%') as banknodes ON node_tags.id=banknodes.id WHERE node_tags.key IN ('name','operator','brand') AND node_tags.value LIKE '%bank%' GROUP BY node_tags.value ORDER BY num DESC LIMIT 10"),
+    Report('cuisines', "5. Popular cuisines in bangalore",
+           "SELECT value,count(*) as quantity FROM node_tags,(SELECT DISTINCT(id) FROM node_tags WHERE value IN ('restaurant','cafe','fast food')) as foodnodes ON node_tags.id=foodnodes.id WHERE key IN ('cuisine') GROUP BY value ORDER BY quantity DESC LIMIT 10"),
+    Report('busy_nodes', "Top nodes with highest number of intersection.", BUSY_NODE_IDS),
+    Report('busy_node_tags', "To find out more about these nodes, we investigated further. We find no node tags.",
+           "SELECT * FROM node_tags,(" + BUSY_NODE_IDS + ") as main_nodes WHERE main_nodes.id=node_tags.id"),
+    Report('nodes', "Number of nodes: 2882959", "SELECT COUNT(*) FROM node"),
+    Report('node_tags', "Number of node_tags: 93243", "SELECT COUNT(*) FROM node_tags"),
+    Report('ways', "Number of ways: 660784", "SELECT COUNT(*) FROM way"),
+    Report('way_nodes', "Number of way_nodes: 3576371", "SELECT COUNT(*) FROM way_nodes"),
+    Report('way_tags', "Number of way_tags: 723631", "SELECT COUNT(*) FROM way_tags"),
+    Report('unique_users', "# OF UNIQUE USERS ",
+           "SELECT COUNT(DISTINCT(e.uid)) FROM (SELECT uid FROM node UNION ALL SELECT uid FROM way) e"),
+    Report('top_users', "Highest contributing user",
+           "SELECT e.user, COUNT(*) as num FROM (SELECT user FROM node UNION ALL SELECT user FROM way) e GROUP BY e.user ORDER BY num DESC LIMIT 10"),
+]
+
+# The same reports answered from the summary tables of project.build_summaries.
+# A bank node always has one of its own values LIKE '%bank%', so the banknodes self-join of
+# the scan is not needed.
+BUSY_SUMMARY_NODES = "(SELECT node_id, degree FROM node_degree ORDER BY degree DESC LIMIT 10) as busy_nodes"
+BUSY_SUMMARY_NODE_IDS = "SELECT id FROM node," + BUSY_SUMMARY_NODES + " ON busy_nodes.node_id=node.id"
+
+REPORTS = [
+    Report('kannada_node_tags', "1. No of node tags written in kannada.",
+           "SELECT COALESCE(SUM(count), 0) FROM tag_counts WHERE element = 'node' AND key LIKE '%:kn%'"),
+    Report('kannada_way_tags', "2. No of way tags written in kannada.",
+           "SELECT COALESCE(SUM(count), 0) FROM tag_counts WHERE element = 'way' AND key LIKE '%:kn%'"),
+    Report('amenities', "3. Most popular aminities in bangalore",
+           "SELECT value, SUM(count) FROM tag_counts WHERE element = 'node' AND key LIKE '%amenity%' GROUP BY value ORDER BY SUM(count) DESC LIMIT 10"),
+    Report('banks', "4. Most popular bank in Bangalore",
+           "SELECT value, SUM(count) as num FROM tag_counts WHERE element = 'node' AND key IN ('name','operator','brand') AND value LIKE '%bank%' GROUP BY value ORDER BY num DESC LIMIT 10"),
+    Report('cuisines', "5. Popular cuisines in bangalore",
+           "SELECT value, count FROM cuisine_counts ORDER BY count DESC LIMIT 10"),
+    Report('busy_nodes', "Top nodes with highest number of intersection.", BUSY_SUMMARY_NODE_IDS),
+    Report('busy_node_tags', "To find out more about these nodes, we investigated further. We find no node tags.",
+           "SELECT * FROM node_tags,(" + BUSY_SUMMARY_NODE_IDS + ") as main_nodes WHERE main_nodes.id=node_tags.id"),
+    Report('nodes', "Number of nodes: 2882959", "SELECT rows FROM table_counts WHERE name = 'node'"),
+    Report('node_tags', "Number of node_tags: 93243", "SELECT rows FROM table_counts WHERE name = 'node_tags'"),
+    Report('ways', "Number of ways: 660784", "SELECT rows FROM table_counts WHERE name = 'way'"),
+    Report('way_nodes', "Number of way_nodes: 3576371", "SELECT rows FROM table_counts WHERE name = 'way_nodes'"),
+    Report('way_tags', "Number of way_tags: 723631", "SELECT rows FROM table_counts WHERE name = 'way_tags'"),
+    Report('unique_users', "# OF UNIQUE USERS ", "SELECT COUNT(DISTINCT(uid)) FROM user_edit_counts"),
+    Report('top_users', "Highest contributing user",
+           "SELECT user, SUM(nodes + ways) as num FROM user_edit_counts GROUP BY user ORDER BY num DESC LIMIT 10"),
+]
+
+
+def connect_read_only(db_path, cached_statements=CACHED_STATEMENTS):
+    """Open db_path for reports only, tuned with READ_PRAGMAS"""
+    conn = sqlite3.connect(db_path, cached_statements=cached_statements, check_same_thread=False)
+    for name, value in READ_PRAGMAS:
+        conn.execute('PRAGMA {0} = {1}'.format(name, value))
+    return conn
+
+
+class QueryRunner(object):
+    """Run reports against db_path on long lived read-only connections.
+
+    Each thread gets one connection, opened the first time it runs a query and kept until
+    close(), so a statement is prepared once per connection and then reused from its cache.
+    run_all() spreads the reports over `threads` threads; sqlite releases the GIL while a
+    query runs, so they execute concurrently.
+    """
+
+    def __init__(self, db_path, threads=4):
+        self.db_path = db_path
+        self.threads = threads
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+        self.pool = None
+
+    def connection(self):
+        """Return this thread's connection, opening it on first use"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = connect_read_only(self.db_path)
+            with self.lock:
+                self.connections.append(conn)
+        return conn
+
+    def run(self, report, params=()):
+        """Run one Report (or bare SQL string) and return its ReportResult"""
+        if not isinstance(report, Report):
+            report = Report(None, None, report)
+        start = time.time()
+        cursor = self.connection().execute(report.sql, params)
+        rows = cursor.fetchall()
+        columns = [column[0] for column in cursor.description or ()]
+        return ReportResult(report.name, report.title, columns, rows, time.time() - start)
+
+    def run_all(self, reports=REPORTS):
+        """Run every report concurrently and return their ReportResults in order"""
+        if self.threads <= 1:
+            return [self.run(report) for report in reports]
+        if self.pool is None:
+            self.pool = ThreadPool(self.threads)
+        return self.pool.map(self.run, reports, chunksize=1)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        with self.lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+        self.local = threading.local()
+
+
+def print_result(result):
+    """Print a ReportResult the way the original query section did, with its time"""
+    print result.title
+    for row in result.rows:
+        print row
+    print "({0:.3f}s)".format(result.seconds)
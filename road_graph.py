@@ -0,0 +1,217 @@
+# Note: The ways of the db project.py loads, as a graph of the nodes they join, built once from
+# way_nodes and node into flat compressed sparse row (CSR) arrays: the neighbours of node index
+# i are targets[offsets[i]:offsets[i + 1]], with the edge lengths in metres alongside in lengths.
+# Degree, component and shortest path queries then run on the arrays, without SQLite.
+#
+# The saved file is a header followed by the six arrays as raw little endian 8 byte values,
+# each starting on an 8 byte boundary, so it can be memory mapped as is (numpy.memmap, say).
+# Python 2 has no zero copy typed view of an mmap, so RoadGraph.load reads them with
+# array.fromfile.
+
+import array
+import bisect
+import heapq
+import math
+import struct
+import sys
+
+EARTH_RADIUS = 6371008.8  # metres
+GRAPH_MAGIC = 'OSMGRAPH'
+GRAPH_VERSION = 1
+GRAPH_HEADER = struct.Struct('<8sQQQ')  # magic, version, nodes, adjacency entries
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """Great circle distance in metres between two points"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+class RoadGraph(object):
+    """Undirected graph of the nodes joined by ways, in CSR arrays.
+
+    node_ids (sorted), lats and lons are indexed by node index; offsets has one more entry
+    than there are nodes; targets and lengths hold the neighbour index and edge length of
+    every adjacency entry. Every edge appears once from each end. Queries take OSM node ids.
+    """
+    ARRAYS = (('node_ids', 'l'), ('lats', 'd'), ('lons', 'd'), ('offsets', 'l'), ('targets', 'l'), ('lengths', 'd'))
+
+    def __init__(self, node_ids, lats, lons, offsets, targets, lengths):
+        self.node_ids = node_ids
+        self.lats = lats
+        self.lons = lons
+        self.offsets = offsets
+        self.targets = targets
+        self.lengths = lengths
+        self.labels = None
+
+    @classmethod
+    def from_db(cls, conn, highway_only=True):
+        """Build the graph of the ways in the db, only those tagged highway unless highway_only is False.
+
+        Consecutive nodes of a way are joined by an edge; a node missing from the node table
+        breaks the way there. Repeated edges (ways sharing a segment) are kept once.
+        """
+        ways = "SELECT id FROM way_tags WHERE key = 'highway'"
+        c = conn.cursor()
+        c.execute('DROP TABLE IF EXISTS temp.graph_node')
+        c.execute('CREATE TEMP TABLE graph_node(idx INTEGER PRIMARY KEY, id INTEGER UNIQUE, lat REAL, lon REAL)')
+        c.execute('INSERT INTO graph_node(id, lat, lon) SELECT id, lat, lon FROM node '
+                  'WHERE id IN (SELECT node_id FROM way_nodes' + (' WHERE id IN (%s)' % ways if highway_only else '') +
+                  ') ORDER BY id')
+        node_ids, lats, lons = array.array('l'), array.array('d'), array.array('d')
+        for node_id, lat, lon in c.execute('SELECT id, lat, lon FROM graph_node ORDER BY idx'):
+            node_ids.append(node_id)
+            lats.append(lat)
+            lons.append(lon)
+
+        # Both directions of every edge, as two parallel arrays of node indices
+        sources, targets = array.array('l'), array.array('l')
+        previous_way = previous = None
+        for way_id, idx in c.execute('SELECT way_nodes.id, graph_node.idx - 1 FROM way_nodes '
+                                     'LEFT JOIN graph_node ON graph_node.id = way_nodes.node_id' +
+                                     (' WHERE way_nodes.id IN (%s)' % ways if highway_only else '') +
+                                     ' ORDER BY way_nodes.id, way_nodes.position'):
+            if way_id == previous_way and previous is not None and idx is not None and idx != previous:
+                sources.append(previous)
+                targets.append(idx)
+                sources.append(idx)
+                targets.append(previous)
+            previous_way, previous = way_id, idx
+        c.execute('DROP TABLE temp.graph_node')
+        return cls.from_edges(node_ids, lats, lons, sources, targets)
+
+    @classmethod
+    def from_edges(cls, node_ids, lats, lons, sources, targets):
+        """Counting sort the (source, target) adjacency entries into CSR arrays, dropping repeats"""
+        count = len(node_ids)
+        offsets = array.array('l', [0]) * (count + 1)
+        for source in sources:
+            offsets[source + 1] += 1
+        for i in xrange(count):
+            offsets[i + 1] += offsets[i]
+        slots = offsets[:-1]
+        adjacency = array.array('l', [0]) * len(sources)
+        for entry in xrange(len(sources)):
+            source = sources[entry]
+            adjacency[slots[source]] = targets[entry]
+            slots[source] += 1
+
+        compact, lengths = array.array('l'), array.array('d')
+        compact_offsets = array.array('l', [0]) * (count + 1)
+        for i in xrange(count):
+            lat, lon = lats[i], lons[i]
+            for target in sorted(set(adjacency[offsets[i]:offsets[i + 1]])):
+                compact.append(target)
+                lengths.append(distance(lat, lon, lats[target], lons[target]))
+            compact_offsets[i + 1] = len(compact)
+        return cls(node_ids, lats, lons, compact_offsets, compact, lengths)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(GRAPH_HEADER.pack(GRAPH_MAGIC, GRAPH_VERSION, len(self.node_ids), len(self.targets)))
+            for name, _ in self.ARRAYS:
+                values = getattr(self, name)
+                if sys.byteorder == 'big':
+                    values = array.array(values.typecode, values)
+                    values.byteswap()
+                values.tofile(f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            magic, version, count, entries = GRAPH_HEADER.unpack(f.read(GRAPH_HEADER.size))
+            if magic != GRAPH_MAGIC or version != GRAPH_VERSION:
+                raise ValueError('{0} is not a version {1} road graph'.format(path, GRAPH_VERSION))
+            sizes = {'offsets': count + 1, 'targets': entries, 'lengths': entries}
+            arrays = []
+            for name, typecode in cls.ARRAYS:
+                values = array.array(typecode)
+                values.fromfile(f, sizes.get(name, count))
+                if sys.byteorder == 'big':
+                    values.byteswap()
+                arrays.append(values)
+        return cls(*arrays)
+
+    def index(self, node_id):
+        """Node index of node_id; KeyError if no way of the graph passes through it"""
+        i = bisect.bisect_left(self.node_ids, node_id)
+        if i == len(self.node_ids) or self.node_ids[i] != node_id:
+            raise KeyError(node_id)
+        return i
+
+    def neighbours(self, node_id):
+        """[(node id, metres)] of the nodes joined to node_id by an edge"""
+        i = self.index(node_id)
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return [(self.node_ids[j], length) for j, length in zip(self.targets[start:end], self.lengths[start:end])]
+
+    def degree(self, node_id):
+        """Number of distinct nodes joined to node_id by an edge"""
+        i = self.index(node_id)
+        return self.offsets[i + 1] - self.offsets[i]
+
+    def components(self):
+        """Array of the connected component label of each node index, numbered from 0 by first node"""
+        if self.labels is None:
+            offsets, targets = self.offsets, self.targets
+            labels = array.array('l', [-1]) * len(self.node_ids)
+            label = 0
+            for root in xrange(len(labels)):
+                if labels[root] != -1:
+                    continue
+                labels[root] = label
+                stack = [root]
+                while stack:
+                    i = stack.pop()
+                    for j in targets[offsets[i]:offsets[i + 1]]:
+                        if labels[j] == -1:
+                            labels[j] = label
+                            stack.append(j)
+                label += 1
+            self.labels = labels
+        return self.labels
+
+    def component_sizes(self):
+        """{component label: number of nodes}"""
+        sizes = {}
+        for label in self.components():
+            sizes[label] = sizes.get(label, 0) + 1
+        return sizes
+
+    def connected(self, node_id, other_id):
+        labels = self.components()
+        return labels[self.index(node_id)] == labels[self.index(other_id)]
+
+    def shortest_path(self, source_id, target_id):
+        """(metres, [node ids]) of the shortest path between two nodes, or None if there is none.
+
+        A* search, guided by the straight line distance to the target, which never
+        overestimates the remaining road distance.
+        """
+        source, target = self.index(source_id), self.index(target_id)
+        if not self.connected(source_id, target_id):
+            return None
+        offsets, targets, lengths, lats, lons = self.offsets, self.targets, self.lengths, self.lats, self.lons
+        target_lat, target_lon = lats[target], lons[target]
+        best = {source: 0.0}
+        previous = {}
+        queue = [(distance(lats[source], lons[source], target_lat, target_lon), 0.0, source)]
+        while queue:
+            _, so_far, i = heapq.heappop(queue)
+            if i == target:
+                path = [target]
+                while path[-1] != source:
+                    path.append(previous[path[-1]])
+                return so_far, [self.node_ids[j] for j in reversed(path)]
+            if so_far > best[i]:
+                continue
+            for entry in xrange(offsets[i], offsets[i + 1]):
+                j = targets[entry]
+                d = so_far + lengths[entry]
+                if d < best.get(j, float('inf')):
+                    best[j] = d
+                    previous[j] = i
+                    heapq.heappush(queue, (d + distance(lats[j], lons[j], target_lat, target_lon), d, j))
+        return None
@@ -0,0 +1,1035 @@
+# Note: Checks that the optimized parts of project.py behave exactly like what they replaced.
+# Run with: python -m unittest test_project
+
+import calendar
+import codecs
+import contextlib
+import copy
+import gzip
+import os
+import random
+import re
+import shutil
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+from xml.sax.saxutils import quoteattr
+
+import benchmark
+import osm_input
+import project
+
+# cerberus is only needed to check CompiledValidator against it
+try:
+    import cerberus
+except ImportError:
+    cerberus = None
+
+# Generated values each differential test compares
+CORPUS_SIZE = 50000
+# Size of the synthetic OSM files the tests shape
+SMALL_CONFIG = benchmark.DEFAULT_CONFIG._replace(nodes=2000, ways=400)
+
+
+# The value_fixer of the original project.py, kept as the reference fix_street_name must match
+def original_value_fixer(value):
+#     Make all upper/lower case of 'road|cross|main' to Road
+    re_road = re.compile(re.escape('road'), re.IGNORECASE)
+    re_main = re.compile(re.escape('main'), re.IGNORECASE)
+    re_cross = re.compile(re.escape('cross'), re.IGNORECASE)
+    if re.search('road', value, re.IGNORECASE):
+        value = re_road.sub('Road',value)
+    if re.search('cross', value, re.IGNORECASE):
+        value = re_road.sub('Cross',value)
+    if re.search('main', value, re.IGNORECASE):
+        value = re_road.sub('Main',value)
+
+#     Fix Rd or Rd. to Road
+#     Added a space so as to avoid considering 'rd' as a part of '3rd' and only taking abc rd.
+    re_rd_period = re.compile(re.escape(' rd\.'), re.IGNORECASE)
+    re_rd = re.compile(re.escape(' rd'), re.IGNORECASE)
+    if re.search(' rd\.', value, re.IGNORECASE):
+        value = re_rd_period.sub(' Road', value)
+    elif re.search(' rd', value, re.IGNORECASE):
+        value = re_rd.sub(' Road', value)
+
+
+#     Fix mn or mn. to Main
+    re_mn_period = re.compile(re.escape('mn.'), re.IGNORECASE)
+    re_mn = re.compile(re.escape('mn'), re.IGNORECASE)
+    if 'Main' not in value:
+        if re.search('th mn\.', value, re.IGNORECASE) or re.search('st mn\.', value, re.IGNORECASE) or re.search('nd mn\.', value, re.IGNORECASE) or re.search('rd mn\.', value, re.IGNORECASE):
+            value = re_mn_period.sub('Main', value)
+        elif re.search('th mn', value, re.IGNORECASE) or re.search('st mn', value, re.IGNORECASE) or re.search('nd mn', value, re.IGNORECASE) or re.search('rd mn', value, re.IGNORECASE):
+            value = re_mn.sub('Main', value)
+    if 'Main Road' not in value:
+        value = value.replace('Main','Main Road')
+
+#     Fix crs or Crs. or cros to Cross
+    re_crs_period = re.compile(re.escape('crs.'), re.IGNORECASE)
+    re_crs = re.compile(re.escape('crs'), re.IGNORECASE)
+    re_cros = re.compile(re.escape('cros'), re.IGNORECASE)
+    if 'Cross' not in value:
+        if re.search('th crs\.', value, re.IGNORECASE) or re.search('st crs\.', value, re.IGNORECASE) or re.search('nd crs\.', value, re.IGNORECASE) or re.search('rd crs\.', value, re.IGNORECASE):
+            value = re_crs_period.sub('Cross', value)
+        elif re.search('th crs', value, re.IGNORECASE) or re.search('st crs', value, re.IGNORECASE) or re.search('nd crs', value, re.IGNORECASE) or re.search('rd crs', value, re.IGNORECASE):
+            value = re_crs.sub('Cross', value)
+        elif re.search('cros', value, re.IGNORECASE):
+            value = re_crs.sub('Cross', value)
+    if 'Cross Road' not in value:
+        value = value.replace('Cross','Cross Road')
+
+#     Remove everything after 'Road'. I.e. Removing area name for roads. Like 4th Main Road, Banashankri should become 4th Main Road.
+    if 'Road' in value:
+        value=value[0:value.index('Road')+4]
+    return value
+
+
+# Pieces the street name corpus is glued together from: every spelling the rules look for, in
+# several cases, and the words and punctuation around them
+STREET_FRAGMENTS = ['road', 'Road', 'ROAD', 'rd', 'Rd', 'RD', 'rd.', 'Rd.', 'mn', 'Mn', 'MN', 'mn.', 'Mn.',
+                    'crs', 'Crs', 'CRS', 'crs.', 'Crs.', 'cros', 'Cros', 'cross', 'Cross', 'CROSS', 'main', 'Main',
+                    'MAIN', '1st', '2nd', '3rd', '4th', '11th', 'th', 'st', 'nd', 'Jayanagar', '100 Feet',
+                    'Banashankari', 'Broadway', 'Mainstreet']
+STREET_SEPARATORS = ['', ' ', ' ', ', ', '.', '-', '  ']
+
+
+def street_corpus(size=CORPUS_SIZE, seed=2):
+    """size utf-8 street names: half from benchmark.SyntheticOsm, half glued from STREET_FRAGMENTS"""
+    synthetic = benchmark.SyntheticOsm(benchmark.DEFAULT_CONFIG._replace(abbreviation_ratio=0.7, seed=seed))
+    rnd = random.Random(seed)
+    values = [synthetic.street().encode('utf-8') for _ in range(size // 2)]
+    while len(values) < size:
+        pieces = [rnd.choice(STREET_FRAGMENTS) for _ in range(rnd.randint(1, 6))]
+        values.append(''.join(piece + rnd.choice(STREET_SEPARATORS) for piece in pieces))
+    return values
+
+
+class ValueFixerTest(unittest.TestCase):
+
+    def test_matches_original(self):
+        for value in street_corpus():
+            self.assertEqual(project.fix_street_name(value), original_value_fixer(value), value)
+
+    def test_memoized_matches_original(self):
+        project.VALUE_CACHE.clear()
+        values = street_corpus(CORPUS_SIZE // 5)
+        for value in values + values:
+            self.assertEqual(project.value_fixer(value), original_value_fixer(value), value)
+
+
+# Nodes 1, 2, 4, 5 and 7 are inside FILTER_BBOX, 3 and 6 outside it. Way 10 runs from inside to
+# outside it, 12 lies outside, 11 is a building and 13 has no tags.
+FILTER_OSM = """<?xml version='1.0' encoding='UTF-8'?>
+<osm version="0.6">
+ <node id="1" lat="12.95" lon="77.55" version="1" timestamp="2015-01-01T00:00:00Z" changeset="1" uid="1" user="a">
+  <tag k="amenity" v="bank"/>
+ </node>
+ <node id="2" lat="12.96" lon="77.56" version="1" timestamp="2015-01-01T00:00:00Z" changeset="1" uid="1" user="a"/>
+ <node id="3" lat="13.10" lon="77.56" version="1" timestamp="2015-01-01T00:00:00Z" changeset="1" uid="1" user="a"/>
+ <node id="4" lat="12.97" lon="77.57" version="1" timestamp="2015-01-01T00:00:00Z" changeset="1" uid="1" user="a">
+  <tag k="shop" v="bakery"/>
+  <tag k="building" v="yes"/>
+ </node>
+ <node id="5" lat="12.98" lon="77.58" version="1" timestamp="2015-01-01T00:00:00Z" changeset="1" uid="1" user="a"/>
+ <node id="6" lat="13.10" lon="77.70" version="1" timestamp="2015-01-01T00:00:00Z" changeset="1" uid="1" user="a">
+  <tag k="amenity" v="cafe"/>
+ </node>
+ <node id="7" lat="12.99" lon="77.59" version="1" timestamp="2015-01-01T00:00:00Z" changeset="1" uid="1" user="a"/>
+ <way id="10" version="1" timestamp="2015-01-01T00:00:00Z" changeset="1" uid="1" user="a">
+  <nd ref="2"/>
+  <nd ref="3"/>
+  <tag k="highway" v="residential"/>
+ </way>
+ <way id="11" version="1" timestamp="2015-01-01T00:00:00Z" changeset="1" uid="1" user="a">
+  <nd ref="5"/>
+  <nd ref="4"/>
+  <tag k="building" v="yes"/>
+ </way>
+ <way id="12" version="1" timestamp="2015-01-01T00:00:00Z" changeset="1" uid="1" user="a">
+  <nd ref="3"/>
+  <nd ref="6"/>
+  <tag k="highway" v="service"/>
+ </way>
+ <way id="13" version="1" timestamp="2015-01-01T00:00:00Z" changeset="1" uid="1" user="a">
+  <nd ref="1"/>
+  <nd ref="2"/>
+ </way>
+</osm>
+"""
+FILTER_BBOX = (12.9, 77.5, 13.0, 77.65)
+
+
+class ElementFilterTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.osm_path = os.path.join(cls.directory, 'filter.osm')
+        with open(cls.osm_path, 'w') as f:
+            f.write(FILTER_OSM)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def kept(self, bbox=None, include_keys=None, exclude_keys=None):
+        """{'node': ids, 'way': ids} an ElementFilter keeps, prepared the way process_map does"""
+        element_filter = project.ElementFilter(bbox, include_keys, exclude_keys)
+        if element_filter.filters_keys:
+            element_filter.scan(self.osm_path)
+        kept = {'node': set(), 'way': set()}
+        for element in project.get_element(self.osm_path, tags=('node', 'way'), keep=element_filter):
+            kept[element.tag].add(int(element.attrib['id']))
+        return kept
+
+    def test_no_filter(self):
+        self.assertEqual(self.kept(), {'node': set([1, 2, 3, 4, 5, 6, 7]), 'way': set([10, 11, 12, 13])})
+
+    def test_bbox(self):
+        # a way is kept if any of its nodes is inside, and is then clipped to those
+        self.assertEqual(self.kept(FILTER_BBOX), {'node': set([1, 2, 4, 5, 7]), 'way': set([10, 11, 13])})
+
+    def test_include_keys_keep_way_nodes(self):
+        # the untagged nodes of the kept ways are kept with them
+        self.assertEqual(self.kept(include_keys=['highway', 'amenity']),
+                         {'node': set([1, 2, 3, 6]), 'way': set([10, 12])})
+
+    def test_exclude_keys(self):
+        self.assertEqual(self.kept(exclude_keys=['building']),
+                         {'node': set([1, 2, 3, 5, 6, 7]), 'way': set([10, 12, 13])})
+
+    def test_include_and_exclude_keys(self):
+        self.assertEqual(self.kept(include_keys=['shop', 'highway'], exclude_keys=['building']),
+                         {'node': set([2, 3, 6]), 'way': set([10, 12])})
+
+    def test_bbox_and_include_keys(self):
+        # way 12 has no node inside, so its nodes are not kept for it
+        self.assertEqual(self.kept(FILTER_BBOX, ['highway', 'amenity']), {'node': set([1, 2]), 'way': set([10])})
+
+    def test_node_id_set(self):
+        ids = project.NodeIdSet([5, 9])
+        ids.add(12)
+        self.assertTrue(ids.is_sorted)
+        ids.add(7)
+        ids.update(project.NodeIdSet([3, 12]))
+        self.assertEqual([i for i in range(15) if i in ids], [3, 5, 7, 9, 12])
+        self.assertEqual(len(ids), 5)
+
+def shaped_corpus(config=SMALL_CONFIG):
+    """The shaped elements of a synthetic OSM file written for config"""
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'synthetic.osm')
+        benchmark.generate_osm(path, config)
+        return project.shape_elements(list(project.get_element(path, tags=('node', 'way'))))
+    finally:
+        shutil.rmtree(directory)
+
+
+# Values a corrupted field is set to: None, wrong types, strings that do and do not coerce
+BAD_VALUES = [None, 'abc', '12', u'7', 3, 2.5, -1, [], {}, ['x'], {'a': 1}, True]
+
+
+def corrupt(document, rnd):
+    """Break document, the as_dict form of a shaped element, in one random way"""
+    action = rnd.randint(0, 5)
+    if action == 1 or not document:
+        document[rnd.choice(['extra', 'node', 'way_nodes'])] = rnd.choice(BAD_VALUES)
+        return
+    field = rnd.choice(sorted(document))
+    value = document[field]
+    if action == 0:
+        del document[field]
+    elif action == 2 or not value or not isinstance(value, (dict, list)):
+        document[field] = rnd.choice(BAD_VALUES)
+    else:
+        record = value
+        if isinstance(value, list):
+            i = rnd.randrange(len(value))
+            if action == 3 or not isinstance(value[i], dict):
+                value[i] = rnd.choice(BAD_VALUES)
+                return
+            record = value[i]
+        if action == 4 or not record:
+            record[rnd.choice(sorted(record) + ['extra'])] = rnd.choice(BAD_VALUES)
+        else:
+            del record[rnd.choice(sorted(record))]
+
+
+@unittest.skipIf(cerberus is None, 'needs cerberus')
+class CompiledValidatorTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.shaped = [el for el in shaped_corpus() if el]
+
+    def assert_same(self, document):
+        reference = cerberus.Validator(project.SCHEMA)
+        validator = project.CompiledValidator(project.SCHEMA)
+        expected = reference.validate(copy.deepcopy(document))
+        self.assertEqual(validator.validate(copy.deepcopy(document)), expected, document)
+        self.assertEqual(validator.errors, reference.errors, document)
+
+    def test_shaped_elements_are_valid(self):
+        validator = project.CompiledValidator(project.SCHEMA)
+        for el in self.shaped:
+            self.assertTrue(validator.validate(el), validator.errors)
+        for el in random.Random(8).sample(self.shaped, 300):
+            self.assert_same(project.as_dict(el))
+
+    def test_corrupted_elements_match_cerberus(self):
+        rnd = random.Random(8)
+        for _ in range(1500):
+            document = project.as_dict(rnd.choice(self.shaped))
+            for _ in range(rnd.randint(1, 3)):
+                corrupt(document, rnd)
+            self.assert_same(document)
+
+
+# A test-only pbf writer, written from fileformat.proto and osmformat.proto, so the decoder of
+# osm_input can be checked against the xml the elements came from. It writes each block in
+# one of the ways a pbf file may hold it: dense or plain nodes, zlib compressed or raw blobs,
+# with or without coordinate offsets.
+
+def encode_varint(value):
+    if value < 0:
+        value += 1 << 64
+    out = []
+    while True:
+        low = value & 0x7f
+        value >>= 7
+        if not value:
+            out.append(chr(low))
+            return ''.join(out)
+        out.append(chr(low | 0x80))
+
+
+def encode_zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def varint_field(number, value):
+    return encode_varint(number << 3) + encode_varint(value)
+
+
+def bytes_field(number, data):
+    return encode_varint(number << 3 | 2) + encode_varint(len(data)) + data
+
+
+def packed_field(number, values, signed=False):
+    if not values:
+        return ''
+    return bytes_field(number, ''.join(encode_varint(encode_zigzag(v) if signed else v) for v in values))
+
+
+def delta_encoded(values):
+    previous = 0
+    deltas = []
+    for value in values:
+        deltas.append(value - previous)
+        previous = value
+    return deltas
+
+
+class StringTable(object):
+    """Ids of the strings of one block; 0 is the empty string"""
+
+    def __init__(self):
+        self.ids = {'': 0}
+        self.strings = ['']
+
+    def __call__(self, value):
+        value = project.utf8(value)
+        if value not in self.ids:
+            self.ids[value] = len(self.strings)
+            self.strings.append(value)
+        return self.ids[value]
+
+
+class PbfBlockWriter(object):
+    """Encode the elements of one PrimitiveBlock; coordinates are stored relative to offset"""
+
+    def __init__(self, offset=(0, 0)):
+        self.strings = StringTable()
+        self.lat_offset, self.lon_offset = offset
+
+    def lat(self, value):
+        return (int(round(float(value) * 1e9)) - self.lat_offset) // 100
+
+    def lon(self, value):
+        return (int(round(float(value) * 1e9)) - self.lon_offset) // 100
+
+    @staticmethod
+    def timestamp(value):
+        return calendar.timegm(time.strptime(value, '%Y-%m-%dT%H:%M:%SZ'))
+
+    def info(self, attrib):
+        return (varint_field(1, int(attrib['version'])) + varint_field(2, self.timestamp(attrib['timestamp'])) +
+                varint_field(3, int(attrib['changeset'])) + varint_field(4, int(attrib['uid'])) +
+                varint_field(5, self.strings(attrib['user'])))
+
+    def tags(self, element):
+        tags = [child.attrib for child in element if child.tag == 'tag']
+        return (packed_field(2, [self.strings(tag['k']) for tag in tags]) +
+                packed_field(3, [self.strings(tag['v']) for tag in tags]))
+
+    def dense_nodes(self, elements):
+        attribs = [element.attrib for element in elements]
+        keys_vals = []
+        for element in elements:
+            for child in element:
+                keys_vals.extend([self.strings(child.attrib['k']), self.strings(child.attrib['v'])])
+            keys_vals.append(0)
+        dense_info = (packed_field(1, [int(a['version']) for a in attribs]) +
+                      packed_field(2, delta_encoded([self.timestamp(a['timestamp']) for a in attribs]), True) +
+                      packed_field(3, delta_encoded([int(a['changeset']) for a in attribs]), True) +
+                      packed_field(4, delta_encoded([int(a['uid']) for a in attribs]), True) +
+                      packed_field(5, delta_encoded([self.strings(a['user']) for a in attribs]), True))
+        dense = (packed_field(1, delta_encoded([int(a['id']) for a in attribs]), True) + bytes_field(5, dense_info) +
+                 packed_field(8, delta_encoded([self.lat(a['lat']) for a in attribs]), True) +
+                 packed_field(9, delta_encoded([self.lon(a['lon']) for a in attribs]), True) +
+                 packed_field(10, keys_vals if any(keys_vals) else []))
+        return bytes_field(2, dense)
+
+    def node(self, element):
+        attrib = element.attrib
+        return bytes_field(1, varint_field(1, encode_zigzag(int(attrib['id']))) + self.tags(element) +
+                           bytes_field(4, self.info(attrib)) + varint_field(8, encode_zigzag(self.lat(attrib['lat']))) +
+                           varint_field(9, encode_zigzag(self.lon(attrib['lon']))))
+
+    def way(self, element):
+        refs = [int(child.attrib['ref']) for child in element if child.tag == 'nd']
+        return bytes_field(3, varint_field(1, int(element.attrib['id'])) + self.tags(element) +
+                           bytes_field(4, self.info(element.attrib)) + packed_field(8, delta_encoded(refs), True))
+
+    def relation(self, element):
+        members = [child.attrib for child in element if child.tag == 'member']
+        return bytes_field(4, varint_field(1, int(element.attrib['id'])) + self.tags(element) +
+                           bytes_field(4, self.info(element.attrib)) +
+                           packed_field(8, [self.strings(member['role']) for member in members]) +
+                           packed_field(9, delta_encoded([int(member['ref']) for member in members]), True) +
+                           packed_field(10, [osm_input.PBF_MEMBER_TYPES.index(member['type']) for member in members]))
+
+    def block(self, elements, dense):
+        if elements[0].tag == 'node' and dense:
+            group = self.dense_nodes(elements)
+        else:
+            group = ''.join(getattr(self, element.tag)(element) for element in elements)
+        block = bytes_field(1, ''.join(bytes_field(1, string) for string in self.strings.strings)) + bytes_field(2, group)
+        if self.lat_offset or self.lon_offset:
+            block += varint_field(19, self.lat_offset) + varint_field(20, self.lon_offset)
+        return block
+
+
+def write_pbf_blob(f, blob_type, data, raw=False):
+    blob = bytes_field(1, data) if raw else varint_field(2, len(data)) + bytes_field(3, zlib.compress(data))
+    header = bytes_field(1, blob_type) + varint_field(3, len(blob))
+    f.write(struct.pack('>I', len(header)) + header + blob)
+
+
+def write_pbf(elements, path, block_size=500):
+    """Write elements (in file order) to a pbf file at path, varying how each block is stored"""
+    with open(path, 'wb') as f:
+        write_pbf_blob(f, 'OSMHeader', bytes_field(4, 'OsmSchema-V0.6') + bytes_field(4, 'DenseNodes'))
+        start = count = 0
+        while start < len(elements):
+            end = start
+            while end < len(elements) and end - start < block_size and elements[end].tag == elements[start].tag:
+                end += 1
+            offset = (12 * 10 ** 9, 77 * 10 ** 9) if count % 2 else (0, 0)
+            data = PbfBlockWriter(offset).block(elements[start:end], dense=count % 3 != 1)
+            write_pbf_blob(f, 'OSMData', data, raw=count % 4 == 3)
+            start = end
+            count += 1
+
+
+def comparable(element):
+    """An element as (tag, attributes, children), with every string utf-8 encoded"""
+    def encoded(attrib):
+        return sorted((key, project.utf8(value)) for key, value in attrib.items())
+    return element.tag, encoded(element.attrib), [(child.tag, encoded(child.attrib)) for child in element]
+
+
+class PbfDecoderTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.xml_path = os.path.join(cls.directory, 'synthetic.osm')
+        benchmark.generate_osm(cls.xml_path, SMALL_CONFIG)
+        with open(cls.xml_path) as f:
+            xml = f.read()
+        relation = ('<relation id="7" version="2" timestamp="2012-03-04T05:06:07Z" changeset="9" uid="1001" '
+                    'user="mapper_1"><member type="way" ref="{0}" role="outer"/><member type="node" ref="{1}" '
+                    'role=""/><tag k="type" v="multipolygon"/></relation>\n').format(
+                        benchmark.FIRST_WAY_ID, benchmark.FIRST_NODE_ID)
+        with open(cls.xml_path, 'w') as f:
+            f.write(xml.replace('</osm>', relation + '</osm>'))
+        cls.elements = list(project.get_element(cls.xml_path))
+        cls.pbf_path = os.path.join(cls.directory, 'synthetic.osm.pbf')
+        write_pbf(cls.elements, cls.pbf_path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def test_wire_format(self):
+        # the examples of the protobuf encoding guide
+        self.assertEqual(osm_input.read_varint('\x96\x01', 0), (150, 2))
+        self.assertEqual(osm_input.read_varint('\xac\x02', 0), (300, 2))
+        self.assertEqual(osm_input.message_fields('\x08\x96\x01'), {1: [150]})
+        self.assertEqual(osm_input.message_fields('\x12\x07testing'), {2: ['testing']})
+        for encoded, value in ((0, 0), (1, -1), (2, 1), (3, -2), (4294967294, 2147483647), (4294967295, -2147483648)):
+            self.assertEqual(osm_input.zigzag(encoded), value)
+        self.assertEqual(osm_input.int64(2 ** 64 - 1), -1)
+        self.assertEqual(osm_input.read_varint(encode_varint(-1), 0), (2 ** 64 - 1, 10))
+
+    def test_pbf_matches_xml(self):
+        expected = map(comparable, self.elements)
+        self.assertEqual(map(comparable, project.get_element(self.pbf_path)), expected)
+        self.assertEqual(map(comparable, project.get_element(self.pbf_path, tags=('way', 'relation'))),
+                         [element for element in expected if element[0] != 'node'])
+
+    def test_shards_cover_file(self):
+        expected = map(comparable, self.elements)
+        shards = osm_input.pbf_shards(self.pbf_path, 3)
+        self.assertEqual(len(shards), 3)
+        elements = []
+        for start, end in shards:
+            reader = osm_input.PbfReader(self.pbf_path, start, end)
+            try:
+                elements.extend(map(comparable, project.get_element(reader)))
+            finally:
+                reader.close()
+        self.assertEqual(elements, expected)
+        way_start = osm_input.pbf_way_start(self.pbf_path)
+        reader = osm_input.PbfReader(self.pbf_path, 0, way_start)
+        try:
+            nodes = map(comparable, project.get_element(reader))
+        finally:
+            reader.close()
+        self.assertEqual(nodes, [element for element in expected if element[0] == 'node'])
+
+
+def table_contents(conn, tables=project.TABLES):
+    """{table: its rows, sorted} for each (table, fields) of tables, read through the views"""
+    return dict((table_name, sorted(conn.execute('SELECT * FROM %s' % table_name)))
+                for table_name, _ in tables)
+
+
+def sqlite_load(shaped, checkpoint=None):
+    """An in-memory db with the shaped elements loaded through a SqliteSink"""
+    conn = sqlite3.connect(':memory:')
+    project.create_tables(conn)
+    sink = project.SqliteSink(conn, checkpoint=checkpoint)
+    for el in shaped:
+        sink.add(el)
+    sink.close()
+    return conn
+
+
+class FailingCheckpoint(object):
+    """Stands in for an ImportCheckpoint whose first save fails, rolling its transaction back"""
+
+    def __init__(self):
+        self.failed = False
+
+    def save(self, conn):
+        if not self.failed:
+            self.failed = True
+            raise sqlite3.OperationalError('disk I/O error')
+
+
+# Module settings of project the import tests point elsewhere, restored after each test
+PROJECT_SETTINGS = ('NODES_PATH', 'NODE_TAGS_PATH', 'WAYS_PATH', 'WAY_NODES_PATH', 'WAY_TAGS_PATH', 'CSV_PATHS',
+                    'SHARD_SIZE')
+# Shards of a few kB: the byte offsets osm_shards starts from then fall inside elements, and
+# every worker shapes several shards
+SMALL_SHARD_SIZE = 16 * 1024
+# An area holding about a tenth of the synthetic nodes, and the keys an extract keeps
+EXTRACT_BBOX = (12.9, 77.5, 13.0, 77.65)
+EXTRACT_KEYS = ['amenity', 'highway']
+
+
+class ImportTestCase(unittest.TestCase):
+    """Base of the tests running full imports: a synthetic OSM file in a temporary directory,
+    and the csvs of each import written to a directory of their own"""
+    config = SMALL_CONFIG
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.osm_path = os.path.join(cls.directory, 'synthetic.osm')
+        benchmark.generate_osm(cls.osm_path, cls.config)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        self.settings = dict((name, getattr(project, name)) for name in PROJECT_SETTINGS)
+
+    def tearDown(self):
+        for name, value in self.settings.items():
+            setattr(project, name, value)
+
+    def use_csv_directory(self, name):
+        """Point the csv paths of project into a new directory name, and return it"""
+        directory = tempfile.mkdtemp(prefix=name, dir=self.directory)
+        project.NODES_PATH, project.NODE_TAGS_PATH, project.WAYS_PATH, project.WAY_NODES_PATH, \
+            project.WAY_TAGS_PATH = project.CSV_PATHS = tuple(
+                os.path.join(directory, os.path.basename(path)) for path in self.settings['CSV_PATHS'])
+        return directory
+
+    def import_osm(self, name, osm_path=None, conn=None, **kwargs):
+        """Import osm_path (by default the synthetic file) with process_map and return the csvs'
+        contents (none with write_csv=False) and the tables' contents; kwargs are passed on to
+        process_map"""
+        self.use_csv_directory(name)
+        if conn is None:
+            conn = sqlite3.connect(':memory:')
+            project.create_tables(conn)
+        project.process_map(osm_path or self.osm_path, False, conn=conn, **kwargs)
+        csvs = []
+        for path in project.CSV_PATHS:
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    csvs.append(f.read())
+        return csvs, table_contents(conn)
+
+
+class SqliteSinkTest(ImportTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(SqliteSinkTest, cls).setUpClass()
+        elements = list(project.get_element(cls.osm_path, tags=('node', 'way')))
+        cls.shaped = [el for el in project.shape_elements(elements) if el]
+
+    def test_rolled_back_flush_keeps_dictionary_entries(self):
+        # the sinks write their reject csvs next to the csvs
+        self.use_csv_directory('sink')
+        expected = table_contents(sqlite_load(self.shaped))
+        conn = sqlite3.connect(':memory:')
+        project.create_tables(conn)
+        sink = project.SqliteSink(conn, checkpoint=FailingCheckpoint())
+        for el in self.shaped[:len(self.shaped) // 2]:
+            sink.add(el)
+        self.assertRaises(sqlite3.OperationalError, sink.flush)
+        self.assertEqual(conn.execute('SELECT COUNT(*) FROM users').fetchone()[0], 0)
+        # the rows of the rolled back flush stay pending and go in with the next one
+        for el in self.shaped[len(self.shaped) // 2:]:
+            sink.add(el)
+        sink.close()
+        self.assertEqual(sum(loader.rejected for loader in sink.loaders.values()), 0)
+        self.assertEqual(table_contents(conn), expected)
+
+
+class ParallelImportTest(ImportTestCase):
+
+    def setUp(self):
+        ImportTestCase.setUp(self)
+        project.SHARD_SIZE = SMALL_SHARD_SIZE
+
+    def assert_same_as_serial(self, osm_path=None, element_filter=None):
+        new_filter = lambda: copy.deepcopy(element_filter)
+        serial = self.import_osm('serial', osm_path, element_filter=new_filter())
+        self.assertTrue(serial[1]['node'])
+        for workers in (2, 4):
+            parallel = self.import_osm('workers', osm_path, workers=workers, element_filter=new_filter())
+            self.assertEqual(parallel[0], serial[0], '{0} workers'.format(workers))
+            self.assertEqual(parallel[1], serial[1], '{0} workers'.format(workers))
+
+    def test_shards_cut_inside_elements(self):
+        shards = project.osm_shards(self.osm_path, os.path.getsize(self.osm_path) // SMALL_SHARD_SIZE)
+        self.assertTrue(len(shards) > 8)
+        with open(self.osm_path, 'rb') as osm:
+            for start, end in shards:
+                osm.seek(start)
+                self.assertTrue(re.match(r'\s*<(node|way|relation)[\s>/]', osm.read(16)), start)
+        elements = []
+        for start, end in shards:
+            reader = project.ShardReader(self.osm_path, start, end)
+            try:
+                elements.extend(map(comparable, project.get_element(reader)))
+            finally:
+                reader.close()
+        self.assertEqual(elements, map(comparable, project.get_element(self.osm_path)))
+
+    def test_workers_match_serial(self):
+        self.assert_same_as_serial()
+
+    def test_filtered_workers_match_serial(self):
+        self.assert_same_as_serial(element_filter=project.ElementFilter(EXTRACT_BBOX, EXTRACT_KEYS))
+
+    def test_pbf_workers_match_serial(self):
+        pbf_path = os.path.join(self.directory, 'synthetic.osm.pbf')
+        write_pbf(list(project.get_element(self.osm_path)), pbf_path, block_size=100)
+        self.assert_same_as_serial(pbf_path)
+
+
+class PipelinedImportTest(ImportTestCase):
+
+    def assert_same_as_serial(self, osm_path=None, element_filter=None):
+        new_filter = lambda: copy.deepcopy(element_filter)
+        serial = self.import_osm('serial', osm_path, element_filter=new_filter())
+        self.assertTrue(serial[1]['node'])
+        pipelined = self.import_osm('pipelined', osm_path, pipelined=True, element_filter=new_filter())
+        self.assertEqual(pipelined, serial)
+
+    def test_pipelined_matches_serial(self):
+        self.assert_same_as_serial()
+
+    def test_filtered_pipelined_matches_serial(self):
+        self.assert_same_as_serial(element_filter=project.ElementFilter(EXTRACT_BBOX, EXTRACT_KEYS))
+
+    def test_compressed_pipelined_matches_serial(self):
+        gz_path = os.path.join(self.directory, 'synthetic.osm.gz')
+        with open(self.osm_path, 'rb') as osm:
+            with gzip.open(gz_path, 'wb') as f:
+                shutil.copyfileobj(osm, f)
+        self.assert_same_as_serial(gz_path)
+
+    def test_interrupted_stage_stops_pipeline(self):
+        shape_elements = project.shape_elements
+        calls = [0]
+
+        def interrupted_shape(elements):
+            calls[0] += 1
+            if calls[0] == 3:
+                raise KeyboardInterrupt
+            return shape_elements(elements)
+
+        outcome = []
+
+        def run():
+            sink = project.CsvSink(project.CSV_PATHS, buffered=True)
+            try:
+                project.shape_pipelined(self.osm_path, False, [sink], queue_size=1)
+            except KeyboardInterrupt:
+                outcome.append('raised')
+        self.use_csv_directory('interrupted')
+        project.shape_elements = interrupted_shape
+        try:
+            thread = threading.Thread(target=run)
+            thread.daemon = True
+            thread.start()
+            thread.join(30)
+        finally:
+            project.shape_elements = shape_elements
+        self.assertFalse(thread.is_alive(), 'the pipeline hung')
+        self.assertEqual(outcome, ['raised'])
+
+class Interrupted(Exception):
+    pass
+
+
+@contextlib.contextmanager
+def interrupted_at_save(count):
+    """Make the count-th ImportCheckpoint.save raise Interrupted, rolling its transaction back"""
+    save = project.ImportCheckpoint.__dict__['save']
+    calls = [0]
+
+    def failing_save(checkpoint, conn):
+        calls[0] += 1
+        if calls[0] == count:
+            raise Interrupted('interrupted at checkpoint {0}'.format(count))
+        save(checkpoint, conn)
+    project.ImportCheckpoint.save = failing_save
+    try:
+        yield
+    finally:
+        project.ImportCheckpoint.save = save
+
+
+class ResumeImportTest(ImportTestCase):
+    # three SqliteSink batches
+    config = SMALL_CONFIG._replace(nodes=20000, ways=4000)
+
+    @classmethod
+    def setUpClass(cls):
+        super(ResumeImportTest, cls).setUpClass()
+        cls.pbf_path = os.path.join(cls.directory, 'synthetic.osm.pbf')
+        write_pbf(list(project.get_element(cls.osm_path)), cls.pbf_path)
+
+    def setUp(self):
+        ImportTestCase.setUp(self)
+        project.SHARD_SIZE = SMALL_SHARD_SIZE * 8
+
+    def assert_resumes(self, failing_save, osm_path=None, **kwargs):
+        expected = self.import_osm('clean', osm_path, write_csv=False, **kwargs)[1]
+        db_path = os.path.join(self.use_csv_directory('resumed'), 'resumed.db')
+        conn = sqlite3.connect(db_path)
+        project.create_tables(conn)
+        with project.tuned_for_load(conn, resumable=True):
+            with interrupted_at_save(failing_save):
+                self.assertRaises(Interrupted, self.import_osm, 'interrupted', osm_path, conn, write_csv=False,
+                                  **kwargs)
+        loaded = sum(len(rows) for rows in table_contents(conn).values())
+        self.assertTrue(0 < loaded < sum(len(rows) for rows in expected.values()), loaded)
+        conn.close()
+        conn = sqlite3.connect(db_path)
+        project.create_tables(conn)
+        with project.tuned_for_load(conn, resumable=True):
+            resumed = self.import_osm('resume', osm_path, conn, write_csv=False, resume=True, **kwargs)[1]
+        self.assertEqual(resumed, expected)
+        conn.close()
+
+    def test_serial(self):
+        self.assert_resumes(2)
+
+    def test_pipelined(self):
+        self.assert_resumes(2, pipelined=True)
+
+    def test_workers(self):
+        self.assert_resumes(7, workers=4)
+
+    def test_pbf(self):
+        self.assert_resumes(2, self.pbf_path)
+
+    def test_pbf_workers(self):
+        self.assert_resumes(3, self.pbf_path, workers=2)
+
+
+def write_elements(f, elements):
+    """Write OsmElements as xml to f, a unicode file"""
+    for element in elements:
+        attributes = u' '.join(u'{0}={1}'.format(k, quoteattr(project.utf8(v).decode('utf-8')))
+                               for k, v in sorted(element.attrib.items()))
+        f.write(u' <{0} {1}>\n'.format(element.tag, attributes))
+        for child in element:
+            f.write(u'  <{0} {1}/>\n'.format(child.tag, u' '.join(
+                u'{0}={1}'.format(k, quoteattr(project.utf8(v).decode('utf-8'))) for k, v in sorted(child.attrib.items()))))
+        f.write(u' </{0}>\n'.format(element.tag))
+
+
+def write_osm(path, elements):
+    with codecs.open(path, 'w', 'utf-8') as f:
+        f.write(u"<?xml version='1.0' encoding='UTF-8'?>\n<osm version=\"0.6\">\n")
+        write_elements(f, elements)
+        f.write(u'</osm>\n')
+
+
+def write_osc(path, changes):
+    """Write [(action, [OsmElement])] as an osmChange file"""
+    with codecs.open(path, 'w', 'utf-8') as f:
+        f.write(u"<?xml version='1.0' encoding='UTF-8'?>\n<osmChange version=\"0.6\">\n")
+        for action, elements in changes:
+            f.write(u'<{0}>\n'.format(action))
+            write_elements(f, elements)
+            f.write(u'</{0}>\n'.format(action))
+        f.write(u'</osmChange>\n')
+
+
+def edited(element, version_step=1, user=('4242', 'osc_mapper'), tags=None, node_ids=None):
+    """A new version of element, by user, with its tags and (for a way) its nodes replaced"""
+    attrib = dict(element.attrib, version=str(int(element.attrib['version']) + version_step),
+                  uid=user[0], user=user[1])
+    children = [child for child in element if child.tag == 'nd' and node_ids is None]
+    children += [osm_input.OsmChild('nd', {'ref': str(node_id)}) for node_id in node_ids or ()]
+    children += [child for child in element if child.tag == 'tag' and tags is None]
+    children += [osm_input.OsmChild('tag', {'k': k, 'v': v}) for k, v in tags or ()]
+    return osm_input.OsmElement(element.tag, attrib, children)
+
+
+def changed_elements(elements):
+    """An osmChange creating, modifying and deleting nodes and ways of elements (sorted nodes
+    then ways), and the elements as they are once it is applied, in file order"""
+    nodes = [element for element in elements if element.tag == 'node']
+    ways = [element for element in elements if element.tag == 'way']
+    new_node = edited(nodes[-1], tags=[('amenity', 'bank'), ('name', u'Osc Bank \u0cac'), ('osc:new_key', 'x')])
+    new_node.attrib.update(id=str(int(nodes[-1].attrib['id']) + 1), lat='12.9500001', lon='77.5999999')
+    new_way = edited(ways[-1], node_ids=[nodes[3].attrib['id'], nodes[4].attrib['id'], new_node.attrib['id']],
+                     tags=[('highway', 'residential'), ('name', '3rd Crs, Jayanagar')])
+    new_way.attrib['id'] = str(int(ways[-1].attrib['id']) + 1)
+    modified = {
+        nodes[10].attrib['id']: edited(nodes[10], tags=[('amenity', 'restaurant'), ('cuisine', 'osc_cuisine')]),
+        nodes[11].attrib['id']: edited(nodes[11], user=nodes[11].attrib['uid'], tags=[]),
+        ways[5].attrib['id']: edited(ways[5], node_ids=[nodes[1].attrib['id'], nodes[10].attrib['id']]),
+        ways[6].attrib['id']: edited(ways[6], tags=[('highway', 'footway'), ('osc:note', 'moved')]),
+    }
+    modified[nodes[10].attrib['id']].attrib.update(lat='13.0000001', lon='77.7000001')
+    modified[nodes[11].attrib['id']].attrib['user'] = nodes[11].attrib['user']
+    deleted = [nodes[20], nodes[21], ways[7]]
+    changes = [('create', [new_node, new_way]), ('modify', sorted(modified.values(), key=lambda e: e.tag)),
+               ('delete', deleted)]
+    deleted_ids = set(element.attrib['id'] for element in deleted)
+    final = [modified.get(element.attrib['id'], element) for element in nodes
+             if element.attrib['id'] not in deleted_ids] + [new_node]
+    final += [modified.get(element.attrib['id'], element) for element in ways
+              if element.attrib['id'] not in deleted_ids] + [new_way]
+    return changes, final
+
+
+class ChangesTestCase(ImportTestCase):
+    """Base of the tests of apply_changes: an osmChange of the synthetic file, and the file as
+    it is once the change is applied"""
+
+    @classmethod
+    def setUpClass(cls):
+        super(ChangesTestCase, cls).setUpClass()
+        changes, final = changed_elements(list(project.get_element(cls.osm_path, tags=('node', 'way'))))
+        cls.osc_path = os.path.join(cls.directory, 'changes.osc')
+        write_osc(cls.osc_path, changes)
+        cls.final_path = os.path.join(cls.directory, 'changed.osm')
+        write_osm(cls.final_path, final)
+
+    def loaded_db(self, osm_path=None, builds=()):
+        """An in-memory db with osm_path (by default the synthetic file) loaded, then each of builds run on it"""
+        conn = sqlite3.connect(':memory:')
+        project.create_tables(conn)
+        self.import_osm('load', osm_path, conn, write_csv=False)
+        for build in builds:
+            build(conn)
+        return conn
+
+
+class ChangesImportTest(ChangesTestCase):
+    """An osmChange applied to a loaded db, against a fresh load of the changed file"""
+
+    def test_changes_match_fresh_load(self):
+        conn = self.loaded_db()
+        counts = project.apply_changes(self.osc_path, conn, batch_size=2)
+        self.assertEqual(counts, {('create', 'node'): 1, ('create', 'way'): 1, ('modify', 'node'): 2,
+                                  ('modify', 'way'): 2, ('delete', 'node'): 2, ('delete', 'way'): 1})
+        self.assertEqual(table_contents(conn), table_contents(self.loaded_db(self.final_path)))
+
+    def test_changes_applied_twice(self):
+        conn = self.loaded_db()
+        project.apply_changes(self.osc_path, conn)
+        project.apply_changes(self.osc_path, conn)
+        self.assertEqual(table_contents(conn), table_contents(self.loaded_db(self.final_path)))
+
+
+# Everything built after a load, in the order the command line builds it
+BUILDS = (project.build_indexes, project.build_summaries, project.build_tag_search, project.build_node_index)
+SUMMARY_TABLES = [(table_name, None) for table_name, _, _ in project.SUMMARY_TABLES]
+# Texts searched for in the tag search tests: words of the synthetic values, of the changed
+# tags and the kannada letter the created node's name ends with
+SEARCH_TEXTS = ['bank', 'Bank', 'osc', 'Road', 'restaurant', 'footway', 'moved', 'osc cuisine', 'Jayanagar',
+                u'Bank \u0cac', 'survey']
+
+
+class DerivedTablesTest(ChangesTestCase):
+    """The summaries, search indexes and spatial index apply_changes updates, against rebuilding them"""
+
+    def changed_db(self):
+        conn = self.loaded_db(builds=BUILDS)
+        project.apply_changes(self.osc_path, conn, batch_size=2)
+        return conn
+
+    def test_summaries_match_rebuild(self):
+        conn = self.changed_db()
+        updated = table_contents(conn, SUMMARY_TABLES)
+        self.assertEqual(updated, table_contents(self.loaded_db(self.final_path, BUILDS), SUMMARY_TABLES))
+        project.build_summaries(conn)
+        self.assertEqual(updated, table_contents(conn, SUMMARY_TABLES))
+
+    @unittest.skipIf(sqlite3.sqlite_version_info < project.TAG_SEARCH_SQLITE, 'needs the trigram tokenizer')
+    def test_tag_search_matches_rebuild(self):
+        conn = self.changed_db()
+        for search_table, _, _ in project.TAG_SEARCH_TABLES:
+            # also compares the index with its content view; raises if they differ
+            conn.execute("INSERT INTO {0}({0}, rank) VALUES ('integrity-check', 1)".format(search_table))
+        updated = [project.search_tags(conn, text) for text in SEARCH_TEXTS]
+        self.assertTrue(('node', benchmark.FIRST_NODE_ID + self.config.nodes) in updated[0])
+        fresh = self.loaded_db(self.final_path, BUILDS)
+        self.assertEqual(updated, [project.search_tags(fresh, text) for text in SEARCH_TEXTS])
+        project.build_tag_search(conn)
+        self.assertEqual(updated, [project.search_tags(conn, text) for text in SEARCH_TEXTS])
+
+    def test_node_index_matches_rebuild(self):
+        conn = self.changed_db()
+        rtree = [('node_rtree', None)]
+        updated = table_contents(conn, rtree)
+        self.assertEqual(updated, table_contents(self.loaded_db(self.final_path, BUILDS), rtree))
+        project.build_node_index(conn)
+        self.assertEqual(updated, table_contents(conn, rtree))
+        area = (benchmark.MIN_LAT, benchmark.MIN_LON, benchmark.MAX_LAT, benchmark.MAX_LON)
+        hits = project.nodes_in_bbox(conn, area)
+        self.assertEqual(len(hits), len(table_contents(conn)['node']))
+        self.assertEqual(hits, project.nodes_in_bbox(self.loaded_db(self.final_path, BUILDS), area))
+
+
+# The tables of dbs created before the tables were encoded, as the original project.py made them
+UNENCODED_TABLE_QUERIES = [
+    '''CREATE TABLE IF NOT EXISTS node(id INTEGER, lat REAL, lon REAL, user STRING, uid INTEGER,
+    version STRING, changeset INTEGER, timestamp STRING, PRIMARY KEY(id ASC))''',
+    '''CREATE TABLE IF NOT EXISTS node_tags(id INTEGER, key STRING, value STRING, type STRING,
+    FOREIGN KEY(id) REFERENCES node(id))''',
+    '''CREATE TABLE IF NOT EXISTS way(id INTEGER, user STRING, uid INTEGER, version STRING,
+    changeset INTEGER, timestamp STRING, PRIMARY KEY(id ASC))''',
+    '''CREATE TABLE IF NOT EXISTS way_nodes(id INTEGER, node_id INTEGER, position INTEGER,
+    FOREIGN KEY(id) REFERENCES way(id), FOREIGN KEY(node_id) REFERENCES node(id))''',
+    '''CREATE TABLE IF NOT EXISTS way_tags(id INTEGER, key STRING, value STRING, type STRING,
+    FOREIGN KEY(id) REFERENCES way(id))''',
+]
+
+
+def storage_problems(conn):
+    """Stored rows pointing at a missing lookup entry, and views not showing every stored row"""
+    problems = []
+    for table_name, (stored_table, encoded) in sorted(project.ENCODED_TABLES.items()):
+        for field, lookup_table in sorted(encoded.items()):
+            missing = conn.execute('SELECT COUNT(*) FROM {0} t WHERE {1}_id IS NOT NULL AND NOT EXISTS '
+                                   '(SELECT 1 FROM {2} WHERE id = t.{1}_id)'.format(stored_table, field, lookup_table))
+            problems.extend('{0}.{1}_id: {2} missing'.format(stored_table, field, count)
+                            for count, in missing if count)
+        counts = [conn.execute('SELECT COUNT(*) FROM ' + table).fetchone()[0] for table in (stored_table, table_name)]
+        if counts[0] != counts[1]:
+            problems.append('{0} shows {1[1]} of the {1[0]} rows of {2}'.format(table_name, counts, stored_table))
+    return problems
+
+
+class EncodedTablesTest(ChangesTestCase):
+    """The dictionary encoded tables behind the views, written by the loaders, by the views'
+    triggers and by encode_tables"""
+
+    def test_changes_keep_storage_consistent(self):
+        conn = self.loaded_db()
+        project.apply_changes(self.osc_path, conn, batch_size=2)
+        self.assertEqual(storage_problems(conn), [])
+        # the triggers added the changes' new users and keys; a loader must reuse their ids
+        node = project.ShapedNode(
+            project.Node(9, 12.95, 77.6, 'osc_mapper', 4242, '1', 1, '2017-01-01T00:00:00Z'),
+            [project.Tag(9, 'new_key', 'x', 'osc'), project.Tag(9, 'amenity', 'bank', 'regular')])
+        sink = project.SqliteSink(conn)
+        sink.add(node)
+        sink.close()
+        self.assertEqual(sum(loader.rejected for loader in sink.loaders.values()), 0)
+        self.assertEqual(storage_problems(conn), [])
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM users WHERE name = 'osc_mapper'").fetchone()[0], 1)
+        self.assertEqual(conn.execute("SELECT key, value FROM node_tags WHERE id = 9 ORDER BY key").fetchall(),
+                         [('amenity', 'bank'), ('new_key', 'x')])
+
+    def test_encode_tables_migrates_old_db(self):
+        expected = table_contents(self.loaded_db())
+        conn = sqlite3.connect(':memory:')
+        for query in UNENCODED_TABLE_QUERIES:
+            conn.execute(query)
+        for table_name, fields in project.TABLES:
+            conn.executemany(project.insert_query(table_name, fields), expected[table_name])
+        conn.commit()
+        self.assertTrue(project.is_unencoded(conn))
+        project.create_tables(conn)
+        self.assertFalse(project.is_unencoded(conn))
+        self.assertEqual(table_contents(conn), expected)
+        self.assertEqual(storage_problems(conn), [])
+        # the migrated db takes changes and builds like a db loaded encoded
+        project.apply_changes(self.osc_path, conn, batch_size=2)
+        for build in BUILDS:
+            build(conn)
+        fresh = self.loaded_db(self.final_path, BUILDS)
+        self.assertEqual(table_contents(conn), table_contents(fresh))
+        self.assertEqual(table_contents(conn, SUMMARY_TABLES), table_contents(fresh, SUMMARY_TABLES))
+        self.assertEqual([project.search_tags(conn, text) for text in SEARCH_TEXTS],
+                         [project.search_tags(fresh, text) for text in SEARCH_TEXTS])
+
+
+if __name__ == '__main__':
+    unittest.main()